@@ -1,13 +1,20 @@
 # This project is licensed under the MIT License.
 
 from pathlib import Path
+from subprocess import CalledProcessError
 import argparse
 import os
 import sys
 import logging
 
+from pkgbuilder.aur import Aur
 from pkgbuilder.builder import Builder
-from pkgbuilder.pkgbuild import Pkgbuild
+from pkgbuilder.chroot import Chroot
+from pkgbuilder.index import AurIndex
+from pkgbuilder.pkgbuild import Pkgbuild, LocalDir
+from pkgbuilder.planner import Planner
+from pkgbuilder.store import ManifestStore
+from pkgbuilder.watch import Watch
 
 log = logging.getLogger('pkgbuilder')
 log.setLevel(logging.INFO)
@@ -20,6 +27,28 @@ def die(e):
     sys.exit(1)
 
 
+def watch(args, builder, names=None):
+    localdir = LocalDir.new(args.pkgbuilds, args.builddir, args.makepkg_config)
+    with Watch(localdir, builder, names) as w:
+        log.info('Watching %s...', localdir.path)
+        for names in w:
+            for name in names:
+                try:
+                    b = builder(name)
+                    if not b.build(args.rebuild, args.jobs):
+                        continue
+                    if args.install or args.reinstall:
+                        b.install(args.reinstall, repo=args.repo)
+                except (Pkgbuild.NoPkgbuildError,
+                        Pkgbuild.SourceNotFoundError,
+                        Pkgbuild.ParseSrcinfoError,
+                        LocalDir.ProviderNotFoundError,
+                        Planner.CycleError) as e:
+                    log.error('%s: %s', name, e.args[0])
+                except CalledProcessError as e:
+                    log.error('%s: %s', name, e)
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('name', nargs='*', help='package name')
@@ -45,6 +74,24 @@ def main():
                    help='remove package build directories')
     p.add_argument('-a', '--aur', action='store_true',
                    help='search for packages in the AUR only')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='number of packages to build at once')
+    p.add_argument('--db', action='store_true',
+                   help='keep build manifests in a database in the build \
+                   directory')
+    p.add_argument('-w', '--watch', action='store_true',
+                   help='rebuild packages when local PKGBUILDs change')
+    p.add_argument('--offline', action='store_true',
+                   help='use cached AUR package info only')
+    p.add_argument('-y', '--refresh', action='store_true',
+                   help='request AUR package info even if it was cached \
+                   less than an hour ago')
+    p.add_argument('--snapshots', action='store_true',
+                   help='download AUR snapshots instead of cloning git \
+                   repositories')
+    p.add_argument('--aur-index', metavar='DUMP',
+                   help='find AUR providers, and AUR packages when offline, \
+                   in a packages-meta-ext-v1 metadata dump')
 
     args = p.parse_args()
     cwd = Path(os.getcwd())
@@ -55,9 +102,40 @@ def main():
         else:
             args.pkgbuilds = cwd.parent
 
+    names = args.name
     if not args.name:
         args.name = [cwd.name]
 
+    index = None
+    if args.aur_index:
+        index = AurIndex.load(args.aur_index, Path(args.builddir, 'aur.idx'))
+    Pkgbuild.aur = Aur(cachedir=Path(args.builddir, 'rpc'),
+                       offline=args.offline, index=index)
+    if args.refresh:
+        Pkgbuild.aur.ttl = 0
+    Pkgbuild.snapshots = args.snapshots
+    Chroot.imagedir = Path(args.builddir, 'images')
+    Chroot.cachedir = Path(args.builddir, 'pkgcache')
+
+    store = None
+    if args.db:
+        store = ManifestStore(Path(args.builddir, 'manifest.db'))
+        if not store.migrated:
+            store.migrate(args.builddir)
+
+    def builder(name):
+        return Builder.new(name, args.pacman_config, args.makepkg_config,
+                           args.builddir, args.chrootdir, args.pkgbuilds,
+                           Pkgbuild.Source.Aur if args.aur else None,
+                           store=store)
+
+    if args.watch:
+        try:
+            watch(args, builder, names)
+        except KeyboardInterrupt:
+            pass
+        return
+
     for name in args.name:
         try:
             n = Path(name).resolve(True)
@@ -66,16 +144,16 @@ def main():
         except FileNotFoundError:
             pass
         try:
-            b = Builder(name, args.pacman_config, args.makepkg_config,
-                        args.builddir, args.chrootdir, args.pkgbuilds,
-                        args.aur if Pkgbuild.Source.Aur else None)
+            b = builder(name)
         except Pkgbuild.NoPkgbuildError as e:
             die(e)
         if args.remove:
             b.pkgbuild.remove()
+            if store:
+                store.remove(b.pkgbuilddir)
             continue
         try:
-            b.build(args.rebuild)
+            b.build(args.rebuild, args.jobs)
         except Pkgbuild.SourceNotFoundError as e:
             die(e)
         if args.install or args.reinstall:
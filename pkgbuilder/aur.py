@@ -7,16 +7,183 @@
 .. moduleauthor:: James Reed <jcrd@tuta.io>
 """
 
-from pathlib import Path
-from subprocess import run
+from asyncio.subprocess import PIPE
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from pathlib import Path, PurePosixPath
+from shutil import rmtree
+from subprocess import CalledProcessError, run
+from threading import BoundedSemaphore, Lock
+from urllib.error import HTTPError, URLError
+import asyncio
+import hashlib
 import json
 import logging
+import os
+import posixpath
+import re
 import tarfile
-import urllib.request
+import tempfile
+import time
+import urllib.parse
+
+from .cache import DiskCache
 
 log = logging.getLogger('pkgbuilder.aur')
 
 
+class ConnectionPool:
+    """
+    A thread-safe pool of persistent HTTP connections. Failed requests are
+    retried with exponential backoff.
+
+    :param max_connections: Maximum number of connections per host, \
+    defaults to 4
+    :param retries: Number of times to retry failed requests, defaults to 3
+    :param backoff: Seconds to wait before the first retry, doubled for each \
+    following retry, defaults to 0.5
+    :param timeout: Connection timeout in seconds, defaults to 30
+    """
+    retry_status = {429, 500, 502, 503, 504}
+    max_redirects = 5
+
+    def __init__(self, max_connections=4, retries=3, backoff=0.5, timeout=30):
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._idle = {}
+        self._slots = {}
+        self._lock = Lock()
+
+    def _acquire(self, host):
+        """
+        Get an idle connection to a host or open a new one, waiting while
+        the maximum number of connections are in use.
+
+        :param host: A tuple of the scheme, hostname and port
+        :return: An HTTPConnection or HTTPSConnection
+        """
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = BoundedSemaphore(self.max_connections)
+            slot = self._slots[host]
+        slot.acquire()
+        with self._lock:
+            idle = self._idle.get(host)
+            if idle:
+                return idle.pop()
+        scheme, hostname, port = host
+        if scheme == 'https':
+            return HTTPSConnection(hostname, port, timeout=self.timeout)
+        return HTTPConnection(hostname, port, timeout=self.timeout)
+
+    def _release(self, host, conn, reuse):
+        """
+        Return a connection to the pool.
+
+        :param host: A tuple of the scheme, hostname and port
+        :param conn: The connection
+        :param reuse: Keep the connection open for following requests
+        """
+        if reuse:
+            with self._lock:
+                self._idle.setdefault(host, []).append(conn)
+        else:
+            conn.close()
+        self._slots[host].release()
+
+    def close(self):
+        """
+        Close idle connections.
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+    @contextmanager
+    def request(self, url):
+        """
+        Send a GET request, following redirects.
+
+        :param url: The URL
+        :raises HTTPError: Raised when the server responds with an error or \
+        redirects too many times
+        :raises URLError: Raised when the request fails after all retries
+        :return: A context manager yielding an HTTPResponse. The connection \
+        is reused if the response is read completely
+        """
+        for _ in range(self.max_redirects + 1):
+            u = urllib.parse.urlsplit(url)
+            host = (u.scheme, u.hostname, u.port)
+            path = u.path or '/'
+            if u.query:
+                path += '?' + u.query
+            r, conn = self._send(host, path, url)
+            if r.status not in (301, 302, 303, 307, 308):
+                break
+            location = r.getheader('Location')
+            try:
+                r.read()
+            except Exception:
+                self._release(host, conn, False)
+                raise
+            self._release(host, conn, not r.will_close)
+            if not location:
+                raise HTTPError(url, r.status, 'Redirect without Location',
+                                r.headers, None)
+            url = urllib.parse.urljoin(url, location)
+        else:
+            raise HTTPError(url, r.status, 'Too many redirects', r.headers,
+                            None)
+        try:
+            yield r
+        finally:
+            self._release(host, conn, r.isclosed() and not r.will_close)
+
+    def _send(self, host, path, url):
+        """
+        Send a GET request, retrying on connection errors and transient
+        server errors.
+
+        :return: A tuple of the HTTPResponse and its connection
+        """
+        attempt = 0
+        while True:
+            conn = self._acquire(host)
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                r = conn.getresponse()
+            except (HTTPException, OSError) as e:
+                self._release(host, conn, False)
+                # Idle connections may have been closed by the server.
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise URLError(e)
+                err = e
+            else:
+                if r.status < 400:
+                    return r, conn
+                r.read()
+                self._release(host, conn, not r.will_close)
+                if r.status not in self.retry_status or \
+                        attempt >= self.retries:
+                    raise HTTPError(url, r.status, r.reason, r.headers, None)
+                err = '{} {}'.format(r.status, r.reason)
+            delay = self.backoff * 2 ** attempt
+            log.debug('Retrying %s in %.1fs: %s', url, delay, err)
+            time.sleep(delay)
+            attempt += 1
+
+
+default_pool = ConnectionPool()
+
+
 class GitRepo:
     """
     A local git repository.
@@ -40,8 +207,17 @@ class GitRepo:
         :raises CalledProcessError: Raised if the git command fails
         """
         run(self._git('fetch origin master'), check=True)
-        r = run(self._git('rev-list HEAD..origin/master --count'), check=True)
-        return r.stdout == '0'
+        r = run(self._git('rev-list HEAD..origin/master --count'), check=True,
+                capture_output=True, text=True)
+        return r.stdout.strip() == '0'
+
+    def pull_cmd(self):
+        """
+        Get the command that runs git pull in this repository.
+
+        :return: A list of command arguments
+        """
+        return self._git('pull')
 
     def pull(self):
         """
@@ -49,7 +225,16 @@ class GitRepo:
 
         :raises CalledProcessError: Raised if the git command fails
         """
-        run(self._git('pull'), check=True)
+        run(self.pull_cmd(), check=True)
+
+    def clone_cmd(self, url):
+        """
+        Get the command that clones a git repository to self.path.
+
+        :param url: Git repository URL
+        :return: A list of command arguments
+        """
+        return ['git', 'clone', '--depth=1', url, str(self.path)]
 
     def clone(self, url):
         """
@@ -61,7 +246,178 @@ class GitRepo:
         """
         if self.path.exists():
             raise FileExistsError
-        run(['git', 'clone', '--depth=1', url, str(self.path)], check=True)
+        run(self.clone_cmd(url), check=True)
+
+
+class GitPool:
+    """
+    Run git commands for many repositories concurrently.
+
+    :param jobs: Maximum number of commands to run at once, defaults to 8
+    :param timeout: Seconds before a command is killed, defaults to 300
+    """
+    class GitError(Exception):
+        """
+        An exception raised when git commands fail for one or more
+        repositories.
+        """
+        pass
+
+    def __init__(self, jobs=8, timeout=300):
+        self.jobs = jobs
+        self.timeout = timeout
+
+    async def _exec(self, cmd):
+        p = await asyncio.create_subprocess_exec(*cmd, stdout=PIPE,
+                                                 stderr=PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(p.communicate(),
+                                                    self.timeout)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            raise TimeoutError('{} timed out after {}s'.format(
+                ' '.join(cmd), self.timeout))
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, cmd, stdout, stderr)
+        return stdout
+
+    async def _task(self, semaphore, cmds):
+        async with semaphore:
+            for cmd in cmds:
+                await self._exec(cmd)
+
+    async def _run(self, tasks):
+        semaphore = asyncio.Semaphore(self.jobs)
+        keys = list(tasks)
+        results = await asyncio.gather(
+            *[self._task(semaphore, tasks[k]) for k in keys],
+            return_exceptions=True)
+        return {k: r for k, r in zip(keys, results)
+                if isinstance(r, Exception)}
+
+    def run(self, tasks):
+        """
+        Run git commands. The commands of each task are run in order, while
+        tasks run concurrently. A failing task does not stop the others.
+
+        :param tasks: A dictionary mapping keys to lists of commands
+        :return: A dictionary mapping the keys of failed tasks to exceptions
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._run(tasks))
+        finally:
+            loop.close()
+
+    @staticmethod
+    def error(errors):
+        """
+        Create a GitError reporting failed tasks.
+
+        :param errors: A dictionary mapping keys of failed tasks to exceptions
+        :return: A GitError
+        """
+        lines = []
+        for k, e in errors.items():
+            msg = str(e)
+            if isinstance(e, CalledProcessError) and e.stderr:
+                msg = e.stderr.decode(errors='replace').strip()
+            lines.append('{}: {}'.format(k, msg))
+        return GitPool.GitError({'message': 'git failed for {} repositories'
+                                 .format(len(errors)),
+                                 'errors': '\n'.join(lines)})
+
+
+class MirrorStore:
+    """
+    Bare mirrors of AUR packages' git repositories. Build directories are
+    cloned from and pulled from the mirrors, so re-creating a build directory
+    needs no network access and each mirror is refreshed with a single fetch
+    when its package changes. Mirrors are locked while they are written so
+    they can be shared by several processes.
+
+    :param path: Path to directory of mirrors
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def mirror(self, name):
+        """
+        Get the path to a package's mirror.
+
+        :param name: Package name
+        :return: Path to the bare repository
+        """
+        return Path(self.path, name + '.git')
+
+    def _lockpath(self, name):
+        return Path(self.path, name + '.lock')
+
+    def _statepath(self, name):
+        return Path(self.mirror(name), 'pkgbuilder.json')
+
+    def fresh(self, aurpkg):
+        """
+        Check if a mirror contains the package's current git repository.
+
+        :param aurpkg: The AurPackage
+        :return: `True` if the mirror is up-to-date, `False` otherwise
+        """
+        try:
+            with open(self._statepath(aurpkg.name)) as f:
+                return json.load(f) == aurpkg.state
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def save(self, aurpkg):
+        """
+        Record that a mirror contains the package's current git repository.
+
+        :param aurpkg: The AurPackage
+        """
+        with open(self._statepath(aurpkg.name), 'w') as f:
+            json.dump(aurpkg.state, f)
+
+    def fetch_cmds(self, aurpkg):
+        """
+        Get the commands that create or refresh a package's mirror.
+
+        :param aurpkg: The AurPackage
+        :return: A list of commands or an empty list if the mirror is \
+        up-to-date
+        """
+        if self.fresh(aurpkg):
+            return []
+        self.path.mkdir(parents=True, exist_ok=True)
+        lock = ['flock', str(self._lockpath(aurpkg.name))]
+        mirror = str(self.mirror(aurpkg.name))
+        return [lock + ['git', 'init', '-q', '--bare', mirror],
+                lock + ['git', '-C', mirror, 'fetch', '-q', '--prune',
+                        aurpkg.giturl, '+refs/heads/*:refs/heads/*']]
+
+    def clone_cmd(self, aurpkg, dest):
+        """
+        Get the command that clones a package's mirror. Objects are
+        hardlinked from the mirror when it is on the same filesystem.
+
+        :param aurpkg: The AurPackage
+        :param dest: Local repository destination
+        :return: A list of command arguments
+        """
+        return ['git', 'clone', '-q', '-b', 'master',
+                str(self.mirror(aurpkg.name)), str(dest)]
+
+    def pull_cmd(self, aurpkg, dest):
+        """
+        Get the command that pulls a package's mirror into a repository.
+
+        :param aurpkg: The AurPackage
+        :param dest: Local repository
+        :return: A list of command arguments
+        """
+        return ['git', '-C', str(dest), 'pull', '-q',
+                str(self.mirror(aurpkg.name)), 'master']
 
 
 class AurPackage:
@@ -70,31 +426,97 @@ class AurPackage:
 
     :param info: Package info
     :param url: URL to the AUR interface
+    :param pool: ConnectionPool used for downloads, defaults to a pool \
+    shared by the process
     """
-    def __init__(self, info, url):
+    def __init__(self, info, url, pool=None):
         self.info = info
         self.url = url
+        self.pool = pool or default_pool
         self.name = info['Name']
         self.urlpath = url + info['URLPath']
         self.giturl = url + '/{}.git'.format(self.name)
 
+    class SnapshotError(Exception):
+        """
+        An exception raised when a snapshot is incomplete or contains unsafe
+        members.
+        """
+        pass
+
+    def _member(self, m, base):
+        """
+        Check a snapshot member and strip the snapshot's top-level directory
+        from its path.
+
+        :param m: The TarInfo
+        :param base: Name of the snapshot's top-level directory
+        :raises SnapshotError: Raised when the member has an absolute path, \
+        a path outside the snapshot, is a hardlink or a special file, or is \
+        a symlink pointing outside the snapshot
+        :return: The member's relative path or `None` if it is skipped
+        """
+        err = {'message': 'Unsafe snapshot member', 'package': self.name,
+               'member': m.name}
+        path = PurePosixPath(m.name)
+        if path.is_absolute() or '..' in path.parts:
+            raise AurPackage.SnapshotError(err)
+        if not path.parts or path.parts[0] != base or len(path.parts) < 2:
+            return None
+        if not (m.isfile() or m.isdir() or m.issym()):
+            raise AurPackage.SnapshotError(err)
+        rel = PurePosixPath(*path.parts[1:])
+        if m.issym():
+            target = posixpath.normpath(posixpath.join(str(rel.parent),
+                                                       m.linkname))
+            if posixpath.isabs(m.linkname) or target.split('/')[0] == '..':
+                raise AurPackage.SnapshotError(err)
+        return str(rel)
+
     def download(self, dest):
         """
-        Download and extract package snapshot to given destination.
+        Download and extract package snapshot to given destination. The
+        snapshot is extracted in a single pass while it is downloaded, into a
+        temporary directory that replaces the destination once the snapshot
+        is complete.
 
         :param dest: Extraction destination
+        :raises SnapshotError: Raised when the snapshot contains unsafe \
+        members or no PKGBUILD
         """
-        with urllib.request.urlopen(self.urlpath) as r:
-            with tarfile.open(fileobj=r, mode='r:gz') as t:
-                log.info('%s: Downloading AUR snapshot to %s...',
-                         self.name, dest)
-                prefix = self.name + '/'
-                members = []
-                for m in t.getmembers():
-                    if m.name.startswith(prefix):
-                        m.name = m.name[len(prefix):]
-                        members.append(m)
-                t.extractall(dest, members)
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=dest.parent, prefix='.')
+        base = self.info.get('PackageBase') or self.name
+        kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        try:
+            log.info('%s: Downloading AUR snapshot to %s...', self.name, dest)
+            with self.pool.request(self.urlpath) as r:
+                with tarfile.open(fileobj=r, mode='r|gz') as t:
+                    for m in t:
+                        name = self._member(m, base)
+                        if name is None:
+                            continue
+                        m.name = name
+                        t.extract(m, tmp, **kwargs)
+            if not Path(tmp, 'PKGBUILD').is_file():
+                raise AurPackage.SnapshotError(
+                    {'message': 'Snapshot does not contain a PKGBUILD',
+                     'package': self.name})
+            if dest.exists():
+                rmtree(dest)
+            os.replace(tmp, dest)
+        except BaseException:
+            rmtree(tmp, ignore_errors=True)
+            raise
+
+    @property
+    def state(self):
+        """
+        The package info that changes when the package's git repository
+        changes.
+        """
+        return {k: self.info.get(k) for k in ['LastModified', 'Version']}
 
     def git_clone(self, dest):
         """
@@ -114,40 +536,234 @@ class Aur:
 
     :param url: URL providing the RPC interface, defaults to \
     https://aur.archlinux.org
+    :param jobs: Maximum number of concurrent requests, defaults to 4
+    :param cachedir: Path to a directory to keep package info in across \
+    runs, defaults to keeping it in memory only
+    :param ttl: Seconds before package info kept in cachedir is requested \
+    again, defaults to one hour
+    :param offline: Serve package info from cachedir only, regardless of \
+    its age, defaults to `False`
+    :param pool: ConnectionPool used for requests, defaults to a pool \
+    shared by the process
+    :param index: An AurIndex to look up packages in when offline or when \
+    requests fail, and to find providers in, defaults to `None`
     """
-    def __init__(self, url='https://aur.archlinux.org'):
+    max_url_length = 4443
+
+    def __init__(self, url='https://aur.archlinux.org', jobs=4,
+                 cachedir=None, ttl=3600, offline=False, pool=None,
+                 index=None):
         self.url = url
         self.rpc = url + '/rpc/?v=5&type=info'
+        self.jobs = jobs
+        self.ttl = ttl
+        self.offline = offline
         self.cache = {}
+        self.missing = set()
+        self.disk = DiskCache.new(cachedir) if cachedir else None
+        self.pool = pool or default_pool
+        self.index = index
+        self._lock = Lock()
 
-    def infos(self, *names):
+    def _key(self, name):
+        return hashlib.sha256('{}\0{}'.format(self.url, name).encode()) \
+            .hexdigest()
+
+    def _use(self, infos):
         """
-        Get info about AUR packages.
+        Cache package info in memory.
 
-        :param names: Positional arguments specifying package names
-        :return: A dictionary mapping names to info
+        :param infos: A dictionary mapping names to info or `None` if the \
+        package does not exist
         """
-        res = {}
-        args = ''
+        with self._lock:
+            for name, info in infos.items():
+                if info:
+                    self.cache[name] = info
+                else:
+                    self.missing.add(name)
+
+    def _load(self, names):
+        """
+        Load package info from the cache directory. Unexpired info is cached
+        in memory.
 
+        :param names: A set of package names
+        :return: A dictionary mapping names of packages with expired info \
+        to info or `None` if the package did not exist
+        """
+        if not self.disk:
+            return {}
+        now = time.time()
+        fresh = {}
+        expired = {}
         for name in names:
-            if name in self.cache:
-                res[name] = self.cache[name]
+            entry = self.disk.get(self._key(name))
+            if entry is None:
+                continue
+            timestamp, info = entry
+            if now - timestamp < self.ttl:
+                fresh[name] = info
             else:
-                args += '&arg[]={}'.format(name)
+                expired[name] = info
+        self._use(fresh)
+        return expired
+
+    def _chunks(self, names):
+        """
+        Split package names into query strings that keep request URLs
+        within the RPC's length limit.
+
+        :param names: An iterable of package names
+        :return: A list of query strings
+        """
+        chunks = []
+        args = ''
+        for name in sorted(names):
+            arg = '&arg[]=' + urllib.parse.quote(name, safe='')
+            if args and len(self.rpc) + len(args) + len(arg) > \
+                    self.max_url_length:
+                chunks.append(args)
+                args = ''
+            args += arg
+        if args:
+            chunks.append(args)
+        return chunks
+
+    def _request(self, args):
+        """
+        Query the RPC interface.
+
+        :param args: The query string
+        :return: A list of package infos
+        """
+        with self.pool.request(self.rpc + args) as r:
+            return json.loads(r.read().decode('utf-8'))['results']
+
+    def _fetch(self, names):
+        """
+        Fetch info about packages in concurrent requests and cache the
+        results, replacing any expired info. Names not found are remembered
+        so they are not requested again.
+
+        :param names: A set of package names
+        """
+        chunks = self._chunks(names)
+        jobs = min(self.jobs, len(chunks))
+        if jobs < 2:
+            results = list(map(self._request, chunks))
+        else:
+            with ThreadPoolExecutor(jobs) as executor:
+                results = list(executor.map(self._request, chunks))
+        infos = dict.fromkeys(names)
+        for pkgs in results:
+            for pkg in pkgs:
+                infos[pkg['Name']] = pkg
+        self._use(infos)
+
+        if self.disk:
+            now = time.time()
+            for name, info in infos.items():
+                self.disk.put(self._key(name), (now, info))
+
+    def _fallback(self, names, expired):
+        """
+        Get the best info available without requesting it: the newer of the
+        expired info and the info in the index by LastModified.
+
+        :param names: A set of package names
+        :param expired: A dictionary mapping names to expired info
+        :return: A dictionary mapping names to info
+        """
+        infos = {n: expired[n] for n in names if n in expired}
+        if self.index:
+            for name in names:
+                info = self.index.get(name)
+                if not info:
+                    continue
+                old = infos.get(name) or {}
+                if info.get('LastModified', 0) >= \
+                        old.get('LastModified', 0):
+                    infos[name] = info
+        return infos
 
-        if not args:
-            return res
+    def infos(self, *names):
+        """
+        Get info about AUR packages. Info is requested only if it is not
+        cached or has expired. If the request fails, or when offline, expired
+        info or info from the index is used instead, whichever is newer.
 
-        with urllib.request.urlopen(self.rpc + args) as r:
-            s = r.read().decode('utf-8')
-            for pkg in json.loads(s)['results']:
-                name = pkg['Name']
-                self.cache[name] = pkg
-                res[name] = pkg
+        :param names: Positional arguments specifying package names
+        :raises URLError: Raised when the request fails and no info is cached
+        :return: A dictionary mapping names to info
+        """
+        with self._lock:
+            uncached = {n for n in names
+                        if n not in self.cache and n not in self.missing}
+        if uncached:
+            expired = self._load(uncached)
+            with self._lock:
+                uncached = {n for n in uncached
+                            if n not in self.cache and n not in self.missing}
+            if self.offline:
+                found = self._fallback(uncached, expired)
+                self._use(found)
+                self._use(dict.fromkeys(uncached - found.keys()))
+            elif uncached:
+                try:
+                    self._fetch(uncached)
+                except (URLError, OSError) as e:
+                    found = self._fallback(uncached, expired)
+                    if uncached - found.keys():
+                        raise
+                    log.warning('Using expired AUR package info: %s', e)
+                    self._use(found)
+        return {n: self.cache[n] for n in names if n in self.cache}
+
+    def prefetch(self, names):
+        """
+        Fetch info about packages and, breadth-first, about their
+        dependencies until the dependency closure is cached. Each level of
+        the closure is fetched in as few requests as possible. Names that
+        are not packages are expanded to their providers in the index.
 
+        :param names: An iterable of package names
+        :return: A dictionary mapping names of found packages to info
+        """
+        seen = set()
+        queue = set(names)
+        res = {}
+        while queue:
+            log.debug('Prefetching %d AUR packages...', len(queue))
+            infos = self.infos(*queue)
+            for name in queue - infos.keys():
+                for info in self.providers(name):
+                    infos[info['Name']] = info
+            res.update(infos)
+            seen |= queue
+            queue = set()
+            for info in infos.values():
+                for dep in info.get('Depends', []) + \
+                        info.get('MakeDepends', []):
+                    name = re.split('[<>=]', dep, maxsplit=1)[0]
+                    if name not in seen:
+                        queue.add(name)
         return res
 
+    def providers(self, name):
+        """
+        Get info about AUR packages that provide a name. Providers can only
+        be found in the index.
+
+        :param name: Provided name
+        :return: A list of package infos
+        """
+        if not self.index:
+            return []
+        infos = self.index.providers(name)
+        self._use({i['Name']: i for i in infos})
+        return infos
+
     def info(self, name):
         """
         Get info about an AUR package.
@@ -169,4 +785,4 @@ class Aur:
         """
         i = self.info(name)
         if i:
-            return AurPackage(i, self.url)
+            return AurPackage(i, self.url, self.pool)
@@ -7,17 +7,21 @@
 .. moduleauthor:: James Reed <jcrd@tuta.io>
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 from enum import IntEnum
 from pathlib import Path
 from itertools import repeat
 import json
 import logging
+import os
 import time
 
-from .chroot import Chroot
-from .pkgbuild import Pkgbuild, LocalDir, parse_restriction
+from .chroot import Chroot, ChrootPool
+from .pkgbuild import Pkgbuild, LocalDir
+from .planner import Planner
 from .repo import get_repo
-from .utils import write_stdin, default_pacman_conf
+from .utils import Registry, write_stdin, default_pacman_conf
 
 log = logging.getLogger('pkgbuilder')
 
@@ -38,19 +42,24 @@ class Manifest:
 
     :param pkgname: Name of package
     :param pkgbuilddir: Path to PKGBUILD directory
+    :param store: A ManifestStore to read and write the manifest through \
+    instead of a build.json file
     """
-    def __init__(self, pkgname, pkgbuilddir):
+    def __init__(self, pkgname, pkgbuilddir, store=None):
         self.pkgname = pkgname
         self.pkgbuilddir = pkgbuilddir
         self.filepath = Path(pkgbuilddir, 'build.json')
+        self.store = store
         self.reset()
 
     def exists(self):
         """
-        Check if the manifest file exists.
+        Check if the manifest exists.
 
         :return: `True` if exists, `False` otherwise
         """
+        if self.store:
+            return self.store.exists(self.pkgbuilddir)
         return self.filepath.exists()
 
     @property
@@ -95,7 +104,7 @@ class Manifest:
 
     def save(self):
         """
-        Save the manifest file.
+        Save the manifest.
         """
         d = {
             'name': self.pkgname,
@@ -103,32 +112,43 @@ class Manifest:
             'packages': list(self.packages),
             'depends': list(self.depends),
             'makedepends': list(self.makedepends),
+            'key': self.key,
         }
+        if self.store:
+            self.store.save(d, self.pkgbuilddir)
+            return
         with open(self.filepath, 'w') as f:
             json.dump(d, f)
 
     def load(self):
         """
-        Load the manifest file and populate the manifest's packages and
+        Load the manifest and populate the manifest's packages and
         dependencies properties.
 
         :return: A dictionary with keys: name, timestamp, packages, depends, \
-        makedepends
+        makedepends, key
         """
-        if not self.exists():
+        if self.store:
+            j = self.store.load(self.pkgbuilddir)
+        elif self.exists():
+            with open(self.filepath) as f:
+                j = json.load(f)
+        else:
+            j = {}
+        if not j:
+            return {}
+
+        try:
+            self.pkgname = j['name']
+            self.packages = set(j['packages'])
+            self.depends = set(j['depends'])
+            self.makedepends = set(j['makedepends'])
+            self.key = j.get('key')
+        except KeyError as e:
+            log.warning('Found malformed manifest: {}'.format(e))
             return {}
-        with open(self.filepath) as f:
-            j = json.load(f)
-            try:
-                self.pkgname = j['name']
-                self.packages = set(j['packages'])
-                self.depends = set(j['depends'])
-                self.makedepends = set(j['makedepends'])
-            except KeyError as e:
-                log.warning('Found malformed manifest: {}'.format(e))
-                return {}
-
-            return j
+
+        return j
 
     def reset(self):
         """
@@ -137,6 +157,7 @@ class Manifest:
         self.packages = set()
         self.depends = set()
         self.makedepends = set()
+        self.key = None
 
     def install(self, reinstall=False, pacman_conf=None, sysroot=None,
                 confirm=False):
@@ -201,6 +222,11 @@ class Builder(Manifest):
     :param localdir: Path to directory of local PKGBUILDs
     :param source: PKGBUILD source - one of Pkgbuild.Source.Local or \
     Pkgbuild.Source.Aur
+    :param restrictions: A list of version Restrictions used to select a \
+    provider from localdir
+    :param pkgbuild: The Pkgbuild to build, resolved from name if not given
+    :param store: A ManifestStore to keep manifests in, defaults to \
+    build.json files
     :raises SourceNotFoundError: Raised when no source can be found for \
     name or its dependencies
     :raises NoPkgbuildError: Raised when a local directory exists but \
@@ -214,6 +240,49 @@ class Builder(Manifest):
         Package = 1
         All = 2
 
+    registry = Registry()
+
+    @classmethod
+    def new(cls,
+            name,
+            pacman_conf=default_pacman_conf,
+            makepkg_conf='/etc/makepkg.conf',
+            builddir='/var/cache/pkgbuilder',
+            chrootdir='/var/lib/pkgbuilder',
+            localdir=None,
+            source=None,
+            restrictions=[],
+            pkgbuild=None,
+            store=None):
+        """
+        Get the Builder shared by this process for a package, creating it if
+        necessary. Shared Builders build their package at most once per
+        process, so packages that are dependencies of several others are
+        resolved and built only once. Parameters are the same as Builder's.
+
+        :return: A Builder
+        """
+        path = localdir.path if isinstance(localdir, LocalDir) else localdir
+        key = (name, source, tuple(restrictions), pacman_conf, makepkg_conf,
+               str(builddir), str(chrootdir), path and str(path),
+               pkgbuild and str(pkgbuild.builddir), id(store))
+        return cls.registry.get(
+            key, lambda: cls(name, pacman_conf, makepkg_conf, builddir,
+                             chrootdir, localdir, source, restrictions,
+                             pkgbuild, store))
+
+    @classmethod
+    def invalidate(cls, name=None):
+        """
+        Forget shared Builders and their build results, along with shared
+        PKGBUILDs.
+
+        :param name: Package name, defaults to all packages
+        :return: The number of forgotten Builders
+        """
+        Pkgbuild.invalidate(name)
+        return cls.registry.invalidate(lambda k: name is None or k[0] == name)
+
     def __init__(self,
                  name,
                  pacman_conf=default_pacman_conf,
@@ -222,7 +291,9 @@ class Builder(Manifest):
                  chrootdir='/var/lib/pkgbuilder',
                  localdir=None,
                  source=None,
-                 restrictions=[]):
+                 restrictions=[],
+                 pkgbuild=None,
+                 store=None):
         self.name = name
         self.pacman_conf = pacman_conf
         self.makepkg_conf = makepkg_conf
@@ -232,79 +303,179 @@ class Builder(Manifest):
 
         self.chroot = Chroot(chrootdir)
 
+        self.built = False
+        self.attempted = False
+
         if isinstance(localdir, LocalDir):
             self.localdir = localdir
-            self.pkgbuild = localdir.providers(name, restrictions)[0]
+            self.pkgbuild = pkgbuild or \
+                localdir.providers(name, restrictions)[0]
         else:
-            self.localdir = LocalDir(localdir, builddir, makepkg_conf)
-            self.localdir.update()
-            self.pkgbuild = Pkgbuild.new(name, builddir, localdir, source,
-                                         makepkg_conf)
+            self.localdir = LocalDir.new(localdir, builddir, makepkg_conf)
+            self.pkgbuild = pkgbuild or \
+                Pkgbuild.new(name, builddir, localdir, source, makepkg_conf)
+
+        self.planner = Planner(self.localdir, builddir, source, pacman_conf,
+                               makepkg_conf)
 
-        super().__init__(name, self.pkgbuild.builddir)
+        super().__init__(name, self.pkgbuild.builddir, store)
 
-    def _build(self, rebuild=0, iter=1):
+    def plan(self):
         """
-        Recursively build a package. If the initial build fails, build missing
-        dependencies before retrying.
+        Resolve the package's dependencies into a build plan.
 
-        :param rebuild: Build packages even if they exist. \
-        `Builder.Rebuild.Package` will rebuild only the package, while \
-        `Builder.Rebuild.All` will rebuild the package and all dependencies
-        :param iter: The iteration number
+        :raises CycleError: Raised when the dependency graph contains a cycle
+        :return: A list of planner Nodes in build order
+        """
+        return self.planner.plan(self.pkgbuild)
+
+    def _dependency(self, node):
+        """
+        Get a Builder for a dependency in the build plan.
+
+        :param node: The planner Node of the dependency
+        :return: A Builder
+        """
+        return Builder.new(node.name, self.pacman_conf, self.makepkg_conf,
+                           self.builddir, self.chrootdir, self.localdir,
+                           self.source, pkgbuild=node.pkgbuild,
+                           store=self.store)
+
+    def _build_package(self, rebuild=False, depends=set(),
+                       makedepends=set(), pool=None, key=None):
+        """
+        Build only this package, installing the given dependencies into the
+        chroot. The package is skipped if it was built from the same inputs.
+
+        :param rebuild: Build the package even if it exists
+        :param depends: A set of paths to runtime dependency packages
+        :param makedepends: A set of paths to build dependency packages
+        :param pool: A ChrootPool to lease the chroot copy to build in from \
+        once a build is needed, defaults to makechrootpkg's default copy
+        :param key: The build cache key of the package's inputs
         :return: A set of paths to built runtime packages
         """
-        if iter == 1:
-            if rebuild:
-                log.info('%s: Rebuilding...', self.name)
-            else:
-                if self.load() and self.verify():
-                    log.info('%s: Already built', self.name)
-                    return self.runtime_packages
-                else:
-                    self.reset()
+        if self.built:
+            return self.runtime_packages
+        if rebuild:
+            log.info('%s: Rebuilding...', self.name)
+        elif self.load() and self.verify():
+            if self.key == key:
+                log.info('%s: Already built', self.name)
+                self.built = True
+                return self.runtime_packages
+            log.info('%s: Inputs changed, rebuilding...', self.name)
+
+        self.reset()
+        self.key = key
+        self.depends = set(depends)
+        self.makedepends = set(makedepends)
 
-        log.info('%s: Building... [pass %d]', self.name, iter)
-        r, stdout, stderr = self.chroot.makepkg(self.pkgbuild,
-                                                self.build_depends)
+        log.info('%s: Building...', self.name)
+        self.attempted = True
+        with pool.lease() if pool else nullcontext() as copy:
+            r, stdout, stderr = self.chroot.makepkg(self.pkgbuild,
+                                                    self.build_depends, copy)
 
         if r == 0:
             self.packages |= set(self.pkgbuild.packagelist)
             if self.verify():
                 self.save()
+                self.built = True
                 return self.runtime_packages
-        elif iter == 1:
-            for line in stdout.splitlines():
-                f = line.split(": ")
-                if f[0] == 'error' and f[1] == 'target not found':
-                    dep, _ = parse_restriction(f[2])
-                    type = self.pkgbuild.dependency_type(dep)
-                    log.info('%s: Missing %s: %s', self.name, type, dep)
-                    rs = self.pkgbuild.dependency_restrictions(dep)
-                    b = Builder(dep, self.pacman_conf, self.makepkg_conf,
-                                self.builddir, self.chrootdir, self.localdir,
-                                restrictions=rs)
-                    b._build(rebuild if rebuild > Builder.Rebuild.Package else \
-                             False)
-                    if type == 'depends':
-                        self.depends |= set(b.packages)
-                    if type == 'makedepends':
-                        self.makedepends |= set(b.packages)
-            if self.build_depends:
-                return self._build(rebuild, iter + 1)
 
+        log.error('%s: Build failed', self.name)
         return set()
 
-    def build(self, rebuild=0):
+    def _build(self, rebuild=0, jobs=1):
+        """
+        Build a package and its dependencies. The dependency graph is resolved
+        up front so every package is built exactly once. Packages whose inputs
+        and dependencies are unchanged since they were last built are skipped.
+        Independent packages are built concurrently in chroot copies leased
+        from a ChrootPool and each package starts as soon as its dependencies
+        are built.
+
+        :param rebuild: Build packages even if they exist. \
+        `Builder.Rebuild.Package` will rebuild only the package, while \
+        `Builder.Rebuild.All` will rebuild the package and all dependencies
+        :param jobs: Maximum number of packages to build at once
+        :return: A set of paths to built runtime packages
+        """
+        if self.built:
+            return self.runtime_packages
+
+        plan = self.plan()
+        builders = {}
+        for node in plan:
+            if node.pkgbuild is self.pkgbuild:
+                builders[node] = self
+            else:
+                builders[node] = self._dependency(node)
+
+        jobs = max(1, min(jobs, len(plan)))
+        # This process builds at most jobs packages at once, but other
+        # pkgbuilder processes may lease copies from the same chroot
+        # directory. Copies are created only when leased, so allowing one per
+        # CPU lets concurrent processes build side by side instead of waiting
+        # for this process's copies.
+        pool = ChrootPool(self.chroot, max(jobs, os.cpu_count() or 1))
+
+        def build(node):
+            b = builders[node]
+            r = rebuild if b is self else rebuild > Builder.Rebuild.Package
+            depends = set()
+            makedepends = set()
+            for d in node.depends:
+                depends |= builders[d].runtime_packages
+            for d in node.makedepends:
+                makedepends |= builders[d].runtime_packages
+            return b._build_package(r, depends, makedepends, pool, node.key)
+
+        if not self.chroot.exists():
+            self.chroot.make()
+
+        pending = {n: set(n.dependencies) for n in plan}
+        running = {}
+        failed = False
+
+        with ThreadPoolExecutor(jobs) as executor:
+            while pending or running:
+                if not failed:
+                    for n in [n for n, deps in pending.items() if not deps]:
+                        del pending[n]
+                        running[executor.submit(build, n)] = n
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    n = running.pop(f)
+                    if not f.result():
+                        failed = True
+                        continue
+                    for deps in pending.values():
+                        deps.discard(n)
+
+        # Only builds download packages into the shared cache.
+        if any(b.attempted for b in builders.values()):
+            self.chroot.clean_cache()
+
+        if failed:
+            return set()
+        return self.runtime_packages
+
+    def build(self, rebuild=0, jobs=1):
         """
         Build the package.
 
         :param rebuild: Build packages even if they exist. \
         `Builder.Rebuild.Package` will rebuild only the package, while \
         `Builder.Rebuild.All` will rebuild the package and all dependencies
+        :param jobs: Maximum number of packages to build at once, defaults \
+        to 1
         :return: A list of paths to all built packages
         """
-        return list(self._build(rebuild))
+        return list(self._build(rebuild, jobs))
 
     def install(self, reinstall=False, sysroot=None, repo=None, confirm=False):
         """
@@ -0,0 +1,171 @@
+# This project is licensed under the MIT License.
+
+"""
+.. module:: cache
+   :synopsis: A persistent on-disk cache.
+
+.. moduleauthor:: James Reed <jcrd@tuta.io>
+"""
+
+from pathlib import Path
+from threading import Lock
+import logging
+import os
+import pickle
+import tempfile
+
+from .utils import Registry
+
+log = logging.getLogger('pkgbuilder.cache')
+
+
+class DiskCache:
+    """
+    A size-bounded on-disk cache mapping string keys to pickled values.
+    Least recently used entries are evicted when the cache grows beyond its
+    maximum size. Entries are written atomically so the cache can be shared
+    by multiple processes.
+
+    :param path: Path to cache directory
+    :param max_size: Maximum size of the cache in bytes, defaults to 64 MiB
+    """
+    registry = Registry()
+
+    @classmethod
+    def new(cls, path, max_size=64 * 1024 * 1024):
+        """
+        Get the DiskCache shared by this process for the given directory.
+
+        :param path: Path to cache directory
+        :param max_size: Maximum size of the cache in bytes
+        :return: A DiskCache
+        """
+        return cls.registry.get(str(path), lambda: cls(path, max_size))
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+        self._size = None
+        self._lock = Lock()
+
+    def _path(self, key):
+        return Path(self.path, key[:2], key)
+
+    def _entries(self):
+        """
+        Get the cache's entries.
+
+        :return: A list of os.DirEntry objects
+        """
+        entries = []
+        if not self.path.exists():
+            return entries
+        with os.scandir(self.path) as dirs:
+            for d in dirs:
+                if not d.is_dir():
+                    continue
+                with os.scandir(d.path) as files:
+                    entries += [f for f in files
+                                if f.is_file() and not f.name.startswith('.')]
+        return entries
+
+    @property
+    def size(self):
+        """
+        The size of the cache in bytes.
+        """
+        with self._lock:
+            if self._size is None:
+                self._size = sum(e.stat().st_size for e in self._entries())
+            return self._size
+
+    def get(self, key, default=None):
+        """
+        Get a cached value.
+
+        :param key: The key
+        :param default: Value returned when key is not cached
+        :return: The cached value or default
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            log.warning('Discarding unreadable cache entry %s: %s', path, e)
+            self.remove(key)
+            return default
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting least recently used entries if the cache is
+        full.
+
+        :param key: The key
+        :param value: A picklable value
+        """
+        path = self._path(key)
+        size = self.size
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            try:
+                size -= path.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        with self._lock:
+            self._size = size + path.stat().st_size
+        if self._size > self.max_size:
+            self.evict()
+
+    def remove(self, key):
+        """
+        Remove a cached value.
+
+        :param key: The key
+        """
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._size = None
+
+    def evict(self, size=None):
+        """
+        Remove least recently used entries.
+
+        :param size: Size in bytes to shrink the cache to, defaults to 90% \
+        of the maximum size
+        """
+        if size is None:
+            size = self.max_size * 9 // 10
+        with self._lock:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                       for e in self._entries()]
+            total = sum(e[1] for e in entries)
+            for _, s, p in sorted(entries):
+                if total <= size:
+                    break
+                try:
+                    os.unlink(p)
+                except FileNotFoundError:
+                    pass
+                total -= s
+            self._size = total
+
+    def clear(self):
+        """
+        Remove all cached values.
+        """
+        self.evict(0)
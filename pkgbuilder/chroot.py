@@ -7,22 +7,278 @@
 .. moduleauthor:: James Reed <jcrd@tuta.io>
 """
 
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
 from shutil import copy2, rmtree
+import fcntl
+import hashlib
+import json
 import logging
+import os
 import re
+import shutil
+import tarfile
+import tempfile
+import time
 
 from parse import compile
 
-from .utils import CmdLogger, cwd
+from .utils import CmdLogger
 
 log = logging.getLogger('pkgbuilder.chroot')
 cmdlog = CmdLogger(log)
 
 
+def filesystem(path):
+    """
+    Get the type of the filesystem containing a path.
+
+    :param path: The path, which need not exist yet
+    :return: The filesystem type, e.g. `btrfs` or `ext4`, or `None` if it is \
+    unknown
+    """
+    path = Path(os.path.realpath(path))
+    fstype = None
+    length = -1
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = re.sub(r'\\([0-7]{3})',
+                               lambda m: chr(int(m.group(1), 8)), fields[1])
+                parts = Path(mount).parts
+                if path.parts[:len(parts)] == parts and len(parts) >= length:
+                    fstype = fields[2]
+                    length = len(parts)
+    except FileNotFoundError:
+        pass
+    return fstype
+
+
+def file_hash(path):
+    """
+    Hash a file's contents.
+
+    :param path: Path to file
+    :return: A hexadecimal SHA-256 digest or `None` if the file is missing
+    """
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def syncdb_hashes(path):
+    """
+    Hash the pacman sync databases in a directory.
+
+    :param path: Path to sync database directory
+    :return: A dictionary mapping database file names to SHA-256 digests
+    """
+    return {db.name: file_hash(db) for db in sorted(Path(path).glob('*.db'))}
+
+
+class CopyBackend(ABC):
+    """
+    A method of creating working copies of a chroot's master root. Backends
+    reset a copy to the state of the master root before it is built in, so
+    makechrootpkg never needs to clean it.
+
+    :param chroot: The chroot
+    """
+    name = None
+
+    class CopyError(Exception):
+        """
+        An exception raised when a copy cannot be created or removed.
+        """
+        pass
+
+    def __init__(self, chroot):
+        self.chroot = chroot
+
+    @classmethod
+    def available(cls, path):
+        """
+        Check if the backend can create copies in a directory.
+
+        :param path: Path to the chroot directory
+        :return: `True` if available, `False` otherwise
+        """
+        return False
+
+    def _run(self, cmd, copy):
+        r, _, stderr = cmdlog.run(cmd)
+        if r != 0:
+            raise CopyBackend.CopyError({
+                'message': '{}: {} failed'.format(self.name, cmd[0]),
+                'copy': str(copy),
+                'stderr': stderr,
+                })
+
+    def exists(self, copy):
+        """
+        Check if a copy exists.
+
+        :param copy: The ChrootCopy
+        :return: `True` if exists, `False` otherwise
+        """
+        return copy.path.exists()
+
+    @abstractmethod
+    def reset(self, copy):
+        """
+        Make a copy identical to the master root.
+
+        :param copy: The ChrootCopy
+        :raises CopyError: Raised when the copy cannot be created
+        """
+
+    def release(self, copy):
+        """
+        Release a copy's resources after a build in it ended.
+
+        :param copy: The ChrootCopy
+        :raises CopyError: Raised when the copy cannot be released
+        """
+        pass
+
+    def remove(self, copy):
+        """
+        Remove a copy.
+
+        :param copy: The ChrootCopy
+        :raises CopyError: Raised when the copy cannot be removed
+        """
+        if copy.path.exists():
+            rmtree(copy.path)
+
+
+class RsyncBackend(CopyBackend):
+    """
+    Copy the master root with rsync, like makechrootpkg does on filesystems
+    other than btrfs. Resetting a copy transfers every file that changed
+    since it was last reset.
+    """
+    name = 'rsync'
+
+    @classmethod
+    def available(cls, path):
+        return shutil.which('rsync') is not None
+
+    def reset(self, copy):
+        copy.path.mkdir(parents=True, exist_ok=True)
+        self._run(['rsync', '-a', '--delete', '-q', '-W', '-x',
+                   str(self.chroot.root) + '/', str(copy.path)], copy)
+
+
+class BtrfsBackend(CopyBackend):
+    """
+    Create copies as btrfs snapshots of the master root subvolume.
+    """
+    name = 'btrfs'
+
+    @classmethod
+    def available(cls, path):
+        return filesystem(path) == 'btrfs' and \
+            shutil.which('btrfs') is not None
+
+    def reset(self, copy):
+        self.remove(copy)
+        self._run(['btrfs', 'subvolume', 'snapshot', str(self.chroot.root),
+                   str(copy.path)], copy)
+
+    def remove(self, copy):
+        if not copy.path.exists():
+            return
+        if copy.path.stat().st_ino == 256:
+            self._run(['btrfs', 'subvolume', 'delete', str(copy.path)], copy)
+        else:
+            rmtree(copy.path)
+
+
+class OverlayBackend(CopyBackend):
+    """
+    Create copies as overlayfs mounts whose lower directory is the master
+    root. A build only writes to the copy's upper directory, so resetting a
+    copy discards its upper directory instead of copying files. Overlayfs
+    does not support changing the master root while copies are mounted, so
+    copies are unmounted when their build ends and mounted again with an
+    empty upper directory before the next one.
+    """
+    name = 'overlay'
+
+    @classmethod
+    def available(cls, path):
+        if os.geteuid() != 0 or filesystem(path) == 'overlay':
+            return False
+        try:
+            with open('/proc/filesystems') as f:
+                return any(line.split()[-1] == 'overlay' for line in f
+                           if line.strip())
+        except FileNotFoundError:
+            return False
+
+    def _layers(self, copy):
+        d = Path(self.chroot.working_dir, 'overlay', copy.name)
+        return Path(d, 'upper'), Path(d, 'work')
+
+    def exists(self, copy):
+        return os.path.ismount(copy.path)
+
+    def reset(self, copy):
+        self.remove(copy)
+        upper, work = self._layers(copy)
+        for d in (upper, work, copy.path):
+            d.mkdir(parents=True)
+        opts = 'lowerdir={},upperdir={},workdir={}'.format(
+            self.chroot.root, upper, work)
+        self._run(['mount', '-t', 'overlay', 'overlay', '-o', opts,
+                   str(copy.path)], copy)
+
+    def release(self, copy):
+        if os.path.ismount(copy.path):
+            self._run(['umount', str(copy.path)], copy)
+
+    def remove(self, copy):
+        self.release(copy)
+        for d in self._layers(copy)[0].parent, copy.path:
+            if d.exists():
+                rmtree(d)
+
+
+def copy_backend(chroot):
+    """
+    Choose the backend for a chroot's copies based on the filesystem of its
+    directory: btrfs snapshots on btrfs, otherwise overlayfs mounts when
+    running as root, otherwise rsync.
+
+    :param chroot: The chroot
+    :raises CopyError: Raised when no backend is available
+    :return: A CopyBackend
+    """
+    for cls in (BtrfsBackend, OverlayBackend, RsyncBackend):
+        if cls.available(chroot.working_dir):
+            log.debug('Using %s chroot copies', cls.name)
+            return cls(chroot)
+    raise CopyBackend.CopyError({
+        'message': 'no copy backend available, install rsync',
+        'copy': str(chroot.working_dir),
+        'stderr': '',
+        })
+
+
 class Mirrorlist:
     """
-    A chroot's mirrorlist.
+    A chroot's mirrorlist. Changes made within a transaction refresh pacman
+    databases once, when the transaction ends.
 
     :param chroot: The chroot
     """
@@ -32,6 +288,35 @@ class Mirrorlist:
         self.chroot = chroot
         self.path = str(chroot.root) + '/etc/pacman.d/mirrorlist'
         self.mirrors = []
+        self._transactions = 0
+        self._changed = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group changes to the mirrorlist so pacman databases are refreshed at
+        most once, when the outermost transaction ends without an error.
+
+        :return: A context manager providing the Mirrorlist
+        """
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+        if self._transactions == 0 and self._changed:
+            self._changed = False
+            self.chroot.refresh()
+
+    def _refresh(self):
+        """
+        Refresh pacman databases after a change, or when the current
+        transaction ends.
+        """
+        if self._transactions:
+            self._changed = True
+        else:
+            self.chroot.refresh()
 
     def __str__(self):
         return '\n'.join(['Server = ' + m for m in self.mirrors])
@@ -58,7 +343,7 @@ class Mirrorlist:
         """
         with open(self.path, 'w') as f:
             f.write(str(self))
-        self.chroot.refresh()
+        self._refresh()
         return str(self)
 
     def copy(self, path='/etc/pacman.d/mirrorlist'):
@@ -69,7 +354,7 @@ class Mirrorlist:
         :param path: Path to the mirrorlist
         """
         copy2(path, self.path)
-        self.chroot.refresh()
+        self._refresh()
         self.read()
 
     def set(self, mirror, write=True):
@@ -113,16 +398,370 @@ class Mirrorlist:
         return mirror
 
 
+class BaseImage:
+    """
+    A cache of compressed images of freshly made master roots. Images are
+    versioned by a fingerprint of the installed package set and the host's
+    sync databases, which mkarchroot installs packages from, so a new root is
+    only made with mkarchroot when the sync databases changed since the last
+    image was created. On filesystems that support reflinks, the latest image
+    is also kept unpacked and copied with reflinks instead of being
+    extracted.
+
+    :param path: Path to image directory
+    :param packages: List of packages installed into roots, defaults to \
+    `base-devel` and `devtools`
+    :param keep: Number of image versions to keep, defaults to 2
+    """
+    packages = ['base-devel', 'devtools']
+    syncdir = '/var/lib/pacman/sync'
+
+    class ImageError(Exception):
+        """
+        An exception raised when an image cannot be created or restored.
+        """
+        pass
+
+    def __init__(self, path, packages=None, keep=2):
+        self.path = Path(path)
+        if packages:
+            self.packages = list(packages)
+        self.keep = keep
+        self._fingerprint = None
+
+    def _run(self, cmd):
+        r, _, stderr = cmdlog.run(cmd)
+        if r != 0:
+            raise BaseImage.ImageError({
+                'message': '{} failed'.format(cmd[0]),
+                'stderr': stderr,
+                })
+
+    def syncdbs(self):
+        """
+        Get hashes of the host's sync databases.
+
+        :return: A dictionary mapping database file names to SHA-256 digests
+        """
+        return syncdb_hashes(self.syncdir)
+
+    @property
+    def fingerprint(self):
+        """
+        The fingerprint of the package set and sync databases.
+
+        :return: A hexadecimal SHA-256 digest
+        """
+        if not self._fingerprint:
+            h = hashlib.sha256()
+            for p in sorted(self.packages):
+                h.update(p.encode() + b'\0')
+            for name, digest in self.syncdbs().items():
+                h.update('{}={}\0'.format(name, digest).encode())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def _paths(self, version):
+        name = 'base-' + version
+        return (Path(self.path, name + '.tar.zst'),
+                Path(self.path, name + '.json'), Path(self.path, name))
+
+    @property
+    def file(self):
+        """
+        Path to the compressed image of the current fingerprint.
+        """
+        return self._paths(self.fingerprint[:16])[0]
+
+    def exists(self):
+        """
+        Check if an image of the current fingerprint exists.
+
+        :return: `True` if exists, `False` otherwise
+        """
+        return self.file.exists()
+
+    def create(self, root):
+        """
+        Create an image of a freshly made root and remove old images.
+
+        :param root: Path to the root
+        :raises ImageError: Raised when creating the image fails
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        file, meta, tree = self._paths(self.fingerprint[:16])
+        tmp = Path(self.path, '.' + file.name)
+        try:
+            self._run(['tar', '--create', '--zstd', '--xattrs',
+                       '--xattrs-include=*', '--acls', '--numeric-owner',
+                       '-f', str(tmp), '-C', str(root), '.'])
+            os.replace(tmp, file)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        with open(meta, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint,
+                       'packages': sorted(self.packages),
+                       'syncdbs': self.syncdbs(),
+                       'created': time.time()}, f)
+        if filesystem(self.path) in ('btrfs', 'xfs'):
+            tmp = Path(self.path, '.' + tree.name)
+            r, _, _ = cmdlog.run(['cp', '-a', '--reflink=always', str(root),
+                                  str(tmp)])
+            if r == 0:
+                os.replace(tmp, tree)
+            elif tmp.exists():
+                rmtree(tmp)
+        log.info('Created base image %s', file)
+        self.prune()
+
+    def restore(self, root):
+        """
+        Create a root from the image of the current fingerprint.
+
+        :param root: Path to the root, which must not exist
+        :raises ImageError: Raised when restoring the image fails
+        """
+        file, _, tree = self._paths(self.fingerprint[:16])
+        if BtrfsBackend.available(root.parent):
+            self._run(['btrfs', 'subvolume', 'create', str(root)])
+        else:
+            root.mkdir()
+        if tree.exists():
+            r, _, _ = cmdlog.run(['cp', '-a', '--reflink=always',
+                                  str(tree) + '/.', str(root)])
+            if r == 0:
+                log.info('Copied base image %s', tree)
+                return
+        self._run(['tar', '--extract', '--zstd', '--xattrs',
+                   '--xattrs-include=*', '--acls', '--numeric-owner',
+                   '-f', str(file), '-C', str(root)])
+        log.info('Extracted base image %s', file)
+
+    def prune(self):
+        """
+        Remove all but the newest images.
+        """
+        metas = sorted(self.path.glob('base-*.json'),
+                       key=lambda p: p.stat().st_mtime, reverse=True)
+        for meta in metas[self.keep:]:
+            for p in self._paths(meta.stem[len('base-'):]):
+                if p.is_dir():
+                    rmtree(p)
+                elif p.exists():
+                    p.unlink()
+
+
+class PackageCache:
+    """
+    A host package cache shared by a chroot's root and all of its copies.
+    The cache is set as the CacheDir of the root's pacman.conf, which
+    arch-nspawn bind-mounts into the root and every copy made from it, so
+    each package is downloaded once. Builds hold a shared lock on the cache
+    and cleaning it requires an exclusive lock, so packages are never
+    removed while they may be installed.
+
+    :param path: Path to cache directory
+    :param max_size: Size in bytes the cache is cleaned down to, defaults \
+    to 4 GiB
+    """
+    def __init__(self, path, max_size=4 << 30):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    @contextmanager
+    def lock(self, shared=True, blocking=True):
+        """
+        Lock the cache.
+
+        :param shared: Whether to take a shared lock, defaults to `True`
+        :param blocking: Whether to wait for the lock, defaults to `True`
+        :return: A context manager providing `True` if the lock was taken, \
+        `False` otherwise
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        op = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            op |= fcntl.LOCK_NB
+        with open(Path(self.path, '.lock'), 'w') as f:
+            try:
+                fcntl.flock(f, op)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def configure(self, conf):
+        """
+        Set the cache as the only CacheDir of a pacman.conf.
+
+        :param conf: Path to pacman.conf
+        :return: `True` if the file was changed, `False` otherwise
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        try:
+            text = Path(conf).read_text()
+        except FileNotFoundError:
+            return False
+        entry = 'CacheDir = {}/\n'.format(self.path)
+        lines = []
+        options = False
+        done = False
+        for line in text.splitlines(keepends=True):
+            s = line.strip()
+            if s.startswith('['):
+                if options and not done:
+                    lines.append(entry)
+                    done = True
+                options = s == '[options]'
+            elif options and re.match(r'#?\s*CacheDir\s*=', s):
+                if not done:
+                    lines.append(entry)
+                    done = True
+                continue
+            lines.append(line)
+        if not done:
+            if options:
+                lines.append(entry)
+            else:
+                lines.insert(0, '[options]\n' + entry)
+        new = ''.join(lines)
+        if new == text:
+            return False
+        fd, tmp = tempfile.mkstemp(dir=Path(conf).parent, prefix='.pacman')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(new)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, conf)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        log.info('Set CacheDir of %s to %s', conf, self.path)
+        return True
+
+    @staticmethod
+    def referenced(syncdir):
+        """
+        Get the package file names referenced by sync databases.
+
+        :param syncdir: Path to sync database directory
+        :return: A set of file names
+        :raises ReadError: Raised when a database cannot be read
+        """
+        names = set()
+        for db in Path(syncdir).glob('*.db'):
+            with tarfile.open(db, 'r:*') as tar:
+                for member in tar:
+                    if not member.name.endswith('/desc'):
+                        continue
+                    lines = tar.extractfile(member).read().decode().split()
+                    if '%FILENAME%' in lines:
+                        names.add(lines[lines.index('%FILENAME%') + 1])
+        return names
+
+    def clean(self, syncdir):
+        """
+        Remove the least recently modified packages until the cache is no
+        larger than its maximum size. Packages referenced by the sync
+        databases are kept. Cleaning is skipped while the cache is in use.
+
+        :param syncdir: Path to sync database directory
+        :return: Number of bytes removed
+        """
+        with self.lock(shared=False, blocking=False) as locked:
+            if not locked:
+                log.debug('Package cache in use, skipping cleanup')
+                return 0
+            try:
+                keep = self.referenced(syncdir)
+            except (tarfile.TarError, OSError) as e:
+                log.warning('Failed to read sync databases: %s', e)
+                return 0
+            files = []
+            size = 0
+            for p in self.path.iterdir():
+                if not p.is_file() or p.name.startswith('.'):
+                    continue
+                st = p.stat()
+                size += st.st_size
+                name = p.name[:-len('.sig')] if p.name.endswith('.sig') \
+                    else p.name
+                if name not in keep:
+                    files.append((st.st_mtime, st.st_size, p))
+            freed = 0
+            for _, n, p in sorted(files):
+                if size - freed <= self.max_size:
+                    break
+                p.unlink()
+                freed += n
+            if freed:
+                log.info('Removed %d bytes from package cache %s', freed,
+                         self.path)
+            return freed
+
+
 class Chroot:
     """
     A mkarchroot-based chroot capable of building packages with makechrootpkg.
+    If `Chroot.imagedir` is set, master roots are restored from a BaseImage
+    in that directory when possible. If `Chroot.cachedir` is set, the root
+    and its copies share a PackageCache in that directory.
+
+    The time of the last database sync and the sync databases seen then are
+    recorded in `sync.json`, so refreshing and updating are skipped within a
+    TTL of the last sync, and upgrading is skipped when the databases did
+    not change since the last upgrade.
 
     :param working_dir: Path to chroot directory
+    :param backend: The CopyBackend class used to create copies leased from \
+    a ChrootPool, defaults to one chosen based on the filesystem
+    :param ttl: Seconds after a sync during which the databases are \
+    considered current, defaults to 3600
     """
-    def __init__(self, working_dir):
+    imagedir = None
+    cachedir = None
+
+    def __init__(self, working_dir, backend=None, ttl=3600):
         self.working_dir = Path(working_dir)
         self.root = Path(working_dir, 'root')
+        self.stamppath = Path(working_dir, 'root.stamp')
+        self.syncpath = Path(working_dir, 'sync.json')
+        self.ttl = ttl
+        self.cache = PackageCache(self.cachedir) if self.cachedir else None
         self.mirrorlist = Mirrorlist(self)
+        self._backend = backend(self) if backend else None
+
+    @property
+    def backend(self):
+        """
+        The CopyBackend used to create copies leased from a ChrootPool.
+
+        :raises CopyError: Raised when no backend is available
+        :return: A CopyBackend
+        """
+        if not self._backend:
+            self._backend = copy_backend(self)
+        return self._backend
+
+    @property
+    def stamp(self):
+        """
+        The stamp of the master root, which changes whenever the root is made
+        or modified with pacman.
+
+        :return: The stamp string or `None` if the root was never stamped
+        """
+        try:
+            return self.stamppath.read_text()
+        except FileNotFoundError:
+            return None
+
+    def _touch(self):
+        """
+        Change the stamp of the master root so working copies are refreshed.
+        """
+        self.stamppath.write_text(str(time.time_ns()))
 
     def exists(self):
         """
@@ -134,57 +773,358 @@ class Chroot:
 
     def make(self):
         """
-        Make the chroot using mkarchroot.
+        Make the chroot from the current base image, or using mkarchroot and
+        creating a base image if it is out of date.
         """
         if not self.working_dir.exists():
             self.working_dir.mkdir(parents=True)
-        cmd = ['mkarchroot', str(self.root), 'base-devel', 'devtools']
-        cmdlog.run(cmd)
+        image = BaseImage(self.imagedir) if self.imagedir else None
+        if image and image.exists():
+            try:
+                image.restore(self.root)
+                self._configure_cache()
+                self._touch()
+                return
+            except BaseImage.ImageError as e:
+                log.warning('Failed to restore base image: %s',
+                            e.args[0]['message'])
+                if self.root.exists():
+                    rmtree(self.root)
+        packages = image.packages if image else BaseImage.packages
+        cmd = ['mkarchroot']
+        if self.cache:
+            self.cache.path.mkdir(parents=True, exist_ok=True)
+            cmd += ['-c', str(self.cache.path)]
+        r, _, _ = cmdlog.run(cmd + [str(self.root)] + packages)
+        if r == 0:
+            dbs = self.syncdbs()
+            self._save_sync({'synced': time.time(), 'syncdbs': dbs,
+                             'upgraded': dbs,
+                             'mirrorlist': file_hash(self.mirrorlist.path)})
+            if image:
+                try:
+                    image.create(self.root)
+                except BaseImage.ImageError as e:
+                    log.warning('Failed to create base image: %s',
+                                e.args[0]['message'])
+            self._configure_cache()
+        self._touch()
+
+    def _configure_cache(self):
+        """
+        Set the shared package cache as the root's CacheDir.
+
+        :return: `True` if the root's pacman.conf was changed, `False` \
+        otherwise
+        """
+        if not self.cache:
+            return False
+        return self.cache.configure(Path(self.root, 'etc/pacman.conf'))
+
+    def clean_cache(self):
+        """
+        Clean the shared package cache, keeping packages referenced by the
+        root's sync databases.
+
+        :return: Number of bytes removed
+        """
+        if not self.cache:
+            return 0
+        return self.cache.clean(Path(self.root, 'var/lib/pacman/sync'))
 
     def pacman(self, flags):
         """
         Run pacman with the given flags in the chroot.
 
         :param flags: String containing flags for the pacman command
+        :return: pacman return code
+        """
+        r, _, _ = cmdlog.run(['arch-nspawn', str(self.root), 'pacman', flags])
+        self._touch()
+        if r != 0:
+            log.error('Chroot pacman %s failed with code %d', flags, r)
+        return r
+
+    def syncdbs(self):
+        """
+        Get hashes of the root's sync databases.
+
+        :return: A dictionary mapping database file names to SHA-256 digests
+        """
+        return syncdb_hashes(Path(self.root, 'var/lib/pacman/sync'))
+
+    def _load_sync(self):
+        try:
+            with open(self.syncpath) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_sync(self, state):
+        fd, tmp = tempfile.mkstemp(dir=self.working_dir, prefix='.sync')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.syncpath)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @contextmanager
+    def _sync_lock(self):
+        """
+        Lock the sync state so concurrent processes sync the root once.
+        """
+        self.working_dir.mkdir(parents=True, exist_ok=True)
+        with open(Path(self.working_dir, 'sync.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _current(self, state):
+        """
+        Check if the recorded sync is within the TTL and used the current
+        mirrorlist.
+
+        :param state: The recorded sync state
+        :return: `True` if current, `False` otherwise
+        """
+        return time.time() - state.get('synced', 0) < self.ttl and \
+            state.get('mirrorlist') == file_hash(self.mirrorlist.path)
+
+    def _sync(self, flags, state):
+        """
+        Sync databases with pacman and record the sync if it succeeds.
+
+        :param flags: String containing flags for the pacman command
+        :param state: The recorded sync state, which is updated
+        :return: Hashes of the synced databases or `None` if pacman failed
         """
-        cmdlog.run(['arch-nspawn', str(self.root), 'pacman', flags])
+        if self.pacman(flags) != 0:
+            return None
+        state['synced'] = time.time()
+        state['syncdbs'] = self.syncdbs()
+        state['mirrorlist'] = file_hash(self.mirrorlist.path)
+        self._save_sync(state)
+        return state['syncdbs']
 
-    def refresh(self):
+    def refresh(self, force=False):
         """
-        Refresh pacman databases.
+        Refresh pacman databases unless they were synced within the TTL with
+        the current mirrorlist.
+
+        :param force: Refresh even if the databases are current
+        :return: `True` if the databases were refreshed, `False` otherwise
         """
-        self.pacman('-Syy')
+        with self._sync_lock():
+            state = self._load_sync()
+            if not force and self._current(state):
+                log.info('Chroot databases are current, skipping refresh')
+                return False
+            return self._sync('-Syy', state) is not None
 
-    def update(self):
+    def update(self, force=False):
         """
-        Update the chroot with `pacman -Syu`.
+        Update the chroot with `pacman -Syu`. Databases are synced unless they
+        are current, and packages are upgraded only if the databases changed
+        since the last upgrade.
+
+        :param force: Sync and upgrade even if nothing changed
+        :return: `True` if the chroot was made or upgraded, `False` if it was \
+        current or pacman failed
         """
         if not self.exists():
             self.make()
-        else:
-            self.pacman('-Syuu')
+            return True
+        with self._sync_lock():
+            state = self._load_sync()
+            dbs = state.get('syncdbs')
+            if force or not self._current(state):
+                dbs = self._sync('-Sy', state)
+                if dbs is None:
+                    return False
+            if not force and dbs and dbs == state.get('upgraded'):
+                log.info('Chroot databases unchanged, skipping upgrade')
+                return False
+            if self.pacman('-Suu') != 0:
+                return False
+            state['upgraded'] = dbs
+            self._save_sync(state)
+        self.clean_cache()
+        return True
 
     def remove(self):
         """
         Remove the chroot.
         """
         if self.exists():
+            for p in self.working_dir.iterdir():
+                if os.path.ismount(p):
+                    cmdlog.run(['umount', str(p)])
             rmtree(self.working_dir)
 
-    def makepkg(self, pkgbuild, deps=[]):
+    def makepkg(self, pkgbuild, deps=[], copy=None):
         """
         Build a package in the chroot using makechrootpkg.
 
         :param pkgbuild: Pkgbuild to build
         :param deps: List of dependency package paths to install into chroot
+        :param copy: A ChrootCopy leased from a ChrootPool or the name of \
+        the chroot copy to build in, defaults to makechrootpkg's default copy
         :return: makechrootpkg return code, stdout, and stderr
         """
         if not self.exists():
             self.make()
+        elif self._configure_cache():
+            self._touch()
         pkgbuild.update()
-        cmd = ['makechrootpkg', '-cr', str(self.working_dir)]
+        cmd = ['makechrootpkg', '-r', str(self.working_dir)]
+        if not isinstance(copy, ChrootCopy):
+            cmd.append('-c')
+        else:
+            try:
+                if copy.stale():
+                    copy.reset()
+            except CopyBackend.CopyError as e:
+                log.error('%s: %s', e.args[0]['copy'], e.args[0]['message'])
+                return 1, '', e.args[0]['stderr']
+        if copy:
+            cmd += ['-l', str(copy)]
         for d in deps:
             cmd += ['-I', d]
         cmd += ['--', '-s']
-        with cwd(pkgbuild.builddir):
-            return cmdlog.run(cmd)
+        try:
+            if not self.cache:
+                return cmdlog.run(cmd, cwd=pkgbuild.builddir)
+            with self.cache.lock():
+                return cmdlog.run(cmd, cwd=pkgbuild.builddir)
+        finally:
+            if isinstance(copy, ChrootCopy):
+                types = ('depends', 'makedepends', 'checkdepends')
+                copy.save(dirty=bool(deps) or
+                          any(pkgbuild.srcinfo.get(t) for t in types))
+                try:
+                    self.backend.release(copy)
+                except CopyBackend.CopyError as e:
+                    log.warning('%s: %s', e.args[0]['copy'],
+                                e.args[0]['message'])
+
+
+class ChrootCopy:
+    """
+    A named working copy of a chroot's master root, leased from a ChrootPool.
+    The copy is reset with the chroot's CopyBackend before a build only if it
+    is missing, was changed by a build that installed dependencies or the
+    master root changed since.
+
+    :param chroot: The chroot
+    :param name: Name of the copy
+    """
+    def __init__(self, chroot, name):
+        self.chroot = chroot
+        self.name = name
+        self.path = Path(chroot.working_dir, name)
+        self.statepath = Path(chroot.working_dir, name + '.json')
+
+    def __str__(self):
+        return self.name
+
+    def _load(self):
+        try:
+            with open(self.statepath) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def stale(self):
+        """
+        Check if the copy must be synchronized with the master root.
+
+        :return: `True` if stale, `False` otherwise
+        """
+        state = self._load()
+        return not self.chroot.backend.exists(self) or \
+            state.get('dirty', True) or \
+            state.get('stamp') != self.chroot.stamp
+
+    def reset(self):
+        """
+        Make the copy identical to the master root.
+
+        :raises CopyError: Raised when the copy cannot be created
+        """
+        start = time.monotonic()
+        self.chroot.backend.reset(self)
+        log.info('Reset chroot copy %s with %s in %.2fs', self.name,
+                 self.chroot.backend.name, time.monotonic() - start)
+
+    def save(self, dirty=True):
+        """
+        Record the state of the copy after a build.
+
+        :param dirty: Whether the build changed the copy, defaults to `True`
+        """
+        with open(self.statepath, 'w') as f:
+            json.dump({'stamp': self.chroot.stamp, 'dirty': dirty}, f)
+
+
+class ChrootPool:
+    """
+    A pool of named working copies of a chroot. Copies are leased through
+    file locks, so concurrent builds in one or many processes never share a
+    copy. The lowest free copy is leased first, so copies are only created
+    when builds run concurrently.
+
+    :param chroot: The chroot
+    :param size: Maximum number of copies, defaults to the number of CPUs
+    :param interval: Seconds between attempts to lease a copy when every \
+    copy is leased, defaults to 1
+    """
+    def __init__(self, chroot, size=None, interval=1):
+        self.chroot = chroot
+        self.size = size or os.cpu_count() or 1
+        self.interval = interval
+
+    def copies(self):
+        """
+        Get the copies of the pool.
+
+        :return: A list of ChrootCopies
+        """
+        return [ChrootCopy(self.chroot, 'pkgbuilder-{}'.format(i + 1))
+                for i in range(self.size)]
+
+    def _try_lease(self, copy):
+        """
+        Try to lock a copy.
+
+        :param copy: The ChrootCopy
+        :return: The open lock file or `None` if the copy is leased
+        """
+        f = open(Path(self.chroot.working_dir, copy.name + '.lease'), 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    @contextmanager
+    def lease(self):
+        """
+        Lease a copy, waiting until one is free. The copy is returned to the
+        pool when the context exits.
+
+        :return: A context manager providing a ChrootCopy
+        """
+        self.chroot.working_dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            for copy in self.copies():
+                f = self._try_lease(copy)
+                if f:
+                    log.debug('Leased chroot copy %s', copy)
+                    try:
+                        yield copy
+                    finally:
+                        f.close()
+                    return
+            time.sleep(self.interval)
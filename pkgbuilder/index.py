@@ -0,0 +1,219 @@
+# This project is licensed under the MIT License.
+
+"""
+.. module:: index
+   :synopsis: An on-disk index of AUR package metadata.
+
+.. moduleauthor:: James Reed <jcrd@tuta.io>
+"""
+
+from pathlib import Path
+import gzip
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+log = logging.getLogger('pkgbuilder.index')
+
+
+class AurIndex:
+    """
+    A memory-mapped index of AUR package info built from a metadata dump,
+    e.g. https://aur.archlinux.org/packages-meta-ext-v1.json.gz. Packages
+    are looked up by name or by the names they provide with a binary search
+    of sorted key tables, so lookups need neither network access nor
+    loading the index into memory.
+
+    The index file consists of a header, a table of package names, a table
+    of provided names, the key strings and the package info records encoded
+    as JSON. Table entries hold the offset and length of a key and of a
+    record.
+
+    :param path: Path to index file
+    :raises InvalidIndexError: Raised when the file is not a valid index
+    """
+    magic = b'PKGBIDX1'
+    header = struct.Struct('<8sQQQQ')
+    entry = struct.Struct('<QIQI')
+
+    class InvalidIndexError(Exception):
+        """
+        An exception raised when an index file is invalid.
+        """
+        pass
+
+    @classmethod
+    def build(cls, dump, path):
+        """
+        Build an index from a metadata dump.
+
+        :param dump: Path to a gzip-compressed or plain JSON array of \
+        package infos
+        :param path: Path to the index file to write
+        :return: The number of indexed packages
+        """
+        opener = gzip.open if str(dump).endswith('.gz') else open
+        with opener(dump, 'rb') as f:
+            infos = json.load(f)
+
+        strings = bytearray()
+        records = bytearray()
+        keys = {}
+        names = []
+        provides = []
+
+        def key(s):
+            b = s.encode()
+            if b not in keys:
+                keys[b] = (len(strings), len(b))
+                strings.extend(b)
+            return b
+
+        for info in infos:
+            rec = json.dumps(info, separators=(',', ':')).encode()
+            r = (len(records), len(rec))
+            records.extend(rec)
+            names.append((key(info['Name']), r))
+            provided = {re.split('[<>=]', p, maxsplit=1)[0]
+                        for p in info.get('Provides') or []}
+            for p in provided:
+                provides.append((key(p), r))
+
+        names.sort()
+        provides.sort()
+        tables = bytearray()
+        for k, (off, size) in names + provides:
+            tables.extend(cls.entry.pack(*keys[k], off, size))
+
+        names_off = cls.header.size
+        strings_off = names_off + len(tables)
+        records_off = strings_off + len(strings)
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cls.header.pack(cls.magic, len(names), len(provides),
+                                        strings_off, records_off))
+                f.write(tables)
+                f.write(strings)
+                f.write(records)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        log.info('Indexed %d AUR packages in %s', len(names), path)
+        return len(names)
+
+    @classmethod
+    def load(cls, dump, path):
+        """
+        Open the index of a metadata dump, building it first if it does not
+        exist or is older than the dump.
+
+        :param dump: Path to the metadata dump
+        :param path: Path to the index file
+        :return: An AurIndex
+        """
+        try:
+            stale = os.stat(path).st_mtime < os.stat(dump).st_mtime
+        except FileNotFoundError:
+            stale = True
+        if stale:
+            cls.build(dump, path)
+        return cls(path)
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self._map = b''
+        err = {'message': 'Invalid AUR index', 'path': str(self.path)}
+        if len(self._map) < self.header.size:
+            raise AurIndex.InvalidIndexError(err)
+        magic, self._names, self._provides, self._strings, self._records = \
+            self.header.unpack_from(self._map)
+        if magic != self.magic:
+            raise AurIndex.InvalidIndexError(err)
+
+    def __len__(self):
+        return self._names
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def close(self):
+        """
+        Unmap the index file.
+        """
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def _entry(self, i):
+        off = self.header.size + i * self.entry.size
+        return self.entry.unpack_from(self._map, off)
+
+    def _key(self, i):
+        off, size, _, _ = self._entry(i)
+        off += self._strings
+        return self._map[off:off + size]
+
+    def _record(self, i):
+        _, _, off, size = self._entry(i)
+        off += self._records
+        return json.loads(self._map[off:off + size])
+
+    def _search(self, start, count, key):
+        """
+        Find the first entry of a table with the given key.
+
+        :param start: Index of the table's first entry
+        :param count: Number of entries in the table
+        :param key: The key as bytes
+        :return: The index of the first entry whose key is not less than key
+        """
+        lo = start
+        hi = start + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, name):
+        """
+        Get info about a package.
+
+        :param name: Package name
+        :return: Package info or `None` if name is not found
+        """
+        key = name.encode()
+        i = self._search(0, self._names, key)
+        if i < self._names and self._key(i) == key:
+            return self._record(i)
+        return None
+
+    def providers(self, name):
+        """
+        Get info about the packages that provide a name.
+
+        :param name: Provided name
+        :return: A list of package infos in the order of the dump
+        """
+        key = name.encode()
+        end = self._names + self._provides
+        i = self._search(self._names, self._provides, key)
+        infos = []
+        while i < end and self._key(i) == key:
+            infos.append(self._record(i))
+            i += 1
+        return infos
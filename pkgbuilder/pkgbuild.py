@@ -7,19 +7,28 @@
 .. moduleauthor:: James Reed <jcrd@tuta.io>
 """
 
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum, auto
 from pathlib import Path
 from shutil import rmtree
 from subprocess import run
+import hashlib
+import json
 import logging
 import os
+import pickle
+import tempfile
 
 from srcinfo.parse import parse_srcinfo
 from parse import parse
 
-from .aur import Aur, GitRepo
-from .utils import synctree
+from .aur import Aur, GitPool, GitRepo, MirrorStore
+from .cache import DiskCache
+from .utils import Registry, hash_files, read_makepkg_conf, synctree
+from .vercmp import base_version, satisfies, total_version_key, \
+    version_key
 
 log = logging.getLogger('pkgbuilder.pkgbuild')
 
@@ -40,6 +49,40 @@ def parse_restriction(pkg):
     return (pkg, None)
 
 
+def full_version(srcinfo):
+    """
+    Get the full version of a PKGBUILD.
+
+    :param srcinfo: The srcinfo dictionary
+    :return: The version string in the form `[epoch:]pkgver-pkgrel`
+    """
+    v = '{}-{}'.format(srcinfo['pkgver'], srcinfo.get('pkgrel', '1'))
+    if srcinfo.get('epoch', '0') != '0':
+        v = '{}:{}'.format(srcinfo['epoch'], v)
+    return v
+
+
+def _load_srcinfo(args):
+    """
+    Generate and parse the srcinfo of a local PKGBUILD. This function is run
+    by LocalDir's worker processes.
+
+    :param args: A tuple of the package name, package build directory, local \
+    PKGBUILDs directory and makepkg configuration file
+    :return: A tuple of the package name, the srcinfo dictionary or `None` \
+    if the directory has no PKGBUILD, and an error message or `None`
+    """
+    name, builddir, path, makepkg_conf = args
+    try:
+        pkgbuild = Pkgbuild.new(name, builddir, path, Pkgbuild.Source.Local,
+                                makepkg_conf)
+        return (name, pkgbuild.srcinfo, None)
+    except Pkgbuild.NoPkgbuildError:
+        return (name, None, None)
+    except Exception as e:
+        return (name, None, str(e))
+
+
 class LocalDir:
     """
     A directory containing local PKGBUILDs.
@@ -47,6 +90,12 @@ class LocalDir:
     :param path: Path to directory
     :param builddir: Path to package build directory
     :param makepkg_conf: Path to makepkg configuration file
+    :param jobs: Number of worker processes used to generate srcinfo, \
+    defaults to the number of CPUs
+
+    The state of each directory and its parsed srcinfo are saved in a
+    snapshot in the package build directory, so rescans only parse
+    directories that were added or changed, even across runs.
     """
     class ProviderNotFoundError(Exception):
         """
@@ -56,16 +105,194 @@ class LocalDir:
 
     Package = namedtuple('Package', ['name', 'version'])
 
-    def __init__(self, path, builddir, makepkg_conf=None):
+    class Providers:
+        """
+        The versions of a package name provided by local PKGBUILDs, kept
+        sorted so version Restrictions are resolved by binary search. vercmp
+        treats a version without a pkgrel as equal to the same version with
+        any pkgrel, so it is not a total order; versions are instead sorted
+        by `total_vercmp`, and Restrictions are bisected on versions without
+        their pkgrel and then checked with vercmp.
+        """
+        def __init__(self):
+            self.keys = []
+            self.bases = []
+            self.versions = []
+            self.pkgbuilds = []
+
+        def __len__(self):
+            return len(self.keys)
+
+        def add(self, version, pkgbuild):
+            """
+            Add a provider.
+
+            :param version: The provided version
+            :param pkgbuild: The Pkgbuild providing the version
+            """
+            k = total_version_key(version)
+            i = bisect_left(self.keys, k)
+            if i < len(self.keys) and self.keys[i] == k:
+                if pkgbuild not in self.pkgbuilds[i]:
+                    self.pkgbuilds[i].append(pkgbuild)
+                return
+            self.keys.insert(i, k)
+            self.bases.insert(i, version_key(base_version(version)))
+            self.versions.insert(i, version)
+            self.pkgbuilds.insert(i, [pkgbuild])
+
+        def remove(self, pkgbuild):
+            """
+            Remove all versions provided by a Pkgbuild.
+
+            :param pkgbuild: The Pkgbuild
+            """
+            for i in reversed(range(len(self.keys))):
+                if pkgbuild in self.pkgbuilds[i]:
+                    self.pkgbuilds[i].remove(pkgbuild)
+                    if not self.pkgbuilds[i]:
+                        del self.keys[i]
+                        del self.bases[i]
+                        del self.versions[i]
+                        del self.pkgbuilds[i]
+
+        def select(self, restrictions=[]):
+            """
+            Get providers that satisfy version Restrictions.
+
+            :param restrictions: A list of version Restrictions
+            :return: A list of Pkgbuild objects, highest version first
+            """
+            lo = 0
+            hi = len(self.keys)
+            for r in restrictions:
+                k = version_key(base_version(r.version))
+                if r.compare in ['>', '>=', '=']:
+                    lo = max(lo, bisect_left(self.bases, k))
+                if r.compare in ['<', '<=', '=']:
+                    hi = min(hi, bisect_right(self.bases, k))
+            return [p for i in reversed(range(lo, hi))
+                    if all(satisfies(self.versions[i], r)
+                           for r in restrictions)
+                    for p in self.pkgbuilds[i]]
+
+    registry = Registry()
+
+    @classmethod
+    def new(cls, path, builddir, makepkg_conf=None, jobs=None):
+        """
+        Get the LocalDir shared by this process for the given directory,
+        parsing its PKGBUILDs the first time it is requested.
+
+        :param path: Path to directory
+        :param builddir: Path to package build directory
+        :param makepkg_conf: Path to makepkg configuration file
+        :param jobs: Number of worker processes used to generate srcinfo
+        :return: An updated LocalDir
+        """
+        def localdir():
+            d = cls(path, builddir, makepkg_conf, jobs)
+            d.update()
+            return d
+
+        key = (path and str(path), str(builddir), makepkg_conf)
+        return cls.registry.get(key, localdir)
+
+    def __init__(self, path, builddir, makepkg_conf=None, jobs=None):
         self.path = path
         self.builddir = builddir
         self.makepkg_conf = makepkg_conf
+        self.jobs = jobs or os.cpu_count() or 1
         self.check_update = True
         self.packages = {}
+        self.index = {}
+        self.errors = {}
+        self._entries = {}
+        self._snapshot = None
+
+    def _scan(self, names):
+        """
+        Generate and parse the srcinfo of PKGBUILDs concurrently.
+
+        :param names: Names of directories to scan
+        :return: An iterator of tuples of the package name, srcinfo \
+        dictionary and error message
+        """
+        args = [(n, self.builddir, self.path, self.makepkg_conf)
+                for n in names]
+        jobs = min(self.jobs, len(args))
+        if jobs < 2:
+            yield from map(_load_srcinfo, args)
+            return
+        with ProcessPoolExecutor(jobs) as executor:
+            yield from executor.map(_load_srcinfo, args,
+                                    chunksize=max(1, len(args) // jobs // 4))
+
+    @property
+    def snapshot_path(self):
+        """
+        Path to the file storing the directory's snapshot.
+        """
+        h = hashlib.sha256(str(Path(self.path).resolve()).encode())
+        return Path(self.builddir, 'snapshots', h.hexdigest()[:16])
+
+    def _conf_digest(self):
+        try:
+            conf = Path(self.makepkg_conf or '/etc/makepkg.conf').read_bytes()
+        except FileNotFoundError:
+            conf = b''
+        return hashlib.sha256(conf).hexdigest()
+
+    def _load_snapshot(self):
+        """
+        Load the snapshot saved by a previous run.
+
+        :return: A dictionary mapping directory names to tuples of the \
+        directory's stat, the PKGBUILD's hash and its srcinfo dictionary
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot['conf'] == self._conf_digest():
+                return snapshot['entries']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning('Discarding unreadable snapshot %s: %s',
+                        self.snapshot_path, e)
+        return {}
+
+    def _save_snapshot(self):
+        path = self.snapshot_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'conf': self._conf_digest(),
+                         'entries': self._snapshot}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def _stat(self, name):
+        """
+        Get the state of a directory and its PKGBUILD.
+
+        :param name: Name of the directory
+        :return: A tuple of inodes, modification times and the PKGBUILD's \
+        size or `None` if the directory does not contain a PKGBUILD
+        """
+        try:
+            d = os.stat(Path(self.path, name))
+            p = os.stat(Path(self.path, name, 'PKGBUILD'))
+        except FileNotFoundError:
+            return None
+        return (d.st_ino, d.st_mtime_ns, p.st_ino, p.st_mtime_ns, p.st_size)
 
     def update(self, force=False):
         """
-        Parse PKGBUILDs in the directory.
+        Parse PKGBUILDs in the directory. Only directories that were added or
+        whose PKGBUILD changed since the last scan are parsed, with srcinfo
+        generated by a pool of worker processes. Directories that fail to
+        parse are skipped and their errors are recorded in `errors`.
 
         :param force: Force checking for updates
         :return: A dictionary mapping Package tuples to lists of Pkgbuild \
@@ -75,38 +302,136 @@ class LocalDir:
             return {}
         if not (self.check_update or force):
             return self.packages
-
-        def add_package(pkg, pkgbuild):
-            if pkg in self.packages:
-                self.packages[pkg].append(pkgbuild)
-            else:
-                self.packages[pkg] = [pkgbuild]
+        if self._snapshot is None:
+            self._snapshot = self._load_snapshot()
 
         with os.scandir(self.path) as dir:
-            for entry in dir:
-                if not entry.is_dir():
-                    continue
-                try:
-                    pkgbuild = Pkgbuild.new(entry.name, self.builddir,
-                                            self.path, Pkgbuild.Source.Local,
-                                            self.makepkg_conf)
-                except Pkgbuild.NoPkgbuildError:
-                    continue
-                srcinfo = pkgbuild.srcinfo
-                if 'provides' in srcinfo:
-                    for p in srcinfo['provides']:
-                        s = p.split('=')
-                        if len(s) < 2:
-                            s.append(srcinfo['pkgver'])
-                        add_package(LocalDir.Package(*s), pkgbuild)
-                else:
-                    add_package(LocalDir.Package(srcinfo['pkgbase'],
-                                                 srcinfo['pkgver']),
-                                pkgbuild)
+            names = sorted(e.name for e in dir if e.is_dir())
+
+        snapshot = {}
+        changed = []
+        for name in names:
+            stat = self._stat(name)
+            if not stat:
+                continue
+            old = self._snapshot.get(name)
+            if old and old[0] == stat:
+                snapshot[name] = old
+                continue
+            path = Path(self.path, name, 'PKGBUILD')
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+            if old and old[1] == digest:
+                snapshot[name] = (stat,) + old[1:]
+                continue
+            changed.append(name)
+            snapshot[name] = (stat, digest, None)
+
+        for name in changed:
+            dir = str(Path(self.path, name).resolve())
+            Pkgbuild.registry.invalidate(
+                lambda k: k[1] == Pkgbuild.Source.Local and k[2] == dir)
+
+        self.errors = {}
+        for name, srcinfo, error in self._scan(changed):
+            if error:
+                log.warning('%s: Failed to parse PKGBUILD: %s', name, error)
+                self.errors[name] = error
+            if not srcinfo:
+                del snapshot[name]
+                continue
+            snapshot[name] = snapshot[name][:2] + (srcinfo,)
+            pkgbuild = Pkgbuild.new(name, self.builddir, self.path,
+                                    Pkgbuild.Source.Local, self.makepkg_conf)
+            # The worker process already synchronized the build directory.
+            pkgbuild._srcinfo = srcinfo
+            pkgbuild.check_update = False
+
+        for name in set(self._entries) - set(snapshot):
+            self._remove(name)
+        for name, (_, _, srcinfo) in snapshot.items():
+            pkgbuild = Pkgbuild.new(name, self.builddir, self.path,
+                                    Pkgbuild.Source.Local, self.makepkg_conf)
+            if not pkgbuild._srcinfo:
+                pkgbuild._srcinfo = srcinfo
+            self._add(name, pkgbuild, pkgbuild._srcinfo)
+
+        dirty = snapshot.keys() != self._snapshot.keys() or \
+            any(snapshot[n] is not self._snapshot[n] for n in snapshot)
+        self._snapshot = snapshot
+        if dirty:
+            self._save_snapshot()
 
         self.check_update = False
         return self.packages
 
+    def _add(self, name, pkgbuild, srcinfo):
+        """
+        Add a PKGBUILD to the packages mapping and the provider index,
+        replacing the PKGBUILD previously found in the same directory.
+
+        :param name: Name of the directory containing the PKGBUILD
+        :param pkgbuild: The Pkgbuild
+        :param srcinfo: The Pkgbuild's srcinfo dictionary
+        """
+        if name in self._entries:
+            if self._entries[name][:2] == (pkgbuild, srcinfo):
+                return
+            self._remove(name)
+
+        packages = []
+        if 'provides' in srcinfo:
+            for p in srcinfo['provides']:
+                s = p.split('=')
+                if len(s) < 2:
+                    s.append(srcinfo['pkgver'])
+                packages.append(LocalDir.Package(*s))
+        else:
+            packages.append(LocalDir.Package(srcinfo['pkgbase'],
+                                             srcinfo['pkgver']))
+
+        version = full_version(srcinfo)
+        provided = set(packages)
+        provided.add(LocalDir.Package(srcinfo['pkgbase'], version))
+        for n in srcinfo.get('packages', {}):
+            provided.add(LocalDir.Package(n, version))
+
+        for pkg in packages:
+            self.packages.setdefault(pkg, []).append(pkgbuild)
+        for pkg in provided:
+            if pkg.name not in self.index:
+                self.index[pkg.name] = LocalDir.Providers()
+            self.index[pkg.name].add(pkg.version, pkgbuild)
+
+        self._entries[name] = (pkgbuild, srcinfo, packages, provided)
+
+    def _remove(self, name):
+        """
+        Remove the PKGBUILD found in a directory from the packages mapping and
+        the provider index.
+
+        :param name: Name of the directory containing the PKGBUILD
+        """
+        pkgbuild, _, packages, provided = self._entries.pop(name)
+        for pkg in packages:
+            self.packages[pkg].remove(pkgbuild)
+            if not self.packages[pkg]:
+                del self.packages[pkg]
+        for pkg in provided:
+            providers = self.index.get(pkg.name)
+            if providers is None:
+                continue
+            providers.remove(pkgbuild)
+            if not providers:
+                del self.index[pkg.name]
+
+    @property
+    def names(self):
+        """
+        A sorted list of the names of directories containing parsed
+        PKGBUILDs.
+        """
+        return sorted(self._entries)
+
     def providers(self, name, restrictions=[]):
         """
         Get providers for a package with version Restrictions.
@@ -115,30 +440,19 @@ class LocalDir:
         :param restrictions: A list of version Restrictions
         :raises ProviderNotFoundError: Raised when no provider can be found \
         for name
-        :return: A list of Pkgbuild objects providing the package
+        :return: A list of Pkgbuild objects providing the package, highest \
+        version first
         """
-        def restrict_version(v, restrictions):
-            for r in restrictions:
-                if (r.compare == '>' and not v > r.version) \
-                or (r.compare == '<' and not v < r.version) \
-                or (r.compare == '=' and not v == r.version) \
-                or (r.compare == '>=' and not v >= r.version) \
-                or (r.compare == '<=' and not v <= r.version):
-                    return False
-
-            return True
-
         err = {'message': 'Provider for {} not found'.format(name),
                'source': Pkgbuild.Source.Local,
                'version_restrictions': restrictions}
 
-        if not self.packages or not self.path:
+        if not self.path or name not in self.index:
+            raise LocalDir.ProviderNotFoundError(err)
+        pkgbuilds = self.index[name].select(restrictions)
+        if not pkgbuilds:
             raise LocalDir.ProviderNotFoundError(err)
-        for pkg, pkgbuilds in self.packages.items():
-            if pkg.name == name \
-                    and restrict_version(pkg.version, restrictions):
-                return pkgbuilds
-        raise LocalDir.ProviderNotFoundError(err)
+        return pkgbuilds
 
 
 class Pkgbuild:
@@ -147,6 +461,8 @@ class Pkgbuild:
     directory needed to build the package.
     """
     aur = Aur()
+    registry = Registry()
+    snapshots = False
 
     class NoPkgbuildError(Exception):
         """
@@ -155,6 +471,13 @@ class Pkgbuild:
         """
         pass
 
+    class UpdateError(Exception):
+        """
+        An exception raised when the build directories of one or more
+        PKGBUILDs cannot be updated.
+        """
+        pass
+
     class SourceNotFoundError(Exception):
         """
         An exception raised when no source is found for the package name.
@@ -175,7 +498,8 @@ class Pkgbuild:
         Aur = auto()
 
     @classmethod
-    def new(cls, name, builddir, localdir=None, source=None, makepkg_conf=None):
+    def new(cls, name, builddir, localdir=None, source=None,
+            makepkg_conf=None):
         """
         Create a new LocalPkgbuild or AurPkgbuild.
 
@@ -189,32 +513,52 @@ class Pkgbuild:
         name
         :raises NoPkgbuildError: Raised when a local directory exists but \
         does not contain a PKGBUILD file
-        :return: LocalPkgbuild or AurPkgbuild
+        :return: LocalPkgbuild or AurPkgbuild, shared by all callers \
+        requesting the same PKGBUILD until invalidated
         """
         err = {'message': 'Directory does not contain a PKGBUILD file'}
         dir = None
         try:
-            dir = Path(localdir, name).resolve(True)
-            if not Path(dir, 'PKGBUILD').exists():
-                err['directory'] = str(dir)
-                raise cls.NoPkgbuildError(err)
+            if localdir:
+                dir = Path(localdir, name).resolve(True)
+                if not Path(dir, 'PKGBUILD').exists():
+                    err['directory'] = str(dir)
+                    raise cls.NoPkgbuildError(err)
         except FileNotFoundError:
             pass
 
         err = {'message': 'Source for {} not found'.format(name)}
 
         if dir and source != cls.Source.Aur:
-            return LocalPkgbuild(name, builddir, dir, makepkg_conf)
+            key = (name, cls.Source.Local, str(dir), str(builddir),
+                   makepkg_conf)
+            return cls.registry.get(
+                key, lambda: LocalPkgbuild(name, builddir, dir, makepkg_conf))
         elif source == cls.Source.Local:
             err['source'] = cls.Source.Local
             raise cls.SourceNotFoundError(err)
         else:
-            aurpkg = Pkgbuild.aur.get_package(name)
-            if aurpkg:
-                return AurPkgbuild(name, builddir, aurpkg, makepkg_conf)
-            else:
-                err['source'] = cls.Source.Aur
-                raise cls.SourceNotFoundError(err)
+            def aurpkgbuild():
+                aurpkg = Pkgbuild.aur.get_package(name)
+                if aurpkg:
+                    kind = SnapshotPkgbuild if cls.snapshots else AurPkgbuild
+                    return kind(name, builddir, aurpkg, makepkg_conf)
+                else:
+                    err['source'] = cls.Source.Aur
+                    raise cls.SourceNotFoundError(err)
+
+            key = (name, cls.Source.Aur, None, str(builddir), makepkg_conf)
+            return cls.registry.get(key, aurpkgbuild)
+
+    @classmethod
+    def invalidate(cls, name=None):
+        """
+        Forget shared PKGBUILDs so they are recreated by `Pkgbuild.new`.
+
+        :param name: Package name, defaults to all packages
+        :return: The number of forgotten PKGBUILDs
+        """
+        return cls.registry.invalidate(lambda k: name is None or k[0] == name)
 
     def __init__(self, name, buildpath, sourcedir, makepkg_conf=None):
         self.name = name
@@ -222,6 +566,7 @@ class Pkgbuild:
         self.makepkg_conf = makepkg_conf
         self.builddir = Path(self.buildpath, self.name)
         self.pkgbuildpath = Path(self.builddir, 'PKGBUILD')
+        self.srcinfo_cache = DiskCache.new(Path(buildpath, 'srcinfo'))
         self.check_update = True
         self._packagelist = []
         self._srcinfo = {}
@@ -230,8 +575,12 @@ class Pkgbuild:
 
     def remove(self):
         """
-        Remove build directory.
+        Remove build directory and forget information derived from it.
         """
+        self._packagelist = []
+        self._srcinfo = {}
+        self._depends = {}
+        self._makedepends = {}
         if not self.builddir.exists():
             return
         log.info('%s: Removing build dir... [%s]', self.name, self.builddir)
@@ -254,10 +603,69 @@ class Pkgbuild:
                      self.builddir)
         self.check_update = False
 
+    @classmethod
+    def update_all(cls, pkgbuilds, jobs=8):
+        """
+        Update the build directories of many PKGBUILDs, cloning or pulling
+        the git repositories or downloading the snapshots of AUR packages
+        concurrently.
+
+        :param pkgbuilds: An iterable of Pkgbuilds
+        :param jobs: Maximum number of git commands or downloads to run at \
+        once
+        :raises UpdateError: Raised when any package cannot be updated, \
+        after the other packages are updated
+        """
+        tasks = {}
+        snapshots = []
+        for pkgbuild in pkgbuilds:
+            if not pkgbuild.check_update:
+                continue
+            if not isinstance(pkgbuild, AurPkgbuild):
+                pkgbuild.update()
+                continue
+            pkgbuild.buildpath.mkdir(parents=True, exist_ok=True)
+            if isinstance(pkgbuild, SnapshotPkgbuild):
+                snapshots.append(pkgbuild)
+                continue
+            cmds = pkgbuild._git_cmds()
+            if cmds:
+                tasks[pkgbuild] = cmds
+            else:
+                pkgbuild.check_update = False
+
+        errors = {}
+        if snapshots:
+            with ThreadPoolExecutor(jobs) as executor:
+                futures = {p: executor.submit(p.update) for p in snapshots}
+            errors.update({p: f.exception() for p, f in futures.items()
+                           if f.exception()})
+
+        if tasks:
+            log.info('Updating %d AUR packages...', len(tasks))
+            git_errors = GitPool(jobs).run(tasks)
+            for pkgbuild in tasks:
+                if pkgbuild in git_errors:
+                    continue
+                pkgbuild._save_state()
+                pkgbuild.check_update = False
+                log.info('%s: PKGBUILD [%s -> %s]', pkgbuild.name,
+                         pkgbuild.uri, pkgbuild.builddir)
+            errors.update(git_errors)
+
+        if errors:
+            err = GitPool.error({p.name: e for p, e in errors.items()})
+            raise Pkgbuild.UpdateError(
+                {'message': 'Failed to update {} packages'.format(len(errors)),
+                 'errors': err.args[0]['errors']})
+
     @property
     def packagelist(self):
         """
         Get a list of paths to packages this PKGBUILD will produce when built.
+        The list is derived from the srcinfo and makepkg configuration,
+        falling back to makepkg --packagelist if the configuration cannot be
+        evaluated without makepkg.
 
         :return: A list of paths to packages
         :raises CalledProcessError: Raised if the makepkg command fails
@@ -265,18 +673,76 @@ class Pkgbuild:
         if self._packagelist:
             return self._packagelist
         self.update()
+        self._packagelist = self._srcinfo_packagelist() or \
+            self._makepkg_packagelist()
+        return self._packagelist
+
+    def _srcinfo_packagelist(self):
+        """
+        Get a list of paths to packages this PKGBUILD will produce when built
+        from its srcinfo and the makepkg configuration.
+
+        :return: A list of paths to packages or `None` if the list cannot be \
+        determined without makepkg
+        """
+        conf = read_makepkg_conf(self.makepkg_conf)
+        if not conf:
+            return None
+        conf = dict(conf)
+        for name in ['PKGDEST', 'PKGEXT']:
+            if os.environ.get(name):
+                conf[name] = os.environ[name]
+        if 'CARCH' not in conf or 'PKGEXT' not in conf or \
+                None in [conf['CARCH'], conf['PKGEXT'],
+                         conf.get('PKGDEST', ''), conf.get('OPTIONS', [])]:
+            return None
+
+        srcinfo = self.srcinfo
+
+        def option(name):
+            enabled = None
+            for o in conf.get('OPTIONS', []) + srcinfo.get('options', []):
+                if o.lstrip('!') == name:
+                    enabled = not o.startswith('!')
+            return enabled
+
+        if option('debug') and option('strip'):
+            return None
+
+        def arch(info):
+            a = info.get('arch', srcinfo.get('arch', []))
+            return 'any' if a and a[0] == 'any' else conf['CARCH']
+
+        dest = Path(conf.get('PKGDEST') or self.builddir).resolve()
+        version = full_version(srcinfo)
+        names = srcinfo.get('packages') or {srcinfo['pkgbase']: {}}
+
+        return ['{}/{}-{}-{}{}'.format(dest, name, version, arch(info),
+                                       conf['PKGEXT'])
+                for name, info in names.items()]
+
+    def _makepkg_packagelist(self):
+        """
+        Get a list of paths to packages this PKGBUILD will produce when built
+        using makepkg --packagelist.
+
+        :return: A list of paths to packages
+        :raises CalledProcessError: Raised if the makepkg command fails
+        """
         cmd = ['makepkg', '--packagelist']
         if self.makepkg_conf:
             cmd += ['--config', self.makepkg_conf]
         r = run(cmd, cwd=self.builddir, capture_output=True, text=True,
                 check=True)
-        self._packagelist = r.stdout.splitlines()
-        return self._packagelist
+        return r.stdout.splitlines()
 
     @property
     def srcinfo(self):
         """
-        Get a srcinfo dictionary corresponding to makepkg --printsrcinfo output.
+        Get a srcinfo dictionary corresponding to makepkg --printsrcinfo
+        output. Parsed srcinfo is cached in the package build directory, keyed
+        by the contents of the PKGBUILD and makepkg configuration file, so
+        makepkg only runs when either changes.
 
         :return: The srcinfo dictionary
         :raises CalledProcessError: Raised if the makepkg command fails
@@ -288,6 +754,28 @@ class Pkgbuild:
         self.update()
         file = Path(self.builddir, '.SRCINFO')
 
+        h = hashlib.sha256()
+        for path in [self.pkgbuildpath,
+                     self.makepkg_conf or '/etc/makepkg.conf']:
+            try:
+                h.update(Path(path).read_bytes())
+            except FileNotFoundError:
+                pass
+            h.update(b'\0')
+        key = h.hexdigest()
+
+        cached = self.srcinfo_cache.get(key)
+        if cached:
+            info, self._srcinfo = cached
+            try:
+                current = file.read_text()
+            except FileNotFoundError:
+                current = None
+            if current != info:
+                with open(file, 'w') as f:
+                    f.write(info)
+            return self._srcinfo
+
         mtime = os.path.getmtime
         if file.exists() and not mtime(self.pkgbuildpath) > mtime(file):
             with open(file) as f:
@@ -309,11 +797,48 @@ class Pkgbuild:
         if errors:
             err = {'message': 'Failed to parse PKGBUILD srcinfo',
                    'errors': errors}
-            raise ParseSrcinfoError(err)
+            raise Pkgbuild.ParseSrcinfoError(err)
 
+        self.srcinfo_cache.put(key, (info, srcinfo))
         self._srcinfo = srcinfo
         return self._srcinfo
 
+    @property
+    def inputs(self):
+        """
+        Get the files in the build directory that determine the built
+        packages: the PKGBUILD and the local sources, install and changelog
+        files listed in its srcinfo. Remote sources are pinned by the PKGBUILD
+        itself.
+
+        :return: A sorted list of paths
+        """
+        self.update()
+        srcinfo = self.srcinfo
+        infos = [srcinfo] + list(srcinfo.get('packages', {}).values())
+        names = {'PKGBUILD'}
+
+        for info in infos:
+            for key, value in info.items():
+                if key in ['install', 'changelog']:
+                    names.add(value)
+                elif key.startswith('source'):
+                    for src in value:
+                        if '://' not in src:
+                            names.update(src.split('::'))
+
+        paths = [Path(self.builddir, n) for n in names]
+        return sorted(p for p in paths if p.is_file())
+
+    @property
+    def digest(self):
+        """
+        Get a hash of the PKGBUILD's inputs.
+
+        :return: A hexadecimal SHA-256 digest
+        """
+        return hash_files(self.inputs, self.builddir)
+
     def _get_depends(self, type):
         """
         Get a given type of package dependencies with Restrictions.
@@ -432,24 +957,130 @@ class AurPkgbuild(Pkgbuild):
         super().__init__(name, buildpath, 'aur', makepkg_conf)
         self.uri = aurpkg.giturl
         self.aurpkg = aurpkg
+        self.mirrors = MirrorStore(Path(buildpath, 'mirrors'))
+
+    @property
+    def statepath(self):
+        """
+        Path to the file recording the AUR package info the build directory
+        was last updated to. It is kept in the git directory so it is not
+        part of the PKGBUILD's inputs.
+        """
+        return Path(self.builddir, '.git', 'pkgbuilder.json')
+
+    def _load_state(self):
+        try:
+            with open(self.statepath) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_state(self):
+        self.mirrors.save(self.aurpkg)
+        with open(self.statepath, 'w') as f:
+            json.dump(self.aurpkg.state, f)
+
+    def stale(self):
+        """
+        Check if the AUR package changed since the build directory was last
+        updated by comparing its recorded LastModified time and version with
+        the AUR's package info. Package info is requested in batches by
+        `Aur.prefetch`, so no request is made per package. Info kept in the
+        Aur's cache directory is only requested again once its ttl expires,
+        so changes pushed within the ttl are not seen until then; set the
+        Aur's ttl to 0 to always request it. Build directories without a
+        recorded state are checked via git fetch.
+
+        :return: `True` if the package changed, `False` otherwise
+        """
+        info = Pkgbuild.aur.info(self.name)
+        if info:
+            self.aurpkg.info = info
+        state = self._load_state()
+        if not state:
+            return not GitRepo(self.builddir).up_to_date()
+        return state != self.aurpkg.state
+
+    def _git_cmds(self):
+        """
+        Get the git commands that update the build directory from the
+        package's mirror, refreshing the mirror first if the package changed.
+
+        :return: A list of commands or an empty list if the build directory \
+        is up-to-date
+        """
+        if self.builddir.exists():
+            if GitRepo(self.builddir).is_repo():
+                if not self.stale():
+                    return []
+                return self.mirrors.fetch_cmds(self.aurpkg) + \
+                    [self.mirrors.pull_cmd(self.aurpkg, self.builddir)]
+            self.remove()
+        return self.mirrors.fetch_cmds(self.aurpkg) + \
+            [self.mirrors.clone_cmd(self.aurpkg, self.builddir)]
 
     def _update(self):
         """
-        Clone the AUR package's git repository to the build directory or update
-        it via git pull.
+        Clone the AUR package's mirror to the build directory or update it
+        via git pull if the package changed.
 
         :return: `True` if the builddir was updated, `False` otherwise
         """
-        if self.builddir.exists():
-            repo = GitRepo(self.builddir)
-            if repo.is_repo():
-                if repo.up_to_date():
-                    return False
-                repo.pull()
-            else:
-                self.remove()
-                self.aurpkg.git_clone(self.builddir)
-        else:
-            self.aurpkg.git_clone(self.builddir)
+        cmds = self._git_cmds()
+        if not cmds:
+            return False
+        for cmd in cmds:
+            run(cmd, check=True)
+        self._save_state()
+        return True
+
+
+class SnapshotPkgbuild(AurPkgbuild):
+    """
+    An AUR-based PKGBUILD downloaded as a snapshot tarball instead of cloned
+    via git. Snapshots are lighter to fetch for large batches of packages.
+
+    :param name: Package name
+    :param buildpath: Path to build directory
+    :param aurpkg: AurPackage for the given package name
+    :param makepkg_conf: Path to makepkg configuration file
+    """
+    def __init__(self, name, buildpath, aurpkg, makepkg_conf=None):
+        super().__init__(name, buildpath, aurpkg, makepkg_conf)
+        self.uri = aurpkg.urlpath
+
+    @property
+    def statepath(self):
+        """
+        Path to the file recording the AUR package info the snapshot was
+        downloaded for.
+        """
+        return Path(self.builddir, '.pkgbuilder.json')
 
+    def _save_state(self):
+        with open(self.statepath, 'w') as f:
+            json.dump(self.aurpkg.state, f)
+
+    def stale(self):
+        """
+        Check if the AUR package changed since its snapshot was downloaded.
+
+        :return: `True` if the package changed, `False` otherwise
+        """
+        info = Pkgbuild.aur.info(self.name)
+        if info:
+            self.aurpkg.info = info
+        return self._load_state() != self.aurpkg.state
+
+    def _update(self):
+        """
+        Download the AUR package's snapshot to the build directory if the
+        package changed.
+
+        :return: `True` if the builddir was updated, `False` otherwise
+        """
+        if self.builddir.exists() and not self.stale():
+            return False
+        self.aurpkg.download(self.builddir)
+        self._save_state()
         return True
@@ -0,0 +1,284 @@
+# This project is licensed under the MIT License.
+
+"""
+.. module:: planner
+   :synopsis: Resolve package dependencies into a build plan.
+
+.. moduleauthor:: James Reed <jcrd@tuta.io>
+"""
+
+from urllib.error import URLError
+import hashlib
+import logging
+
+from .pkgbuild import Pkgbuild, LocalDir
+from .repo import sync_package
+from .utils import Registry, default_pacman_conf
+from .vercmp import satisfies
+
+log = logging.getLogger('pkgbuilder.planner')
+
+
+class Node:
+    """
+    A package in a build plan.
+
+    :param pkgbuild: The Pkgbuild to build
+    """
+    def __init__(self, pkgbuild):
+        self.pkgbuild = pkgbuild
+        self.depends = []
+        self.makedepends = []
+        self._key = None
+
+    def __repr__(self):
+        return 'Node({})'.format(self.name)
+
+    @property
+    def name(self):
+        """
+        The name of the package.
+        """
+        return self.pkgbuild.name
+
+    @property
+    def dependencies(self):
+        """
+        A list of nodes that must be built before this node.
+        """
+        return self.depends + [n for n in self.makedepends
+                               if n not in self.depends]
+
+    @property
+    def key(self):
+        """
+        The build cache key, combining the hash of the PKGBUILD's inputs with
+        the keys of its dependencies. The key changes when the package or any
+        package it is built against changes.
+        """
+        if not self._key:
+            h = hashlib.sha256(self.pkgbuild.digest.encode())
+            for k in sorted(n.key for n in self.dependencies):
+                h.update(k.encode())
+            self._key = h.hexdigest()
+        return self._key
+
+
+class Planner:
+    """
+    Resolves the dependencies of a package against the sync repositories,
+    local PKGBUILDs and the AUR before any package is built.
+
+    :param localdir: LocalDir of local PKGBUILDs
+    :param builddir: Path to package build directory
+    :param source: PKGBUILD source - one of Pkgbuild.Source.Local or \
+    Pkgbuild.Source.Aur
+    :param pacman_conf: Path to pacman configuration file
+    :param makepkg_conf: Path to makepkg configuration file
+    """
+    sync = Registry()
+
+    class CycleError(Exception):
+        """
+        An exception raised when packages depend on each other.
+        """
+        pass
+
+    def __init__(self, localdir, builddir, source=None,
+                 pacman_conf=default_pacman_conf, makepkg_conf=None):
+        self.localdir = localdir
+        self.builddir = builddir
+        self.source = source
+        self.pacman_conf = pacman_conf
+        self.makepkg_conf = makepkg_conf
+
+    def in_repos(self, name, restrictions=[]):
+        """
+        Check if a dependency is satisfied by the sync repositories.
+
+        :param name: Package name
+        :param restrictions: A list of version Restrictions
+        :return: `True` if satisfied, `False` otherwise
+        """
+        targets = [name + r.compare + r.version for r in restrictions]
+        for t in targets or [name]:
+            found = Planner.sync.get(
+                (t, self.pacman_conf),
+                lambda: sync_package(t, self.pacman_conf) is not None)
+            if not found:
+                return False
+        return True
+
+    def in_aur(self, name, restrictions=[]):
+        """
+        Check if a dependency would be resolved from the AUR, i.e. it is
+        neither satisfied by the sync repositories nor provided locally.
+
+        :param name: Package name
+        :param restrictions: A list of version Restrictions
+        :return: `True` if resolved from the AUR, `False` otherwise
+        """
+        if self.source == Pkgbuild.Source.Local or \
+                self.in_repos(name, restrictions):
+            return False
+        return self.local_provider(name, restrictions) is None
+
+    def local_provider(self, name, restrictions=[]):
+        """
+        Find the local PKGBUILD that provides a dependency.
+
+        :param name: Package name
+        :param restrictions: A list of version Restrictions
+        :return: A Pkgbuild or `None` if the source is the AUR or no local \
+        PKGBUILD provides name
+        """
+        if self.source == Pkgbuild.Source.Aur:
+            return None
+        try:
+            return self.localdir.providers(name, restrictions)[0]
+        except LocalDir.ProviderNotFoundError:
+            return None
+
+    def resolve(self, name, restrictions=[]):
+        """
+        Find the PKGBUILD that provides a dependency.
+
+        :param name: Package name
+        :param restrictions: A list of version Restrictions
+        :raises ProviderNotFoundError: Raised when the source is local and \
+        no provider can be found for name
+        :raises SourceNotFoundError: Raised when no source can be found for \
+        name in the AUR
+        :return: A Pkgbuild or `None` if the dependency is satisfied by the \
+        sync repositories
+        """
+        if self.in_repos(name, restrictions):
+            return None
+        if self.source != Pkgbuild.Source.Aur:
+            try:
+                return self.localdir.providers(name, restrictions)[0]
+            except LocalDir.ProviderNotFoundError:
+                if self.source == Pkgbuild.Source.Local:
+                    raise
+        try:
+            return Pkgbuild.new(name, self.builddir,
+                                source=Pkgbuild.Source.Aur,
+                                makepkg_conf=self.makepkg_conf)
+        except Pkgbuild.SourceNotFoundError:
+            provider = self.aur_provider(name, restrictions)
+            if not provider:
+                raise
+        log.info('%s: Provided by AUR package %s', name, provider)
+        return Pkgbuild.new(provider, self.builddir,
+                            source=Pkgbuild.Source.Aur,
+                            makepkg_conf=self.makepkg_conf)
+
+    def aur_provider(self, name, restrictions=[]):
+        """
+        Find an AUR package that provides a dependency.
+
+        :param name: Provided name
+        :param restrictions: A list of version Restrictions
+        :return: The name of the providing package or `None` if not found
+        """
+        for info in Pkgbuild.aur.providers(name):
+            versions = []
+            for p in info.get('Provides') or []:
+                n, _, v = p.partition('=')
+                if n == name:
+                    versions.append(v)
+            if any(all(v and satisfies(v, r) for r in restrictions)
+                   for v in versions):
+                return info['Name']
+        return None
+
+    def prefetch(self, pkgbuild):
+        """
+        Fetch AUR info about the dependency closure of the dependencies of a
+        PKGBUILD and of its local dependencies that are neither in the sync
+        repositories nor provided locally, so they are resolved without a
+        request per package, and
+        update the build directories of the closure's AUR packages
+        concurrently.
+
+        :param pkgbuild: The Pkgbuild whose dependencies to prefetch
+        """
+        if self.source == Pkgbuild.Source.Local:
+            return
+        names = []
+        seen = set()
+        queue = [pkgbuild]
+        while queue:
+            p = queue.pop()
+            if p in seen:
+                continue
+            seen.add(p)
+            for type in ['depends', 'makedepends']:
+                for name, rs in getattr(p, type).items():
+                    if self.in_repos(name, rs):
+                        continue
+                    local = self.local_provider(name, rs)
+                    if local:
+                        queue.append(local)
+                    elif name not in names:
+                        names.append(name)
+        if not names:
+            return
+        try:
+            infos = Pkgbuild.aur.prefetch(names)
+            pkgbuilds = [Pkgbuild.new(n, self.builddir,
+                                      source=Pkgbuild.Source.Aur,
+                                      makepkg_conf=self.makepkg_conf)
+                         for n in sorted(infos) if self.in_aur(n)]
+            Pkgbuild.update_all(pkgbuilds)
+        except (URLError, OSError, ValueError) as e:
+            log.warning('%s: Failed to prefetch AUR dependencies: %s',
+                        pkgbuild.name, e)
+        except Pkgbuild.UpdateError as e:
+            log.warning('%s: Failed to update AUR dependencies: %s',
+                        pkgbuild.name, e.args[0]['errors'])
+
+    def plan(self, pkgbuild):
+        """
+        Resolve the dependency graph of a PKGBUILD.
+
+        :param pkgbuild: The Pkgbuild to plan
+        :raises CycleError: Raised when the dependency graph contains a cycle
+        :return: A list of Nodes in build order, i.e. every node comes after \
+        its dependencies and the given PKGBUILD comes last
+        """
+        nodes = {}
+        visiting = []
+        order = []
+
+        def visit(pkgbuild):
+            if pkgbuild in visiting:
+                names = [p.name for p in visiting] + [pkgbuild.name]
+                err = {'message': 'Dependency cycle detected',
+                       'cycle': ' -> '.join(names)}
+                raise Planner.CycleError(err)
+            if pkgbuild in nodes:
+                return nodes[pkgbuild]
+
+            node = Node(pkgbuild)
+            visiting.append(pkgbuild)
+            for type in ['depends', 'makedepends']:
+                deps = getattr(node, type)
+                for name, rs in getattr(pkgbuild, type).items():
+                    dep = self.resolve(name, rs)
+                    if dep is None or dep is pkgbuild:
+                        continue
+                    log.info('%s: Planned %s: %s', pkgbuild.name, type,
+                             dep.name)
+                    n = visit(dep)
+                    if n not in deps:
+                        deps.append(n)
+            visiting.pop()
+
+            nodes[pkgbuild] = node
+            order.append(node)
+            return node
+
+        self.prefetch(pkgbuild)
+        visit(pkgbuild)
+        return order
@@ -17,6 +17,21 @@ from parse import search
 from .utils import default_pacman_conf
 
 
+def sync_package(target, pacman_conf=default_pacman_conf):
+    """
+    Find a package in the sync repositories that satisfies a dependency.
+
+    :param target: Package name with an optional version restriction, \
+    e.g. `name>=1`
+    :param pacman_conf: Path to pacman configuration file
+    :return: Name of the satisfying package or `None` if not found
+    """
+    r = run(['pacman', '--config', pacman_conf, '-Sddp', '--print-format',
+             '%n', target], capture_output=True, text=True)
+    if r.returncode == 0:
+        return r.stdout.strip() or None
+
+
 def get_repo(name_or_path, pacman_conf=default_pacman_conf):
     """
     Get a LocalRepo object from a repository name or path.
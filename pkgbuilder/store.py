@@ -0,0 +1,237 @@
+# This project is licensed under the MIT License.
+
+"""
+.. module:: store
+   :synopsis: A SQLite index of build manifests.
+
+.. moduleauthor:: James Reed <jcrd@tuta.io>
+"""
+
+from pathlib import Path
+from threading import Lock
+import json
+import logging
+import sqlite3
+
+log = logging.getLogger('pkgbuilder.store')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS packages (
+    pkgbuilddir TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    key TEXT
+);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+CREATE INDEX IF NOT EXISTS packages_timestamp ON packages (timestamp);
+
+CREATE TABLE IF NOT EXISTS artifacts (
+    pkgbuilddir TEXT NOT NULL
+        REFERENCES packages (pkgbuilddir) ON DELETE CASCADE,
+    type TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (pkgbuilddir, type, path)
+);
+CREATE INDEX IF NOT EXISTS artifacts_path ON artifacts (path, type);
+
+CREATE TABLE IF NOT EXISTS edges (
+    pkgbuilddir TEXT NOT NULL
+        REFERENCES packages (pkgbuilddir) ON DELETE CASCADE,
+    depend TEXT NOT NULL,
+    type TEXT NOT NULL,
+    PRIMARY KEY (pkgbuilddir, depend, type)
+);
+CREATE INDEX IF NOT EXISTS edges_depend ON edges (depend);
+'''
+
+artifact_types = ['packages', 'depends', 'makedepends']
+
+
+class ManifestStore:
+    """
+    A SQLite database indexing the build manifests of all packages in a
+    build directory, with tables for packages, their artifacts and the
+    dependency edges between them.
+
+    :param path: Path to the database file
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(schema)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self._db.close()
+
+    @property
+    def migrated(self):
+        """
+        `True` if build.json files have been imported by `migrate`.
+        """
+        with self._lock:
+            r = self._db.execute('PRAGMA user_version').fetchone()
+            return r[0] > 0
+
+    def exists(self, pkgbuilddir):
+        """
+        Check if a manifest exists.
+
+        :param pkgbuilddir: Path to PKGBUILD directory
+        :return: `True` if exists, `False` otherwise
+        """
+        with self._lock:
+            r = self._db.execute('SELECT 1 FROM packages '
+                                 'WHERE pkgbuilddir = ?', (str(pkgbuilddir),))
+            return r.fetchone() is not None
+
+    def _save(self, d, pkgbuilddir):
+        pkgbuilddir = str(pkgbuilddir)
+        self._db.execute('DELETE FROM packages WHERE pkgbuilddir = ?',
+                         (pkgbuilddir,))
+        self._db.execute('INSERT INTO packages VALUES (?, ?, ?, ?)',
+                         (pkgbuilddir, d['name'], d['timestamp'],
+                          d.get('key')))
+        self._db.executemany('INSERT OR IGNORE INTO artifacts VALUES '
+                             '(?, ?, ?)',
+                             [(pkgbuilddir, t, p) for t in artifact_types
+                              for p in d[t]])
+
+    def _link(self, pkgbuilddir=None):
+        """
+        Record dependency edges by matching dependency paths to the packages
+        that built them.
+
+        :param pkgbuilddir: Only record the edges of the package in this \
+        PKGBUILD directory, both to its dependencies and from packages that \
+        were built against it, defaults to recording all edges
+        """
+        where = ''
+        args = ()
+        if pkgbuilddir:
+            where = 'AND (d.pkgbuilddir = ? OR a.pkgbuilddir = ?)'
+            args = (str(pkgbuilddir), str(pkgbuilddir))
+        self._db.execute('''
+            INSERT OR IGNORE INTO edges
+            SELECT d.pkgbuilddir, p.name, d.type
+            FROM artifacts d
+            JOIN artifacts a ON a.path = d.path AND a.type = 'packages'
+            JOIN packages p ON p.pkgbuilddir = a.pkgbuilddir
+            WHERE d.type != 'packages' {}
+        '''.format(where), args)
+
+    def save(self, d, pkgbuilddir):
+        """
+        Save a manifest.
+
+        :param d: A dictionary with keys: name, timestamp, packages, \
+        depends, makedepends, key
+        :param pkgbuilddir: Path to PKGBUILD directory
+        """
+        with self._lock, self._db:
+            self._save(d, pkgbuilddir)
+            self._link(pkgbuilddir)
+
+    def load(self, pkgbuilddir):
+        """
+        Load a manifest.
+
+        :param pkgbuilddir: Path to PKGBUILD directory
+        :return: A dictionary with keys: name, timestamp, packages, depends, \
+        makedepends, key or an empty dictionary if not found
+        """
+        pkgbuilddir = str(pkgbuilddir)
+        with self._lock:
+            r = self._db.execute('SELECT * FROM packages '
+                                 'WHERE pkgbuilddir = ?',
+                                 (pkgbuilddir,)).fetchone()
+            if not r:
+                return {}
+            d = {'name': r['name'], 'timestamp': r['timestamp'],
+                 'key': r['key']}
+            for t in artifact_types:
+                d[t] = []
+            for a in self._db.execute('SELECT type, path FROM artifacts '
+                                      'WHERE pkgbuilddir = ?',
+                                      (pkgbuilddir,)):
+                d[a['type']].append(a['path'])
+            return d
+
+    def remove(self, pkgbuilddir):
+        """
+        Remove a manifest.
+
+        :param pkgbuilddir: Path to PKGBUILD directory
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM packages WHERE pkgbuilddir = ?',
+                             (str(pkgbuilddir),))
+
+    def built(self, since=0):
+        """
+        Get the names of built packages.
+
+        :param since: Only include packages built at or after this timestamp
+        :return: A list of package names ordered by build time
+        """
+        with self._lock:
+            r = self._db.execute('SELECT name FROM packages '
+                                 'WHERE timestamp >= ? ORDER BY timestamp',
+                                 (since,))
+            return [row['name'] for row in r]
+
+    def depends(self, name):
+        """
+        Get the packages that a package was built against.
+
+        :param name: Package name
+        :return: A set of package names
+        """
+        with self._lock:
+            r = self._db.execute('SELECT e.depend FROM edges e '
+                                 'JOIN packages p '
+                                 'ON p.pkgbuilddir = e.pkgbuilddir '
+                                 'WHERE p.name = ?', (name,))
+            return {row['depend'] for row in r}
+
+    def dependents(self, name):
+        """
+        Get the packages that were built against a package.
+
+        :param name: Package name
+        :return: A set of package names
+        """
+        with self._lock:
+            r = self._db.execute('SELECT p.name FROM edges e '
+                                 'JOIN packages p '
+                                 'ON p.pkgbuilddir = e.pkgbuilddir '
+                                 'WHERE e.depend = ?', (name,))
+            return {row['name'] for row in r}
+
+    def migrate(self, builddir):
+        """
+        Import the build.json manifests found in a package build directory.
+
+        :param builddir: Path to package build directory
+        :return: The number of imported manifests
+        """
+        n = 0
+        with self._lock, self._db:
+            for f in Path(builddir).glob('*/*/build.json'):
+                try:
+                    with open(f) as fp:
+                        self._save(json.load(fp), f.parent)
+                except (ValueError, KeyError) as e:
+                    log.warning('Skipping malformed manifest %s: %s', f, e)
+                    continue
+                n += 1
+            self._link()
+            self._db.execute('PRAGMA user_version = 1')
+        log.info('Imported %d manifests into %s', n, self.path)
+        return n
@@ -10,13 +10,19 @@
 from asyncio.subprocess import PIPE
 from contextlib import contextmanager
 from filecmp import dircmp
+from functools import lru_cache
 from pathlib import Path
 from shutil import copy2, copytree, rmtree
+from threading import RLock
 import asyncio
+import hashlib
 import os
+import re
+import shlex
 import subprocess
 
 default_pacman_conf = '/etc/pacman.conf'
+default_makepkg_conf = '/etc/makepkg.conf'
 
 
 class CmdLogger:
@@ -47,15 +53,16 @@ class CmdLogger:
         return ''.join(lines)
 
     @asyncio.coroutine
-    def _run_and_log(self, cmd):
+    def _run_and_log(self, cmd, cwd=None):
         """
         A coroutine to run a command, capturing and logging its output.
 
         :param cmd: The command to run
+        :param cwd: The command's working directory
         :return: The command's exit code, a list of stdout lines, and a list of
         stderr lines
         """
-        p = yield from asyncio.create_subprocess_exec(*cmd,
+        p = yield from asyncio.create_subprocess_exec(*cmd, cwd=cwd,
                                                       stdout=PIPE, stderr=PIPE)
         try:
             stdout, stderr = yield from asyncio.gather(
@@ -68,16 +75,65 @@ class CmdLogger:
 
         return r, stdout, stderr
 
-    def run(self, cmd):
+    def run(self, cmd, cwd=None):
         """
-        Run a command, capturing and logging its output.
+        Run a command, capturing and logging its output. Each call uses its own
+        event loop so commands can be run from multiple threads.
 
         :param cmd: The command to run
+        :param cwd: The command's working directory
         :return: The command's exit code, a list of stdout lines, and a list \
         of stderr lines
         """
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self._run_and_log(cmd))
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._run_and_log(cmd, cwd))
+        finally:
+            loop.close()
+
+
+class Registry:
+    """
+    A thread-safe, session-scoped mapping of keys to shared objects.
+    """
+    def __init__(self):
+        self._items = {}
+        self._lock = RLock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, factory):
+        """
+        Get the object registered under a key, creating it if necessary.
+
+        :param key: A hashable key
+        :param factory: A function called without arguments to create the \
+        object if the key is not registered
+        :return: The registered object
+        """
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = factory()
+            return self._items[key]
+
+    def invalidate(self, predicate=None):
+        """
+        Remove registered objects.
+
+        :param predicate: A function called with each key that returns \
+        `True` if its object should be removed, defaults to removing all \
+        objects
+        :return: The number of removed objects
+        """
+        with self._lock:
+            keys = [k for k in self._items if not predicate or predicate(k)]
+            for k in keys:
+                del self._items[k]
+            return len(keys)
 
 
 @contextmanager
@@ -95,6 +151,92 @@ def cwd(path):
         os.chdir(oldcwd)
 
 
+def _parse_conf(text):
+    """
+    Parse the simple variable assignments of a bash configuration file.
+
+    :param text: The file contents
+    :return: A dictionary mapping names to strings or lists of strings; \
+    values that need bash to be evaluated are `None`
+    """
+    conf = {}
+    assign = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)=(.*)$')
+    lines = iter(text.splitlines())
+    for line in lines:
+        m = assign.match(line)
+        if not m:
+            continue
+        name, value = m.groups()
+        while value.endswith('\\'):
+            value = value[:-1] + next(lines, '')
+        if value.startswith('('):
+            while ')' not in value:
+                value += '\n' + next(lines, ')')
+            value = value[1:value.rindex(')')]
+        try:
+            words = shlex.split(value, comments=True)
+        except ValueError:
+            conf[name] = None
+            continue
+        if any(c in value for c in '$`'):
+            conf[name] = None
+        elif m.group(2).startswith('('):
+            conf[name] = words
+        else:
+            conf[name] = ' '.join(words)
+    return conf
+
+
+@lru_cache(maxsize=16)
+def _read_conf_files(files):
+    """
+    Read and merge configuration files. Results are memoized.
+
+    :param files: A tuple of tuples of the path, modification time and size \
+    of each file, so changed files are read again
+    :return: A dictionary mapping variable names to values
+    """
+    conf = {}
+    for f, _, _ in files:
+        conf.update(_parse_conf(Path(f).read_text()))
+    return conf
+
+
+def read_makepkg_conf(path=None):
+    """
+    Read the variables set by makepkg's configuration files in the order
+    makepkg sources them, including the makepkg.conf.d directory and, when
+    using the default configuration file, the user's configuration file.
+    Results are memoized until one of the files changes.
+
+    :param path: Path to makepkg configuration file, defaults to \
+    /etc/makepkg.conf
+    :return: A dictionary mapping variable names to strings, lists of \
+    strings or `None` if the value cannot be determined without bash, or \
+    `None` if the configuration file does not exist
+    """
+    path = Path(path or default_makepkg_conf)
+    if not path.is_file():
+        return None
+    files = [path] + sorted(Path(str(path) + '.d').glob('*.conf'))
+    if str(path) == default_makepkg_conf:
+        xdg = os.environ.get('XDG_CONFIG_HOME',
+                             os.path.expanduser('~/.config'))
+        for f in [Path(xdg, 'pacman/makepkg.conf'),
+                  Path(os.path.expanduser('~/.makepkg.conf'))]:
+            if f.is_file():
+                files.append(f)
+                break
+    stats = []
+    for f in files:
+        try:
+            st = f.stat()
+        except FileNotFoundError:
+            continue
+        stats.append((str(f), st.st_mtime_ns, st.st_size))
+    return _read_conf_files(tuple(stats))
+
+
 def write_stdin(cmd, iter):
     """
     Write strings produced by an iterable to a subprocess's standard input.
@@ -121,6 +263,24 @@ def write_stdin(cmd, iter):
     wait()
 
 
+def hash_files(paths, root):
+    """
+    Hash the names and contents of files.
+
+    :param paths: Paths to the files
+    :param root: Directory that file names are relative to
+    :return: A hexadecimal SHA-256 digest
+    """
+    h = hashlib.sha256()
+    for p in sorted(Path(p) for p in paths):
+        name = str(p.relative_to(root))
+        h.update('{}\0{}\0'.format(name, p.stat().st_size).encode())
+        with open(p, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
 def synctree(a, b):
     """
     Copy new and updated files from a to b.
@@ -0,0 +1,189 @@
+# This project is licensed under the MIT License.
+
+"""
+.. module:: vercmp
+   :synopsis: Compare package versions like pacman's vercmp.
+
+.. moduleauthor:: James Reed <jcrd@tuta.io>
+"""
+
+from functools import cmp_to_key, lru_cache
+from string import ascii_letters, digits
+
+alnum = ascii_letters + digits
+
+
+def parse_version(version):
+    """
+    Split a package version into its epoch, pkgver and pkgrel.
+
+    :param version: A version string of the form `[epoch:]pkgver[-pkgrel]`
+    :return: A tuple of the epoch, pkgver and pkgrel, where pkgrel is `None` \
+    if not present
+    """
+    i = 0
+    while i < len(version) and version[i] in digits:
+        i += 1
+    epoch = '0'
+    if i < len(version) and version[i] == ':':
+        epoch = version[:i] or '0'
+        i += 1
+    else:
+        i = 0
+    release = None
+    j = version.rfind('-', i)
+    if j >= 0:
+        release = version[j + 1:]
+    else:
+        j = len(version)
+    return (epoch, version[i:j], release)
+
+
+def rpmvercmp(a, b):
+    """
+    Compare two version segments using the rpm algorithm used by pacman.
+
+    :param a: The first version segment
+    :param b: The second version segment
+    :return: -1 if a is older than b, 1 if it is newer, 0 if they are equal
+    """
+    if a == b:
+        return 0
+
+    one = two = 0
+    ptr1 = ptr2 = 0
+    while one < len(a) and two < len(b):
+        while one < len(a) and a[one] not in alnum:
+            one += 1
+        while two < len(b) and b[two] not in alnum:
+            two += 1
+        if one == len(a) or two == len(b):
+            break
+
+        # Different numbers of separators: the one with more is newer.
+        if one - ptr1 != two - ptr2:
+            return -1 if one - ptr1 < two - ptr2 else 1
+
+        ptr1 = one
+        ptr2 = two
+        if a[ptr1] in digits:
+            kind = digits
+        else:
+            kind = ascii_letters
+        while ptr1 < len(a) and a[ptr1] in kind:
+            ptr1 += 1
+        while ptr2 < len(b) and b[ptr2] in kind:
+            ptr2 += 1
+
+        # Segments of different types: numbers are newer than letters.
+        if two == ptr2:
+            return 1 if kind is digits else -1
+
+        s1 = a[one:ptr1]
+        s2 = b[two:ptr2]
+        if kind is digits:
+            s1 = s1.lstrip('0')
+            s2 = s2.lstrip('0')
+            if len(s1) != len(s2):
+                return 1 if len(s1) > len(s2) else -1
+        if s1 != s2:
+            return 1 if s1 > s2 else -1
+
+        one = ptr1
+        two = ptr2
+
+    if one == len(a) and two == len(b):
+        return 0
+    # An empty remainder is newer than a letter remainder, e.g. 1.0 > 1.0rc,
+    # and older than anything else.
+    if (one == len(a) and b[two] not in ascii_letters) \
+            or (one < len(a) and a[one] in ascii_letters):
+        return -1
+    return 1
+
+
+@lru_cache(maxsize=65536)
+def vercmp(a, b):
+    """
+    Compare two package versions like pacman's vercmp. The pkgrel is only
+    compared if both versions have one. Results are memoized.
+
+    :param a: The first version
+    :param b: The second version
+    :return: -1 if a is older than b, 1 if it is newer, 0 if they are equal
+    """
+    if a == b:
+        return 0
+    epoch1, ver1, rel1 = parse_version(a)
+    epoch2, ver2, rel2 = parse_version(b)
+    r = rpmvercmp(epoch1, epoch2)
+    if r == 0:
+        r = rpmvercmp(ver1, ver2)
+        if r == 0 and rel1 is not None and rel2 is not None:
+            r = rpmvercmp(rel1, rel2)
+    return r
+
+
+def total_vercmp(a, b):
+    """
+    Compare two package versions like vercmp, except that a version without
+    a pkgrel is older than the same version with any pkgrel. Unlike vercmp,
+    this is a total order, e.g. `1.5` < `1.5-1` < `1.5-2`.
+
+    :param a: The first version
+    :param b: The second version
+    :return: -1 if a is older than b, 1 if it is newer, 0 if they are equal
+    """
+    r = vercmp(base_version(a), base_version(b))
+    if r == 0:
+        rel1 = parse_version(a)[2]
+        rel2 = parse_version(b)[2]
+        if rel1 is None or rel2 is None:
+            r = (rel1 is not None) - (rel2 is not None)
+        else:
+            r = rpmvercmp(rel1, rel2)
+    return r
+
+
+def base_version(version):
+    """
+    Strip the pkgrel from a package version.
+
+    :param version: A version string of the form `[epoch:]pkgver[-pkgrel]`
+    :return: The version string `epoch:pkgver`
+    """
+    epoch, ver, _ = parse_version(version)
+    return epoch + ':' + ver
+
+
+version_key = cmp_to_key(vercmp)
+total_version_key = cmp_to_key(total_vercmp)
+
+
+def sort_versions(versions, reverse=False):
+    """
+    Sort package versions.
+
+    :param versions: An iterable of version strings
+    :param reverse: Sort newest first if `True`, defaults to `False`
+    :return: A sorted list of versions
+    """
+    return sorted(versions, key=version_key, reverse=reverse)
+
+
+def satisfies(version, restriction):
+    """
+    Check if a package version satisfies a version Restriction.
+
+    :param version: The package version
+    :param restriction: A Restriction tuple or `None`
+    :return: `True` if satisfied, `False` otherwise
+    """
+    if not restriction:
+        return True
+    r = vercmp(version, restriction.version)
+    return {'<': r < 0,
+            '<=': r <= 0,
+            '=': r == 0,
+            '>=': r >= 0,
+            '>': r > 0}[restriction.compare]
@@ -0,0 +1,376 @@
+# This project is licensed under the MIT License.
+
+"""
+.. module:: watch
+   :synopsis: Rebuild local packages when their PKGBUILDs change.
+
+.. moduleauthor:: James Reed <jcrd@tuta.io>
+"""
+
+from pathlib import Path
+from subprocess import CalledProcessError
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+from .builder import Builder
+from .pkgbuild import Pkgbuild, LocalDir
+from .planner import Planner
+
+log = logging.getLogger('pkgbuilder.watch')
+
+
+def _ignored(name):
+    return name.startswith('.') or name.endswith('~')
+
+
+class PollWatcher:
+    """
+    Watch a directory tree by periodically comparing the state of its files.
+
+    :param path: Path to directory
+    :param interval: Seconds between polls, defaults to 2
+    :param exclude: A list of paths to ignore
+    """
+    def __init__(self, path, interval=2, exclude=[]):
+        self.path = Path(path)
+        self.interval = interval
+        self.exclude = {os.path.realpath(p) for p in exclude}
+        self._state = self._snapshot()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _snapshot(self):
+        """
+        Get the state of the files in the directory tree.
+
+        :return: A dictionary mapping relative paths of files to tuples of \
+        inode, modification time and size, and of directories to `None`
+        """
+        state = {}
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs if not _ignored(d) and
+                       os.path.realpath(os.path.join(root, d))
+                       not in self.exclude]
+            for name in dirs:
+                rel = os.path.relpath(os.path.join(root, name), self.path)
+                state[rel] = None
+            for name in files:
+                if _ignored(name):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    s = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                rel = os.path.relpath(path, self.path)
+                state[rel] = (s.st_ino, s.st_mtime_ns, s.st_size)
+        return state
+
+    def read(self, timeout=None):
+        """
+        Wait for changes.
+
+        :param timeout: Seconds to wait, defaults to waiting until a change \
+        is found
+        :return: A set of the names of changed top-level entries, empty if \
+        the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - time.monotonic()))
+            time.sleep(wait)
+            state = self._snapshot()
+            changed = state.keys() ^ self._state.keys()
+            changed |= {p for p in state.keys() & self._state.keys()
+                        if state[p] != self._state[p]}
+            self._state = state
+            if changed:
+                return {Path(p).parts[0] for p in changed}
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+
+class InotifyWatcher:
+    """
+    Watch a directory tree using inotify.
+
+    :param path: Path to directory
+    :param exclude: A list of paths to ignore
+    :raises OSError: Raised when inotify is not available
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    event = struct.Struct('iIII')
+
+    def __init__(self, path, exclude=[]):
+        self.path = Path(path)
+        self.exclude = {os.path.realpath(p) for p in exclude}
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK |
+                                            self.IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._watches = {}
+        self._add(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _add(self, path):
+        """
+        Watch a directory and its subdirectories.
+
+        :param path: Path to directory
+        """
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not _ignored(d) and
+                       os.path.realpath(os.path.join(root, d))
+                       not in self.exclude]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root),
+                                              self.mask)
+            if wd < 0:
+                log.warning('Failed to watch %s: %s', root,
+                            os.strerror(ctypes.get_errno()))
+                continue
+            self._watches[wd] = os.path.relpath(root, self.path)
+
+    def _events(self):
+        """
+        Read pending events.
+
+        :return: A set of the names of changed top-level entries or `None` \
+        if events were lost
+        """
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            i = 0
+            while i < len(buf):
+                wd, mask, _, size = self.event.unpack_from(buf, i)
+                i += self.event.size
+                name = os.fsdecode(buf[i:i + size].rstrip(b'\0'))
+                i += size
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                if mask & self.IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                rel = self._watches.get(wd)
+                if rel is None or _ignored(name):
+                    continue
+                path = os.path.normpath(os.path.join(rel, name))
+                if mask & self.IN_ISDIR and \
+                        mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add(Path(self.path, path))
+                if path != '.':
+                    changed.add(Path(path).parts[0])
+
+    def read(self, timeout=None):
+        """
+        Wait for changes.
+
+        :param timeout: Seconds to wait, defaults to waiting until a change \
+        is found
+        :return: A set of the names of changed top-level entries, empty if \
+        the timeout expired, or `None` if events were lost
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.monotonic())
+            r, _, _ = select.select([self._fd], [], [], wait)
+            if not r:
+                return set()
+            changed = self._events()
+            if changed is None or changed:
+                return changed
+
+
+def watcher(path, interval=2, exclude=[]):
+    """
+    Create an InotifyWatcher, falling back to a PollWatcher if inotify is
+    not available.
+
+    :param path: Path to directory
+    :param interval: Seconds between polls when polling
+    :param exclude: A list of paths to ignore
+    :return: An InotifyWatcher or PollWatcher
+    """
+    try:
+        return InotifyWatcher(path, exclude)
+    except (OSError, AttributeError) as e:
+        log.warning('Using polling to watch %s: %s', path, e)
+        return PollWatcher(path, interval, exclude)
+
+
+class Watch:
+    """
+    Watch a directory of local PKGBUILDs and report which packages must be
+    rebuilt. Iterating over a Watch first yields every watched package, then
+    waits for changes and yields the watched packages affected by them:
+    the changed packages themselves and the packages that depend on them.
+
+    :param localdir: LocalDir to watch
+    :param builder: A callable returning the Builder for a package name
+    :param names: Names of packages to watch, defaults to every package in \
+    localdir
+    :param debounce: Seconds without changes to wait for before rebuilding, \
+    defaults to 1
+    :param interval: Seconds between polls when inotify is not available, \
+    defaults to 2
+    """
+    def __init__(self, localdir, builder, names=None, debounce=1,
+                 interval=2):
+        self.localdir = localdir
+        self.builder = builder
+        self.names = names
+        self.debounce = debounce
+        self.watcher = watcher(localdir.path, interval, [localdir.builddir])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        self.watcher.close()
+
+    def __iter__(self):
+        yield self.targets()
+        while True:
+            changed = self.wait()
+            names = self.update(changed)
+            if names:
+                yield names
+
+    def targets(self):
+        """
+        Get the names of watched packages.
+
+        :return: A list of package names
+        """
+        return self.names or self.localdir.names
+
+    def wait(self):
+        """
+        Wait for a burst of changes to end.
+
+        :return: A set of the names of changed directories or `None` if \
+        every directory may have changed
+        """
+        changed = set()
+        timeout = None
+        while True:
+            names = self.watcher.read(timeout)
+            if names is None:
+                changed = None
+            elif not names:
+                return changed
+            elif changed is not None:
+                changed |= names
+            timeout = self.debounce
+
+    def update(self, changed):
+        """
+        Update the LocalDir after changes and forget shared Builders so they
+        are planned again.
+
+        :param changed: A set of the names of changed directories or `None` \
+        if every directory may have changed
+        :return: A list of the names of affected packages
+        """
+        log.info('Changed: %s', ', '.join(sorted(changed or ['*'])))
+        dirs = None
+        if changed is not None:
+            dirs = {os.path.realpath(Path(self.localdir.path, n))
+                    for n in changed}
+        # Recreate the PKGBUILDs of changed directories so files besides
+        # PKGBUILD are synchronized with the build directory again.
+        Pkgbuild.registry.invalidate(
+            lambda k: k[1] == Pkgbuild.Source.Local and
+            (dirs is None or k[2] in dirs))
+        self.localdir.update(force=True)
+        Builder.registry.invalidate()
+        return self.affected(dirs)
+
+    def affected(self, dirs):
+        """
+        Get the watched packages that must be rebuilt.
+
+        :param dirs: A set of the paths of changed directories or `None` if \
+        every directory may have changed
+        :return: A list of package names
+        """
+        if dirs is None:
+            return self.targets()
+        names = []
+        for name in self.targets():
+            try:
+                plan = self.builder(name).plan()
+            except (Pkgbuild.NoPkgbuildError, Pkgbuild.SourceNotFoundError,
+                    Pkgbuild.ParseSrcinfoError,
+                    LocalDir.ProviderNotFoundError, Planner.CycleError) as e:
+                log.error('%s: Failed to plan: %s', name, e.args[0])
+                continue
+            except CalledProcessError as e:
+                log.error('%s: Failed to plan: %s', name, e)
+                continue
+            for node in plan:
+                localdir = getattr(node.pkgbuild, 'localdir', None)
+                if localdir and str(localdir) in dirs:
+                    names.append(name)
+                    break
+        return names
@@ -1,8 +1,110 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from subprocess import run
 from tempfile import TemporaryDirectory
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen
+import io
+import logging
+import json
+import socket
+import tarfile
+import time
 import unittest
 
-from pkgbuilder.aur import GitRepo
+from pkgbuilder.aur import Aur, AurPackage, ConnectionPool, GitPool, \
+    GitRepo
+
+log = logging.getLogger(__name__)
+
+
+def aurpkg(name, depends=[], makedepends=[]):
+    return {'Name': name, 'URLPath': '/cgit/aur.git/snapshot/{}.tar.gz'
+            .format(name), 'Depends': depends, 'MakeDepends': makedepends}
+
+
+def snapshot(members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as t:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            if isinstance(data, tuple):
+                info.type, info.linkname = data
+            else:
+                info.size = len(data)
+            t.addfile(info, io.BytesIO(data) if info.isfile() else None)
+    return buf.getvalue()
+
+
+class RpcHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in self.server.redirects:
+            self.send_response(302)
+            location = self.server.redirects[self.path]
+            if location:
+                self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path in self.server.files:
+            body = self.server.files[self.path]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        names = parse_qs(urlparse(self.path).query).get('arg[]', [])
+        results = [self.server.packages[n] for n in names
+                   if n in self.server.packages]
+        body = json.dumps({'results': results}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RpcServer:
+    def __init__(self, packages):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RpcHandler)
+        self.server.packages = {p['Name']: p for p in packages}
+        self.server.requests = []
+        self.server.connections = 0
+        self.server.failures = 0
+        self.server.files = {}
+        self.server.redirects = {}
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class TestGitClone(unittest.TestCase):
@@ -18,3 +120,262 @@ class TestGitClone(unittest.TestCase):
 
     def tearDown(self):
         self.tmp.cleanup()
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        packages = [aurpkg('pkg{}'.format(i), ['dep{}>=1'.format(i), 'glibc'])
+                    for i in range(300)]
+        packages += [aurpkg('dep{}'.format(i), makedepends=['tool'])
+                     for i in range(300)]
+        packages.append(aurpkg('tool'))
+        self.server = RpcServer(packages)
+        self.aur = Aur(self.server.url)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_chunks(self):
+        chunks = self.aur._chunks(['pkg{}'.format(i) for i in range(1000)])
+        self.assertGreater(len(chunks), 1)
+        for c in chunks:
+            self.assertLessEqual(len(self.aur.rpc + c), Aur.max_url_length)
+        self.assertEqual(sum(c.count('&arg[]=') for c in chunks), 1000)
+
+    def test_chunks_quoted(self):
+        self.assertEqual(self.aur._chunks(['a+b']), ['&arg[]=a%2Bb'])
+
+    def test_prefetch(self):
+        names = ['pkg{}'.format(i) for i in range(300)]
+        infos = self.aur.prefetch(names)
+        self.assertEqual(len(infos), 601)
+        self.assertLess(len(self.server.requests), 10)
+        self.assertIn('glibc', self.aur.missing)
+
+        n = len(self.server.requests)
+        self.assertEqual(self.aur.info('dep5')['Name'], 'dep5')
+        self.assertIsNone(self.aur.info('glibc'))
+        self.assertEqual(len(self.server.requests), n)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.server = RpcServer([aurpkg('pkg1'), aurpkg('pkg2')])
+        self.server.server.packages['pkg1']['LastModified'] = 1
+
+    def tearDown(self):
+        self.server.close()
+        self.tmp.cleanup()
+
+    def newAur(self, **kwargs):
+        return Aur(self.server.url, cachedir=self.tmp.name, **kwargs)
+
+    def test_persistent(self):
+        self.assertEqual(len(self.newAur().infos('pkg1', 'pkg2', 'pkg3')), 2)
+        self.assertEqual(len(self.server.requests), 1)
+
+        aur = self.newAur()
+        self.assertEqual(len(aur.infos('pkg1', 'pkg2', 'pkg3')), 2)
+        self.assertIn('pkg3', aur.missing)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_ttl(self):
+        self.newAur().infos('pkg1', 'pkg2')
+        self.server.server.packages['pkg1']['LastModified'] = 2
+        time.sleep(0.01)
+
+        aur = self.newAur(ttl=0)
+        self.assertEqual(aur.info('pkg1')['LastModified'], 2)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.newAur().info('pkg1')['LastModified'], 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_offline(self):
+        self.newAur().infos('pkg1')
+        self.server.close()
+
+        aur = self.newAur(ttl=0, offline=True)
+        self.assertEqual(aur.info('pkg1')['Name'], 'pkg1')
+        self.assertIsNone(aur.info('pkg2'))
+
+    def test_expired_on_error(self):
+        self.newAur().infos('pkg1')
+        self.server.close()
+
+        aur = self.newAur(ttl=0)
+        self.assertEqual(aur.info('pkg1')['Name'], 'pkg1')
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = RpcServer([aurpkg('pkg1')])
+        self.pool = ConnectionPool(backoff=0.01)
+        self.url = Aur(self.server.url).rpc + '&arg[]=pkg1'
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def get(self):
+        with self.pool.request(self.url) as r:
+            return json.loads(r.read())['results']
+
+    def test_keep_alive(self):
+        for _ in range(10):
+            self.assertEqual(self.get()[0]['Name'], 'pkg1')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retry(self):
+        self.server.server.failures = 2
+        self.assertEqual(self.get()[0]['Name'], 'pkg1')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_exhausted(self):
+        self.server.server.failures = 10
+        with self.assertRaises(HTTPError):
+            self.get()
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_redirect(self):
+        self.server.server.files['/file'] = b'data'
+        self.server.server.redirects['/moved'] = '/file'
+        self.server.server.redirects['/broken'] = None
+        with self.pool.request(self.server.url + '/moved') as r:
+            self.assertEqual(r.read(), b'data')
+        with self.assertRaises(HTTPError) as cm:
+            with self.pool.request(self.server.url + '/broken'):
+                pass
+        self.assertEqual(cm.exception.code, 302)
+
+    def test_redirect_loop(self):
+        self.server.server.redirects['/loop'] = '/loop'
+        with self.assertRaises(HTTPError) as cm:
+            with self.pool.request(self.server.url + '/loop'):
+                self.fail('redirect loop yielded a response')
+        self.assertEqual(cm.exception.code, 302)
+        self.assertEqual(len(self.server.requests),
+                         self.pool.max_redirects + 1)
+        idle = [c for conns in self.pool._idle.values() for c in conns]
+        self.assertEqual(len(idle), len(set(map(id, idle))))
+        self.assertEqual(self.get()[0]['Name'], 'pkg1')
+
+    def test_benchmark(self):
+        n = 200
+        start = time.perf_counter()
+        for _ in range(n):
+            with urlopen(self.url) as r:
+                r.read()
+        urlopen_time = time.perf_counter() - start
+        connections = self.server.connections
+
+        start = time.perf_counter()
+        for _ in range(n):
+            self.get()
+        pool_time = time.perf_counter() - start
+
+        log.info('%d requests: urlopen %.3fs, %d connections; '
+                 'pool %.3fs, %d connections', n, urlopen_time, connections,
+                 pool_time, self.server.connections - connections)
+        self.assertEqual(connections, n)
+        self.assertEqual(self.server.connections - connections, 1)
+
+
+def bare_repo(path, name):
+    src = Path(path, 'src', name)
+    src.mkdir(parents=True)
+    Path(src, 'PKGBUILD').write_text('pkgname={}\n'.format(name))
+    for cmd in [['init', '-q', '-b', 'master'], ['add', '.'],
+                ['-c', 'user.name=test', '-c', 'user.email=test',
+                 'commit', '-q', '-m', 'init']]:
+        run(['git', '-C', str(src)] + cmd, check=True)
+    url = str(Path(path, name + '.git'))
+    run(['git', 'clone', '-q', '--bare', str(src), url], check=True)
+    return url
+
+
+class TestGitPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.urls = {'pkg{}'.format(i): bare_repo(self.tmp.name,
+                                                  'pkg{}'.format(i))
+                     for i in range(8)}
+        self.pool = GitPool(jobs=4)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def repo(self, name):
+        return GitRepo(Path(self.tmp.name, 'clones', name))
+
+    def test_clone_pull(self):
+        tasks = {n: [self.repo(n).clone_cmd(u)] for n, u in self.urls.items()}
+        self.assertEqual(self.pool.run(tasks), {})
+        for n in self.urls:
+            self.assertTrue(Path(self.repo(n).path, 'PKGBUILD').exists())
+
+        tasks = {n: [self.repo(n).pull_cmd()] for n in self.urls}
+        self.assertEqual(self.pool.run(tasks), {})
+
+    def test_errors(self):
+        tasks = {n: [self.repo(n).clone_cmd(u)] for n, u in self.urls.items()}
+        tasks['missing'] = [self.repo('missing').clone_cmd(
+            str(Path(self.tmp.name, 'missing.git')))]
+        errors = self.pool.run(tasks)
+        self.assertEqual(list(errors), ['missing'])
+        self.assertTrue(Path(self.repo('pkg0').path, 'PKGBUILD').exists())
+
+        e = GitPool.error(errors)
+        self.assertIsInstance(e, GitPool.GitError)
+        self.assertIn('missing: ', e.args[0]['errors'])
+
+    def test_timeout(self):
+        pool = GitPool(timeout=0.1)
+        errors = pool.run({'slow': [['sleep', '5']]})
+        self.assertIsInstance(errors['slow'], TimeoutError)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.dest = Path(self.tmp.name, 'pkg1')
+        self.server = RpcServer([aurpkg('pkg1')])
+        self.aurpkg = Aur(self.server.url).get_package('pkg1')
+
+    def tearDown(self):
+        self.server.close()
+        self.tmp.cleanup()
+
+    def serve(self, members):
+        self.server.server.files[urlparse(self.aurpkg.urlpath).path] = \
+            snapshot(members)
+
+    def test_download(self):
+        self.serve({'pkg1/PKGBUILD': b'pkgname=pkg1\n',
+                    'pkg1/src/patch': b'patch',
+                    'pkg1/link': (tarfile.SYMTYPE, 'src/patch'),
+                    'other/file': b''})
+        self.aurpkg.download(self.dest)
+        self.assertEqual(Path(self.dest, 'PKGBUILD').read_bytes(),
+                         b'pkgname=pkg1\n')
+        self.assertEqual(Path(self.dest, 'link').read_bytes(), b'patch')
+        self.assertFalse(Path(self.dest, 'file').exists())
+
+    def test_unsafe(self):
+        self.dest.mkdir()
+        for member in [{'pkg1/../evil': b''},
+                       {'/pkg1/evil': b''},
+                       {'pkg1/link': (tarfile.SYMTYPE, '../../evil')},
+                       {'pkg1/link': (tarfile.SYMTYPE, '/etc/passwd')},
+                       {'pkg1/fifo': (tarfile.FIFOTYPE, '')}]:
+            self.serve(dict(member, **{'pkg1/PKGBUILD': b''}))
+            with self.assertRaises(AurPackage.SnapshotError):
+                self.aurpkg.download(self.dest)
+            self.assertEqual(list(self.dest.iterdir()), [])
+        self.assertEqual(len(list(Path(self.tmp.name).iterdir())), 1)
+
+    def test_no_pkgbuild(self):
+        self.serve({'pkg1/file': b''})
+        with self.assertRaises(AurPackage.SnapshotError):
+            self.aurpkg.download(self.dest)
+        self.assertFalse(self.dest.exists())
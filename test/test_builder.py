@@ -1,3 +1,5 @@
+from types import SimpleNamespace
+from unittest.mock import patch
 import unittest
 
 from pkgbuilder.builder import Builder
@@ -15,6 +17,40 @@ def newBuilder(pkg='test1'):
                    source=Pkgbuild.Source.Local)
 
 
+class TestBuilderRegistry(unittest.TestCase):
+    def tearDown(self):
+        Builder.registry.invalidate()
+
+    def test_pkgbuild_key(self):
+        local = SimpleNamespace(builddir='/tmp/pkgbuilder/cache/local/dep')
+        aur = SimpleNamespace(builddir='/tmp/pkgbuilder/cache/aur/dep')
+        b1 = Builder.new('dep', builddir='/tmp/pkgbuilder/cache',
+                         chrootdir=chrootdir, pkgbuild=local)
+        b2 = Builder.new('dep', builddir='/tmp/pkgbuilder/cache',
+                         chrootdir=chrootdir, pkgbuild=aur)
+        self.assertIsNot(b1, b2)
+        self.assertIs(b2.pkgbuild, aur)
+        self.assertIs(Builder.new('dep', builddir='/tmp/pkgbuilder/cache',
+                                  chrootdir=chrootdir, pkgbuild=local), b1)
+
+
+class TestAlreadyBuilt(unittest.TestCase):
+    def test_no_lease(self):
+        class Pool:
+            def lease(self):
+                raise AssertionError('leased a copy for a built package')
+
+        b = newBuilder()
+        b.packages = {'/tmp/pkgbuilder/test1.pkg.tar.zst'}
+        b.key = 'key'
+        with patch.object(b, 'load', return_value={'key': 'key'}), \
+                patch.object(b, 'verify', return_value=True):
+            self.assertEqual(b._build_package(pool=Pool(), key='key'),
+                             b.packages)
+        self.assertTrue(b.built)
+        self.assertFalse(b.attempted)
+
+
 class TestMakeChroot(unittest.TestCase):
     def setUp(self):
         self.builder = newBuilder()
@@ -42,6 +78,21 @@ class TestBuild(unittest.TestCase):
         self.builder.pkgbuild.remove()
 
 
+class TestParallelBuild(unittest.TestCase):
+    def setUp(self):
+        self.builder = newBuilder()
+        self.builder.chroot.make()
+
+    def test_parallel_build(self):
+        self.assertTrue(self.builder.build(jobs=2))
+        self.assertIn(test1_dep1_pkg, pkgnames(self.builder.depends))
+        self.assertIn(test1_makedep1_pkg, pkgnames(self.builder.makedepends))
+        self.assertTrue(self.builder.verify())
+
+    def tearDown(self):
+        self.builder.pkgbuild.remove()
+
+
 class TestSaveManifest(unittest.TestCase):
     def setUp(self):
         self.builder = newBuilder()
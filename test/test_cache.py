@@ -0,0 +1,52 @@
+from tempfile import TemporaryDirectory
+import os
+import unittest
+
+from pkgbuilder.cache import DiskCache
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.cache = DiskCache(self.tmp.name, max_size=4096)
+
+    def test_get(self):
+        self.cache.put('aa', {'pkgbase': 'test1'})
+        self.assertEqual(self.cache.get('aa'), {'pkgbase': 'test1'})
+        self.assertIsNone(self.cache.get('bb'))
+
+    def test_persistent(self):
+        self.cache.put('aa', [1, 2, 3])
+        self.assertEqual(DiskCache(self.tmp.name).get('aa'), [1, 2, 3])
+
+    def test_evict(self):
+        self.cache.max_size = 1024 * 1024
+        for i in range(16):
+            self.cache.put('{:02x}'.format(i), bytes(512))
+            os.utime(self.cache._path('{:02x}'.format(i)), (i, i))
+        self.cache.get('00')
+        self.cache.max_size = 4096
+        self.cache.put('ff', bytes(512))
+        self.assertLessEqual(self.cache.size, 4096)
+        self.assertIsNotNone(self.cache.get('00'))
+        self.assertIsNone(self.cache.get('01'))
+        self.assertIsNotNone(self.cache.get('ff'))
+
+    def test_overwrite(self):
+        self.cache.put('aa', bytes(512))
+        self.cache.put('aa', bytes(256))
+        size = os.stat(self.cache._path('aa')).st_size
+        self.assertEqual(self.cache.size, size)
+        self.assertEqual(DiskCache(self.tmp.name).size, size)
+
+    def test_remove(self):
+        self.cache.put('aa', 1)
+        self.cache.remove('aa')
+        self.assertIsNone(self.cache.get('aa'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
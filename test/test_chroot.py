@@ -1,10 +1,25 @@
 from datetime import date
+from pathlib import Path
+from shutil import copytree, rmtree
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest.mock import patch
+import io
+import logging
+import os
+import subprocess
+import tarfile
+import time
 import unittest
 
-from pkgbuilder.chroot import Chroot, Mirrorlist
+from pkgbuilder.chroot import Chroot, ChrootCopy, ChrootPool, Mirrorlist, \
+    BaseImage, BtrfsBackend, CopyBackend, OverlayBackend, PackageCache, \
+    RsyncBackend, filesystem
 
 from .common import chrootdir
 
+log = logging.getLogger(__name__)
+
 
 class TestMirrorlistDate(unittest.TestCase):
     def setUp(self):
@@ -24,3 +39,337 @@ class TestMirrorlistStr(unittest.TestCase):
     def test_save(self):
         self.assertEqual(str(self.mirrorlist),
                          'Server = line1\nServer = line2')
+
+
+class TestChrootPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.chroot = Chroot(self.tmpdir.name, RsyncBackend)
+        self.pool = ChrootPool(self.chroot, 2, interval=0.01)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lease(self):
+        with self.pool.lease() as a:
+            with self.pool.lease() as b:
+                self.assertEqual((a.name, b.name),
+                                 ('pkgbuilder-1', 'pkgbuilder-2'))
+        with self.pool.lease() as c:
+            self.assertEqual(c.name, 'pkgbuilder-1')
+
+    def test_lease_process(self):
+        with self.pool.lease() as copy:
+            lock = '{}/{}.lease'.format(self.tmpdir.name, copy)
+            r = subprocess.run(['flock', '-n', lock, 'true'])
+            self.assertNotEqual(r.returncode, 0)
+        r = subprocess.run(['flock', '-n', lock, 'true'])
+        self.assertEqual(r.returncode, 0)
+
+    def test_wait(self):
+        leased = []
+        with self.pool.lease(), self.pool.lease():
+            def lease():
+                with self.pool.lease() as c:
+                    leased.append(c.name)
+            t = Thread(target=lease)
+            t.start()
+            t.join(0.1)
+            self.assertEqual(leased, [])
+        t.join()
+        self.assertEqual(leased, ['pkgbuilder-1'])
+
+    def test_stale(self):
+        self.chroot._touch()
+        with self.pool.lease() as copy:
+            self.assertTrue(copy.stale())
+            copy.path.mkdir()
+            copy.save(dirty=False)
+            self.assertFalse(copy.stale())
+            copy.save(dirty=True)
+            self.assertTrue(copy.stale())
+            copy.save(dirty=False)
+            self.chroot._touch()
+            self.assertTrue(copy.stale())
+
+
+def master(chroot, n=10, files=100):
+    for i in range(n):
+        d = Path(chroot.root, 'usr', str(i))
+        d.mkdir(parents=True)
+        for j in range(files):
+            Path(d, str(j)).write_bytes(bytes(1024))
+    chroot._touch()
+
+
+class TestCopyBackend(unittest.TestCase):
+    backends = [b for b in (BtrfsBackend, OverlayBackend, RsyncBackend)
+                if b.available('/tmp')]
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+
+    def tearDown(self):
+        for cls in self.backends:
+            chroot = Chroot(self.tmpdir.name, cls)
+            chroot.backend.remove(ChrootCopy(chroot, 'copy'))
+        self.tmpdir.cleanup()
+
+    def test_filesystem(self):
+        self.assertEqual(filesystem('/proc/self'), 'proc')
+        self.assertIsNotNone(filesystem(Path(self.tmpdir.name, 'missing')))
+
+    def test_unavailable(self):
+        chroot = Chroot(self.tmpdir.name)
+        with patch.object(BtrfsBackend, 'available', return_value=False), \
+                patch.object(OverlayBackend, 'available',
+                             return_value=False), \
+                patch.object(RsyncBackend, 'available', return_value=False):
+            with self.assertRaises(CopyBackend.CopyError):
+                chroot.backend
+
+    def test_overlay_release(self):
+        chroot = Chroot(self.tmpdir.name, OverlayBackend)
+        copy = ChrootCopy(chroot, 'copy')
+        with patch.object(os.path, 'ismount', return_value=True), \
+                patch.object(OverlayBackend, '_run') as run:
+            chroot.backend.release(copy)
+        run.assert_called_once_with(['umount', str(copy.path)], copy)
+
+    def test_reset(self):
+        if not self.backends:
+            self.skipTest('no copy backend is available')
+        for cls in self.backends:
+            chroot = Chroot(self.tmpdir.name, cls)
+            if not chroot.root.exists():
+                master(chroot, 1, 1)
+            copy = ChrootCopy(chroot, 'copy')
+            with self.subTest(backend=cls.name):
+                self.assertTrue(copy.stale())
+                copy.reset()
+                self.assertTrue(chroot.backend.exists(copy))
+                file = Path(copy.path, 'usr/0/0')
+                file.write_text('build')
+                Path(copy.path, 'new').touch()
+                self.assertEqual(Path(chroot.root, 'usr/0/0').read_bytes(),
+                                 bytes(1024))
+                copy.reset()
+                self.assertEqual(file.read_bytes(), bytes(1024))
+                self.assertFalse(Path(copy.path, 'new').exists())
+                chroot.backend.remove(copy)
+                self.assertFalse(chroot.backend.exists(copy))
+
+    def test_benchmark(self):
+        if not self.backends:
+            self.skipTest('no copy backend is available')
+        chroot = Chroot(self.tmpdir.name)
+        master(chroot)
+        start = time.perf_counter()
+        copytree(chroot.root, Path(self.tmpdir.name, 'full'))
+        log.info('full copy %.3fs', time.perf_counter() - start)
+        for cls in self.backends:
+            chroot = Chroot(self.tmpdir.name, cls)
+            copy = ChrootCopy(chroot, 'copy')
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                copy.reset()
+                times.append(time.perf_counter() - start)
+                Path(copy.path, 'usr/0/0').write_text('build')
+            chroot.backend.remove(copy)
+            log.info('%s: first copy %.3fs, reset %.3fs',
+                     cls.name, times[0], min(times[1:]))
+
+
+class TestBaseImage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.syncdir = Path(self.tmpdir.name, 'sync')
+        self.syncdir.mkdir()
+        Path(self.syncdir, 'core.db').write_bytes(b'core')
+        self.image = BaseImage(Path(self.tmpdir.name, 'images'), keep=1)
+        self.image.syncdir = self.syncdir
+        self.chroot = Chroot(Path(self.tmpdir.name, 'chroot'))
+        self.chroot.imagedir = self.image.path
+        Path(self.chroot.root, 'etc').mkdir(parents=True)
+        Path(self.chroot.root, 'etc/os-release').write_text('Arch')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fingerprint(self):
+        fp = self.image.fingerprint
+        image = BaseImage(self.image.path, ['devtools', 'base-devel'])
+        image.syncdir = self.syncdir
+        self.assertEqual(image.fingerprint, fp)
+        image = BaseImage(self.image.path, ['base-devel'])
+        image.syncdir = self.syncdir
+        self.assertNotEqual(image.fingerprint, fp)
+        Path(self.syncdir, 'core.db').write_bytes(b'core2')
+        image = BaseImage(self.image.path)
+        image.syncdir = self.syncdir
+        self.assertNotEqual(image.fingerprint, fp)
+
+    def test_restore(self):
+        self.assertFalse(self.image.exists())
+        self.image.create(self.chroot.root)
+        self.assertTrue(self.image.exists())
+        root = Path(self.tmpdir.name, 'root')
+        self.image.restore(root)
+        self.assertEqual(Path(root, 'etc/os-release').read_text(), 'Arch')
+
+    def test_make(self):
+        self.image.create(self.chroot.root)
+        rmtree(self.chroot.working_dir)
+        BaseImage.syncdir, syncdir = self.syncdir, BaseImage.syncdir
+        try:
+            self.chroot.make()
+        finally:
+            BaseImage.syncdir = syncdir
+        self.assertTrue(self.chroot.exists())
+        self.assertIsNotNone(self.chroot.stamp)
+
+    def test_prune(self):
+        self.image.create(self.chroot.root)
+        old = self.image.file
+        Path(self.syncdir, 'extra.db').write_bytes(b'extra')
+        image = BaseImage(self.image.path, keep=1)
+        image.syncdir = self.syncdir
+        time.sleep(0.01)
+        image.create(self.chroot.root)
+        self.assertFalse(old.exists())
+        self.assertTrue(image.exists())
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.chroot = Chroot(self.tmpdir.name, RsyncBackend)
+        self.syncdir = Path(self.chroot.root, 'var/lib/pacman/sync')
+        self.syncdir.mkdir(parents=True)
+        Path(self.chroot.mirrorlist.path).parent.mkdir(parents=True)
+        Path(self.chroot.mirrorlist.path).write_text('Server = a\n')
+        self.db = b'core'
+        self.calls = []
+        self.failing = set()
+        patcher = patch.object(Chroot, 'pacman', self.pacman)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def pacman(self, flags):
+        self.calls.append(flags)
+        if flags in self.failing:
+            return 1
+        if 'y' in flags:
+            Path(self.syncdir, 'core.db').write_bytes(self.db)
+        return 0
+
+    def test_refresh(self):
+        self.assertTrue(self.chroot.refresh())
+        self.assertFalse(self.chroot.refresh())
+        self.assertTrue(self.chroot.refresh(force=True))
+        self.assertEqual(self.calls, ['-Syy', '-Syy'])
+        self.chroot.ttl = 0
+        self.assertTrue(self.chroot.refresh())
+
+    def test_update(self):
+        self.assertTrue(self.chroot.update())
+        self.assertFalse(self.chroot.update())
+        self.assertEqual(self.calls, ['-Sy', '-Suu'])
+        self.chroot.ttl = 0
+        self.assertFalse(self.chroot.update())
+        self.assertEqual(self.calls, ['-Sy', '-Suu', '-Sy'])
+        self.db = b'core2'
+        self.assertTrue(self.chroot.update())
+        self.assertEqual(self.calls[-2:], ['-Sy', '-Suu'])
+
+    def test_refresh_failed(self):
+        self.failing = {'-Syy'}
+        self.assertFalse(self.chroot.refresh())
+        self.failing = set()
+        self.assertTrue(self.chroot.refresh())
+        self.assertEqual(self.calls, ['-Syy', '-Syy'])
+
+    def test_update_failed(self):
+        self.failing = {'-Sy'}
+        self.assertFalse(self.chroot.update())
+        self.assertEqual(self.calls, ['-Sy'])
+        self.failing = {'-Suu'}
+        self.assertFalse(self.chroot.update())
+        self.assertEqual(self.calls, ['-Sy', '-Sy', '-Suu'])
+        self.failing = set()
+        self.assertTrue(self.chroot.update())
+        self.assertEqual(self.calls[-1], '-Suu')
+
+    def test_transaction(self):
+        self.chroot.refresh()
+        with self.chroot.mirrorlist.transaction() as m:
+            m.set('b')
+            m.add('c')
+            with m.transaction():
+                m.add('d')
+            self.assertEqual(self.calls, ['-Syy'])
+        self.assertEqual(self.calls, ['-Syy', '-Syy'])
+        self.chroot.mirrorlist.write()
+        self.assertEqual(self.calls, ['-Syy', '-Syy'])
+        self.chroot.mirrorlist.add('e')
+        self.assertEqual(self.calls, ['-Syy', '-Syy', '-Syy'])
+
+
+def syncdb(path, filenames):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name in filenames:
+            desc = '%FILENAME%\n{}\n\n%NAME%\n{}\n'.format(
+                name, name.split('-')[0]).encode()
+            info = tarfile.TarInfo(name.rsplit('-', 1)[0] + '/desc')
+            info.size = len(desc)
+            tar.addfile(info, io.BytesIO(desc))
+
+
+class TestPackageCache(unittest.TestCase):
+    conf = '[options]\n#CacheDir    = /var/cache/pacman/pkg/\n' \
+        'Architecture = auto\n\n[core]\nInclude = mirrorlist\n'
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.cache = PackageCache(Path(self.tmpdir.name, 'cache'), 2048)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_configure(self):
+        conf = Path(self.tmpdir.name, 'pacman.conf')
+        conf.write_text(self.conf)
+        self.assertTrue(self.cache.configure(conf))
+        self.assertEqual(conf.read_text(), self.conf.replace(
+            '#CacheDir    = /var/cache/pacman/pkg/',
+            'CacheDir = {}/'.format(self.cache.path)))
+        self.assertFalse(self.cache.configure(conf))
+        conf.write_text('[core]\n')
+        self.assertTrue(self.cache.configure(conf))
+        self.assertEqual(conf.read_text(), '[options]\nCacheDir = {}/\n'
+                         '[core]\n'.format(self.cache.path))
+
+    def test_clean(self):
+        syncdir = Path(self.tmpdir.name, 'sync')
+        syncdir.mkdir()
+        syncdb(Path(syncdir, 'core.db'), ['a-2-1-any.pkg.tar.zst'])
+        self.assertEqual(PackageCache.referenced(syncdir),
+                         {'a-2-1-any.pkg.tar.zst'})
+        self.cache.path.mkdir()
+        files = ['a-1-1-any.pkg.tar.zst', 'a-1-1-any.pkg.tar.zst.sig',
+                 'b-1-1-any.pkg.tar.zst', 'a-2-1-any.pkg.tar.zst',
+                 'a-2-1-any.pkg.tar.zst.sig']
+        for i, name in enumerate(files):
+            p = Path(self.cache.path, name)
+            p.write_bytes(bytes(1024))
+            os.utime(p, (i, i))
+        with self.cache.lock():
+            self.assertEqual(self.cache.clean(syncdir), 0)
+        self.assertEqual(self.cache.clean(syncdir), 3072)
+        self.assertEqual(sorted(p.name for p in self.cache.path.iterdir()
+                                if not p.name.startswith('.')),
+                         files[3:])
@@ -0,0 +1,93 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import gzip
+import json
+import time
+import unittest
+
+from pkgbuilder.aur import Aur, ConnectionPool
+from pkgbuilder.index import AurIndex
+
+from .test_aur import RpcServer
+
+count = 20000
+
+
+def dump(path):
+    infos = []
+    for i in range(count):
+        info = {'Name': 'pkg{}'.format(i), 'Version': '1.{}-1'.format(i),
+                'URLPath': '/cgit/aur.git/snapshot/pkg{}.tar.gz'.format(i),
+                'Depends': ['pkg{}'.format(i + 1)] if i % 100 else []}
+        if i % 1000 == 0:
+            info['Provides'] = ['virtual{}=1.{}'.format(i // 2000, i)]
+        infos.append(info)
+    with gzip.open(path, 'wt') as f:
+        json.dump(infos, f)
+
+
+class TestAurIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = TemporaryDirectory()
+        cls.dump = Path(cls.tmp.name, 'packages-meta-ext-v1.json.gz')
+        dump(cls.dump)
+        cls.index = AurIndex.load(cls.dump, Path(cls.tmp.name, 'aur.idx'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.close()
+        cls.tmp.cleanup()
+
+    def test_get(self):
+        self.assertEqual(len(self.index), count)
+        self.assertEqual(self.index.get('pkg1234')['Version'], '1.1234-1')
+        self.assertIn('pkg0', self.index)
+        self.assertIn('pkg{}'.format(count - 1), self.index)
+        self.assertNotIn('pkg', self.index)
+        self.assertNotIn('virtual0', self.index)
+
+    def test_providers(self):
+        names = [i['Name'] for i in self.index.providers('virtual1')]
+        self.assertEqual(sorted(names), ['pkg2000', 'pkg3000'])
+        self.assertEqual(self.index.providers('pkg1'), [])
+
+    def test_invalid(self):
+        path = Path(self.tmp.name, 'invalid.idx')
+        path.write_bytes(b'invalid')
+        with self.assertRaises(AurIndex.InvalidIndexError):
+            AurIndex(path)
+
+    def test_lookup_speed(self):
+        start = time.perf_counter()
+        for i in range(10000):
+            self.index.get('pkg{}'.format(i))
+        self.assertLess((time.perf_counter() - start) / 10000, 0.001)
+
+    def test_aur(self):
+        aur = Aur('http://127.0.0.1:1', offline=True, index=self.index)
+        self.assertEqual(aur.get_package('pkg5').name, 'pkg5')
+        self.assertEqual(len(aur.prefetch(['pkg150'])), 51)
+        infos = aur.prefetch(['pkg3999'])
+        self.assertEqual(sorted(infos), ['pkg3999', 'pkg4000'])
+        infos = aur.prefetch(['virtual2'])
+        self.assertEqual(sorted(infos), ['pkg4000', 'pkg5000'])
+
+    def test_aur_online(self):
+        server = RpcServer([{'Name': 'pkg7', 'Version': '2.0-1',
+                             'Depends': []}])
+        pool = ConnectionPool()
+        try:
+            aur = Aur(server.url, pool=pool, index=self.index)
+            self.assertEqual(aur.infos('pkg7')['pkg7']['Version'], '2.0-1')
+            self.assertEqual(len(server.requests), 1)
+        finally:
+            pool.close()
+            server.close()
+        aur = Aur(server.url, pool=ConnectionPool(retries=0),
+                  index=self.index)
+        self.assertEqual(aur.infos('pkg8')['pkg8']['Version'], '1.8-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,18 @@
 from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 import os
+import shutil
 import unittest
 
-from pkgbuilder.pkgbuild import Pkgbuild, LocalDir, Restriction, \
-    parse_restriction
+from pkgbuilder.aur import Aur, AurPackage, MirrorStore
+from pkgbuilder.pkgbuild import Pkgbuild, LocalDir, AurPkgbuild, \
+    SnapshotPkgbuild, Restriction, parse_restriction
+from pkgbuilder.utils import read_makepkg_conf
 
 from .common import test1_pkg, localdir, pkgnames
+from .test_aur import RpcServer, aurpkg, snapshot
 
 
 def newPkgbuild(pkg='test1'):
@@ -29,13 +36,47 @@ class TestLocalPkgbuild(unittest.TestCase):
         self.assertEqual(srcinfo['depends'], ['test1-dep1'])
         self.assertEqual(srcinfo['makedepends'], ['test1-makedep1'])
 
+    def test_srcinfo_file_rewritten(self):
+        self.pkgbuild.srcinfo
+        file = Path(self.pkgbuild.builddir, '.SRCINFO')
+        info = file.read_text()
+        file.write_text('stale')
+        self.pkgbuild._srcinfo = {}
+        self.assertEqual(self.pkgbuild.srcinfo['pkgbase'], 'test1')
+        self.assertEqual(file.read_text(), info)
+
     def test_dependency_restrictions(self):
         self.assertFalse(self.pkgbuild.dependency_restrictions('test1-dep1'))
 
+    def test_inputs(self):
+        self.assertEqual([p.name for p in self.pkgbuild.inputs], ['PKGBUILD'])
+        self.assertEqual(self.pkgbuild.digest, newPkgbuild().digest)
+
     def tearDown(self):
         self.pkgbuild.remove()
 
 
+@unittest.skipUnless(read_makepkg_conf(), 'makepkg.conf not found')
+class TestPackagelist(unittest.TestCase):
+    def setUp(self):
+        self.localdir = LocalDir(localdir, '/tmp/pkgbuilder/cache')
+        self.localdir.update()
+
+    def test_srcinfo_packagelist(self):
+        for pkgbuilds in self.localdir.packages.values():
+            for pkgbuild in pkgbuilds:
+                self.assertEqual(pkgbuild._srcinfo_packagelist(),
+                                 pkgbuild._makepkg_packagelist())
+
+
+class TestSharedPkgbuild(unittest.TestCase):
+    def test_shared_pkgbuild(self):
+        pkgbuild = newPkgbuild()
+        self.assertIs(newPkgbuild(), pkgbuild)
+        Pkgbuild.invalidate('test1')
+        self.assertIsNot(newPkgbuild(), pkgbuild)
+
+
 class TestNoPkgbuild(unittest.TestCase):
     def test_no_pkgbuild_error(self):
         try:
@@ -61,6 +102,45 @@ class TestRestriction(unittest.TestCase):
         self.assertEqual(r, Restriction('>=', '2'))
 
 
+class TestProviders(unittest.TestCase):
+    def setUp(self):
+        self.providers = LocalDir.Providers()
+        for v in ['1', '3', '2']:
+            self.providers.add(v, 'pkg' + v)
+
+    def test_select(self):
+        self.assertEqual(self.providers.select(), ['pkg3', 'pkg2', 'pkg1'])
+        self.assertEqual(self.providers.select([Restriction('>', '1'),
+                                                Restriction('<', '3')]),
+                         ['pkg2'])
+        self.assertEqual(self.providers.select([Restriction('=', '3')]),
+                         ['pkg3'])
+        self.assertEqual(self.providers.select([Restriction('<=', '0')]), [])
+
+    def test_select_vercmp(self):
+        self.providers.add('1.10', 'pkg1.10')
+        self.providers.add('1:0.1', 'pkg1:0.1')
+        self.assertEqual(self.providers.select([Restriction('<', '1:0')]),
+                         ['pkg3', 'pkg2', 'pkg1.10', 'pkg1'])
+
+    def test_select_pkgrel(self):
+        providers = LocalDir.Providers()
+        for v in ['1.5-2', '1.5', '1.5-1', '1.4-3', '1.6']:
+            providers.add(v, 'pkg' + v)
+        self.assertEqual(providers.versions,
+                         ['1.4-3', '1.5', '1.5-1', '1.5-2', '1.6'])
+        self.assertEqual(providers.select([Restriction('=', '1.5')]),
+                         ['pkg1.5-2', 'pkg1.5-1', 'pkg1.5'])
+        self.assertEqual(providers.select([Restriction('>=', '1.5-2')]),
+                         ['pkg1.6', 'pkg1.5-2', 'pkg1.5'])
+        self.assertEqual(providers.select([Restriction('<', '1.5-2')]),
+                         ['pkg1.5-1', 'pkg1.4-3'])
+
+    def test_remove(self):
+        self.providers.remove('pkg3')
+        self.assertEqual(self.providers.select(), ['pkg2', 'pkg1'])
+
+
 class TestLocalDir(unittest.TestCase):
     def setUp(self):
         self.localdir = LocalDir(localdir, '/tmp/pkgbuilder/cache')
@@ -97,6 +177,169 @@ class TestLocalDir(unittest.TestCase):
         except LocalDir.ProviderNotFoundError:
             return True
 
+    def test_provides_pkgbase(self):
+        pkg = self.localdir.providers('test-provides')
+        self.assertEqual(pkg[0].name, 'test-provides')
+
+    def test_serial_update(self):
+        d = LocalDir(localdir, '/tmp/pkgbuilder/cache', jobs=1)
+        self.assertEqual(set(d.update()), set(self.localdir.packages))
+        self.assertFalse(d.errors)
+
+
+class TestIncrementalUpdate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = Path(self.tmpdir.name, 'local')
+        self.builddir = Path(self.tmpdir.name, 'cache')
+        for name in ['test1', 'test1-dep1', 'test-provides']:
+            shutil.copytree(Path(localdir, name), Path(self.path, name))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def localdir(self):
+        d = LocalDir(str(self.path), str(self.builddir), jobs=1)
+        scan = d._scan
+        d.scanned = []
+
+        def _scan(names):
+            d.scanned += names
+            return scan(names)
+        d._scan = _scan
+        return d
+
+    def test_snapshot(self):
+        d = self.localdir()
+        d.update()
+        self.assertEqual(d.scanned, ['test-provides', 'test1', 'test1-dep1'])
+        self.assertTrue(d.snapshot_path.exists())
+
+        d = self.localdir()
+        packages = d.update()
+        self.assertEqual(d.scanned, [])
+        self.assertEqual(len(packages), 4)
+
+    def test_changed(self):
+        self.localdir().update()
+        os.utime(Path(self.path, 'test1-dep1', 'PKGBUILD'))
+        with open(Path(self.path, 'test1', 'PKGBUILD'), 'a') as f:
+            f.write('\n# changed\n')
+        shutil.rmtree(Path(self.path, 'test-provides'))
+
+        d = self.localdir()
+        packages = d.update()
+        self.assertEqual(d.scanned, ['test1'])
+        self.assertEqual(len(packages), 2)
+
+
+class TestAurStaleness(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.url = self.tmpdir.name
+        src = Path(self.url, 'src')
+        shutil.copytree(Path(localdir, 'test1'), src)
+        for cmd in [['init', '-q', '-b', 'master'], ['add', '.'],
+                    ['-c', 'user.name=test', '-c', 'user.email=test',
+                     'commit', '-q', '-m', 'init']]:
+            run(['git', '-C', str(src)] + cmd, check=True)
+        run(['git', 'clone', '-q', '--bare', str(src),
+             str(Path(self.url, 'test1.git'))], check=True)
+
+        self.aur = Pkgbuild.aur
+        Pkgbuild.aur = Aur(offline=True)
+        self.setInfo(1)
+
+    def tearDown(self):
+        Pkgbuild.aur = self.aur
+        self.tmpdir.cleanup()
+
+    def setInfo(self, modified):
+        Pkgbuild.aur.cache['test1'] = {'Name': 'test1', 'URLPath': '',
+                                       'Version': '1-1',
+                                       'LastModified': modified}
+
+    def newPkgbuild(self):
+        aurpkg = AurPackage(Pkgbuild.aur.info('test1'), self.url)
+        return AurPkgbuild('test1', Path(self.url, 'cache'), aurpkg)
+
+    def test_stale(self):
+        pkgbuild = self.newPkgbuild()
+        pkgbuild.update()
+        self.assertTrue(pkgbuild.statepath.exists())
+
+        with patch.object(MirrorStore, 'pull_cmd',
+                          return_value=['true']) as pull:
+            self.newPkgbuild().update()
+            pull.assert_not_called()
+
+            self.setInfo(2)
+            pkgbuild = self.newPkgbuild()
+            self.assertTrue(pkgbuild.stale())
+            pkgbuild.update()
+            pull.assert_called_once()
+        self.assertEqual(pkgbuild._load_state()['LastModified'], 2)
+
+    def test_mirror(self):
+        pkgbuild = self.newPkgbuild()
+        pkgbuild.update()
+        self.assertTrue(pkgbuild.mirrors.fresh(pkgbuild.aurpkg))
+
+        shutil.rmtree(Path(self.url, 'test1.git'))
+        pkgbuild.remove()
+        pkgbuild.update()
+        self.assertTrue(pkgbuild.pkgbuildpath.exists())
+
+    def test_update_all(self):
+        pkgbuild = self.newPkgbuild()
+        Pkgbuild.update_all([pkgbuild])
+        self.assertFalse(pkgbuild.check_update)
+        self.assertTrue(pkgbuild.pkgbuildpath.exists())
+        self.assertTrue(pkgbuild.statepath.exists())
+
+
+class TestSnapshotPkgbuild(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.names = ['pkg{}'.format(i) for i in range(8)]
+        self.server = RpcServer([aurpkg(n) for n in self.names])
+        for n in self.names:
+            path = '/cgit/aur.git/snapshot/{}.tar.gz'.format(n)
+            self.server.server.files[path] = snapshot(
+                {n + '/PKGBUILD': 'pkgname={}\n'.format(n).encode()})
+        self.aur = Pkgbuild.aur
+        Pkgbuild.aur = Aur(self.server.url)
+
+    def tearDown(self):
+        Pkgbuild.aur = self.aur
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def newPkgbuild(self, name):
+        return SnapshotPkgbuild(name, self.tmpdir.name,
+                                Pkgbuild.aur.get_package(name))
+
+    def test_update_all(self):
+        pkgbuilds = [self.newPkgbuild(n) for n in self.names]
+        Pkgbuild.update_all(pkgbuilds, jobs=4)
+        for p in pkgbuilds:
+            self.assertFalse(p.check_update)
+            self.assertTrue(p.pkgbuildpath.exists())
+
+        n = len(self.server.requests)
+        pkgbuild = self.newPkgbuild('pkg0')
+        pkgbuild.update()
+        self.assertFalse(pkgbuild.stale())
+        self.assertEqual(len(self.server.requests), n)
+
+    def test_update_error(self):
+        del self.server.server.files['/cgit/aur.git/snapshot/pkg1.tar.gz']
+        pkgbuilds = [self.newPkgbuild(n) for n in self.names]
+        with self.assertRaises(Pkgbuild.UpdateError) as e:
+            Pkgbuild.update_all(pkgbuilds)
+        self.assertIn('pkg1: ', e.exception.args[0]['errors'])
+        self.assertTrue(pkgbuilds[0].pkgbuildpath.exists())
+
 
 if __name__ == '__main__':
     unittest.main()
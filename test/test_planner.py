@@ -0,0 +1,90 @@
+from unittest.mock import patch
+import unittest
+
+from pkgbuilder.pkgbuild import Pkgbuild, LocalDir
+from pkgbuilder.planner import Planner
+
+from .common import localdir
+
+builddir = '/tmp/pkgbuilder/cache'
+
+
+def newPlanner():
+    d = LocalDir(localdir, builddir)
+    d.update()
+    return Planner(d, builddir, Pkgbuild.Source.Local)
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.planner = newPlanner()
+        self.pkgbuild = self.planner.localdir.providers('test1')[0]
+
+    def test_plan_order(self):
+        plan = self.planner.plan(self.pkgbuild)
+        names = [n.name for n in plan]
+        self.assertEqual(names[-1], 'test1')
+        self.assertIn('test1-dep1', names)
+        self.assertIn('test1-makedep1', names)
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_plan_edges(self):
+        node = self.planner.plan(self.pkgbuild)[-1]
+        self.assertEqual([n.name for n in node.depends], ['test1-dep1'])
+        self.assertEqual([n.name for n in node.makedepends],
+                         ['test1-makedep1'])
+
+    def test_provider_not_found_error(self):
+        pkgbuild = self.planner.localdir.providers('test-fail')[0]
+        with self.assertRaises(LocalDir.ProviderNotFoundError):
+            self.planner.plan(pkgbuild)
+
+    def tearDown(self):
+        self.pkgbuild.remove()
+
+
+class FakeLocalDir:
+    def __init__(self, pkgbuilds):
+        self.pkgbuilds = {p.name: p for p in pkgbuilds}
+
+    def providers(self, name, restrictions=[]):
+        if name not in self.pkgbuilds:
+            raise LocalDir.ProviderNotFoundError({'message': name})
+        return [self.pkgbuilds[name]]
+
+
+class FakeAur:
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, names):
+        self.prefetched.append(sorted(names))
+        return {}
+
+
+class FakePkgbuild:
+    def __init__(self, name, depends=[], makedepends=[]):
+        self.name = name
+        self.depends = dict.fromkeys(depends, [])
+        self.makedepends = dict.fromkeys(makedepends, [])
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_prefetch_local_depends(self):
+        dep = FakePkgbuild('local-dep', ['aur-dep2', 'repo-dep'])
+        makedep = FakePkgbuild('local-makedep', [],
+                               ['aur-dep3', 'local-dep'])
+        pkgbuild = FakePkgbuild('pkg', ['aur-dep1', 'local-dep'],
+                                ['local-makedep'])
+        planner = Planner(FakeLocalDir([dep, makedep, pkgbuild]), builddir)
+        aur = FakeAur()
+        with patch.object(Pkgbuild, 'aur', aur), \
+                patch.object(Planner, 'in_repos',
+                             lambda self, n, rs=[]: n.startswith('repo-')):
+            planner.prefetch(pkgbuild)
+        self.assertEqual(aur.prefetched,
+                         [['aur-dep1', 'aur-dep2', 'aur-dep3']])
+
+
+if __name__ == '__main__':
+    unittest.main()
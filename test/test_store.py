@@ -0,0 +1,82 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import json
+import os
+import unittest
+
+from pkgbuilder.store import ManifestStore
+
+
+def manifest(name, packages, depends=[], makedepends=[]):
+    return {'name': name, 'timestamp': 0, 'packages': packages,
+            'depends': depends, 'makedepends': makedepends}
+
+
+class TestManifestStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.store = ManifestStore(Path(self.tmp.name, 'manifest.db'))
+        self.store.save(manifest('dep', ['/dep.pkg']), '/local/dep')
+        self.store.save(manifest('pkg', ['/pkg.pkg'], ['/dep.pkg']),
+                        '/local/pkg')
+
+    def test_load(self):
+        d = self.store.load('/local/pkg')
+        self.assertEqual(d['name'], 'pkg')
+        self.assertEqual(d['packages'], ['/pkg.pkg'])
+        self.assertEqual(d['depends'], ['/dep.pkg'])
+        self.assertEqual(self.store.load('/local/none'), {})
+
+    def test_edges(self):
+        self.assertEqual(self.store.dependents('dep'), {'pkg'})
+        self.assertEqual(self.store.depends('pkg'), {'dep'})
+
+    def test_edges_saved_before_depend(self):
+        self.store.save(manifest('pkg2', ['/pkg2.pkg'], [], ['/dep2.pkg']),
+                        '/local/pkg2')
+        self.assertEqual(self.store.depends('pkg2'), set())
+        self.store.save(manifest('dep2', ['/dep2.pkg']), '/local/dep2')
+        self.assertEqual(self.store.dependents('dep2'), {'pkg2'})
+        self.assertEqual(self.store.depends('pkg2'), {'dep2'})
+
+    def test_missing_dir(self):
+        store = ManifestStore(Path(self.tmp.name, 'new', 'manifest.db'))
+        self.assertFalse(store.exists('/local/pkg'))
+        store.close()
+
+    def test_remove(self):
+        self.store.remove('/local/pkg')
+        self.assertFalse(self.store.exists('/local/pkg'))
+        self.assertEqual(self.store.dependents('dep'), set())
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        for name, m in [('dep', manifest('dep', ['/dep.pkg'])),
+                        ('pkg', manifest('pkg', ['/pkg.pkg'], [],
+                                         ['/dep.pkg']))]:
+            d = Path(self.tmp.name, 'local', name)
+            os.makedirs(d)
+            with open(Path(d, 'build.json'), 'w') as f:
+                json.dump(m, f)
+        self.store = ManifestStore(Path(self.tmp.name, 'manifest.db'))
+
+    def test_migrate(self):
+        self.assertFalse(self.store.migrated)
+        self.assertEqual(self.store.migrate(self.tmp.name), 2)
+        self.assertTrue(self.store.migrated)
+        self.assertEqual(sorted(self.store.built()), ['dep', 'pkg'])
+        self.assertEqual(self.store.dependents('dep'), {'pkg'})
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
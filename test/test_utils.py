@@ -4,7 +4,8 @@ from tempfile import TemporaryDirectory
 import os
 import unittest
 
-from pkgbuilder.utils import synctree
+from pkgbuilder.utils import Registry, hash_files, read_makepkg_conf, \
+    synctree
 
 
 class TestSynctree(unittest.TestCase):
@@ -48,3 +49,69 @@ class TestSynctree(unittest.TestCase):
     def tearDown(self):
         self.seed.cleanup()
         self.tmp.cleanup()
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_get(self):
+        a = self.registry.get('a', object)
+        self.assertIs(self.registry.get('a', object), a)
+
+    def test_invalidate(self):
+        self.registry.get('a', object)
+        self.registry.get('b', object)
+        self.assertEqual(self.registry.invalidate(lambda k: k == 'a'), 1)
+        self.assertNotIn('a', self.registry)
+        self.assertIn('b', self.registry)
+        self.assertEqual(self.registry.invalidate(), 1)
+        self.assertEqual(len(self.registry), 0)
+
+
+class TestHashFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.file = Path(self.tmp.name, 'file')
+        self.file.write_text('before')
+
+    def test_hash_files(self):
+        h = hash_files([self.file], self.tmp.name)
+        self.assertEqual(hash_files([self.file], self.tmp.name), h)
+        self.file.write_text('after')
+        self.assertNotEqual(hash_files([self.file], self.tmp.name), h)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class TestReadMakepkgConf(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.conf = Path(self.tmp.name, 'makepkg.conf')
+        self.conf.write_text('CARCH="x86_64"\n'
+                             'OPTIONS=(strip docs\n'
+                             '         !debug) # comment\n'
+                             "PKGEXT='.pkg.tar.zst'\n"
+                             'LDFLAGS="$LDFLAGS -s"\n')
+        os.mkdir(Path(self.tmp.name, 'makepkg.conf.d'))
+        Path(self.tmp.name, 'makepkg.conf.d', 'ext.conf').write_text(
+            "PKGEXT='.pkg.tar.xz'\n")
+
+    def test_read_makepkg_conf(self):
+        conf = read_makepkg_conf(str(self.conf))
+        self.assertEqual(conf['CARCH'], 'x86_64')
+        self.assertEqual(conf['OPTIONS'], ['strip', 'docs', '!debug'])
+        self.assertEqual(conf['PKGEXT'], '.pkg.tar.xz')
+        self.assertIsNone(conf['LDFLAGS'])
+
+    def test_read_makepkg_conf_changed(self):
+        self.assertEqual(read_makepkg_conf(str(self.conf))['CARCH'], 'x86_64')
+        self.conf.write_text('CARCH="aarch64"\n')
+        st = self.conf.stat()
+        os.utime(self.conf, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(read_makepkg_conf(str(self.conf))['CARCH'],
+                         'aarch64')
+
+    def tearDown(self):
+        self.tmp.cleanup()
@@ -0,0 +1,133 @@
+from random import Random
+from shutil import which
+from subprocess import run
+import logging
+import time
+import unittest
+
+from pkgbuilder.pkgbuild import Restriction
+from pkgbuilder.vercmp import vercmp, parse_version, satisfies, \
+    sort_versions, total_vercmp
+
+log = logging.getLogger(__name__)
+
+# Cases from pacman's test/util/vercmptest.sh.
+cases = [
+    ('1.5.0', '1.5.0', 0),
+    ('1.5.1', '1.5.0', 1),
+    ('1.5.1', '1.5', 1),
+    ('1.5.0-1', '1.5.0-1', 0),
+    ('1.5.0-1', '1.5.0-2', -1),
+    ('1.5.0-1', '1.5.1-1', -1),
+    ('1.5.0-2', '1.5.1-1', -1),
+    ('1.5-1', '1.5.1-1', -1),
+    ('1.5-2', '1.5.1-1', -1),
+    ('1.5-2', '1.5.1-2', -1),
+    ('1.5', '1.5-1', 0),
+    ('1.5-1', '1.5', 0),
+    ('1.1-1', '1.1', 0),
+    ('1.0-1', '1.1', -1),
+    ('1.1-1', '1.0', 1),
+    ('1.5b-1', '1.5-1', -1),
+    ('1.5b', '1.5', -1),
+    ('1.5b-1', '1.5', -1),
+    ('1.5b', '1.5.1', -1),
+    ('1.0a', '1.0alpha', -1),
+    ('1.0alpha', '1.0b', -1),
+    ('1.0b', '1.0beta', -1),
+    ('1.0beta', '1.0rc', -1),
+    ('1.0rc', '1.0', -1),
+    ('1.5.a', '1.5', 1),
+    ('1.5.b', '1.5.a', 1),
+    ('1.5.1', '1.5.b', 1),
+    ('1.5.b-1', '1.5.b', 0),
+    ('1.5-1', '1.5.b', -1),
+    ('2.0', '2_0', 0),
+    ('2.0_a', '2_0.a', 0),
+    ('2.0a', '2.0.a', -1),
+    ('2___a', '2_a', 1),
+    ('0:1.0', '0:1.0', 0),
+    ('0:1.0', '0:1.1', -1),
+    ('1:1.0', '0:1.0', 1),
+    ('1:1.0', '0:1.1', 1),
+    ('1:1.0', '2:1.1', -1),
+    ('1:1.0', '0:1.0-1', 1),
+    ('1:1.0-1', '0:1.1-1', 1),
+    ('0:1.0', '1.0', 0),
+    ('0:1.0', '1.1', -1),
+    ('0:1.1', '1.0', 1),
+    ('1:1.0', '1.0', 1),
+    ('1:1.0', '1.1', 1),
+    ('1:1.1', '1.1', 1),
+    ('1.10', '1.9', 1),
+]
+
+
+def random_versions(n, seed=0):
+    r = Random(seed)
+    parts = ['0', '1', '2', '9', '10', '010', 'a', 'b', 'rc', 'alpha']
+    seps = ['.', '.', '.', '_', '+']
+    versions = []
+    for _ in range(n):
+        v = r.choice(parts[:5])
+        for _ in range(r.randint(0, 3)):
+            v += r.choice(seps) + r.choice(parts)
+        if r.random() < 0.3:
+            v = '{}:{}'.format(r.randint(0, 2), v)
+        if r.random() < 0.5:
+            v += '-{}'.format(r.randint(1, 3))
+        versions.append(v)
+    return versions
+
+
+class TestVercmp(unittest.TestCase):
+    def test_vercmp(self):
+        for a, b, r in cases:
+            self.assertEqual(vercmp(a, b), r, (a, b))
+            self.assertEqual(vercmp(b, a), -r, (b, a))
+
+    def test_parse_version(self):
+        self.assertEqual(parse_version('1:2.0-3'), ('1', '2.0', '3'))
+        self.assertEqual(parse_version('2.0'), ('0', '2.0', None))
+
+    def test_sort_versions(self):
+        self.assertEqual(sort_versions(['1.10', '1:0.1', '1.9', '1.9-2']),
+                         ['1.9', '1.9-2', '1.10', '1:0.1'])
+
+    def test_total_vercmp(self):
+        self.assertEqual(total_vercmp('1.5', '1.5-1'), -1)
+        self.assertEqual(total_vercmp('1.5-2', '1.5-1'), 1)
+        self.assertEqual(total_vercmp('1.5-1', '1.5-1'), 0)
+        self.assertEqual(total_vercmp('1.5-9', '1.6'), -1)
+        self.assertEqual(total_vercmp('1:1', '2-1'), 1)
+
+    def test_satisfies(self):
+        self.assertTrue(satisfies('1.10-1', Restriction('>', '1.9')))
+        self.assertTrue(satisfies('2-3', Restriction('=', '2')))
+        self.assertFalse(satisfies('2-3', Restriction('=', '2-1')))
+        self.assertTrue(satisfies('2', None))
+
+
+@unittest.skipUnless(which('vercmp'), 'vercmp not found')
+class TestVercmpBinary(unittest.TestCase):
+    def test_vercmp_binary(self):
+        versions = random_versions(200)
+        pairs = list(zip(versions, reversed(versions)))
+
+        start = time.perf_counter()
+        expected = [int(run(['vercmp', a, b], capture_output=True,
+                            text=True).stdout) for a, b in pairs]
+        binary = time.perf_counter() - start
+
+        vercmp.cache_clear()
+        start = time.perf_counter()
+        results = [vercmp(a, b) for a, b in pairs]
+        native = time.perf_counter() - start
+
+        self.assertEqual(results, [max(-1, min(1, r)) for r in expected])
+        log.info('vercmp: %d comparisons, binary %.3fs, native %.6fs',
+                 len(pairs), binary, native)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from pathlib import Path
+from subprocess import CalledProcessError
+from tempfile import TemporaryDirectory
+import os
+import unittest
+
+from pkgbuilder.pkgbuild import Pkgbuild
+from pkgbuilder.watch import InotifyWatcher, PollWatcher, Watch
+
+
+class WatcherTests:
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        for name in ['pkg1', 'pkg2']:
+            Path(self.path, name).mkdir()
+            Path(self.path, name, 'PKGBUILD').write_text(name)
+        self.watcher = self.newWatcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmpdir.cleanup()
+
+    def test_timeout(self):
+        self.assertEqual(self.watcher.read(0.1), set())
+
+    def test_modify(self):
+        Path(self.path, 'pkg1', 'PKGBUILD').write_text('changed')
+        self.assertEqual(self.watcher.read(1), {'pkg1'})
+
+    def test_create(self):
+        Path(self.path, 'pkg3').mkdir()
+        self.assertEqual(self.watcher.read(1), {'pkg3'})
+        self.watcher.read(0.1)
+        Path(self.path, 'pkg3', 'PKGBUILD').write_text('pkg3')
+        self.assertEqual(self.watcher.read(1), {'pkg3'})
+
+    def test_ignored(self):
+        Path(self.path, 'pkg2', '.PKGBUILD.swp').write_text('')
+        self.assertEqual(self.watcher.read(0.1), set())
+
+
+class TestPollWatcher(WatcherTests, unittest.TestCase):
+    def newWatcher(self):
+        return PollWatcher(self.path, interval=0.05)
+
+
+class TestInotifyWatcher(WatcherTests, unittest.TestCase):
+    def newWatcher(self):
+        try:
+            return InotifyWatcher(self.path)
+        except OSError as e:
+            self.skipTest(str(e))
+
+
+class FakeWatcher:
+    def __init__(self, events):
+        self.events = events
+
+    def read(self, timeout=None):
+        return self.events.pop(0) if self.events else set()
+
+    def close(self):
+        pass
+
+
+class FakeLocalDir:
+    path = '/pkgbuilds'
+    builddir = '/tmp/pkgbuilder/cache'
+    names = ['pkg1', 'pkg2', 'pkg3']
+
+
+class Node:
+    def __init__(self, name):
+        self.pkgbuild = type('Pkgbuild', (), {})()
+        self.pkgbuild.localdir = Path(FakeLocalDir.path, name)
+
+
+class FakeBuilder:
+    plans = {'pkg1': ['pkg1'],
+             'pkg2': ['pkg1', 'pkg2'],
+             'pkg3': ['pkg3']}
+
+    def __init__(self, name):
+        self.name = name
+
+    def plan(self):
+        return [Node(n) for n in self.plans[self.name]]
+
+
+class BrokenBuilder(FakeBuilder):
+    errors = {'pkg2': CalledProcessError(1, ['makepkg', '--printsrcinfo']),
+              'pkg3': Pkgbuild.ParseSrcinfoError(
+                  {'message': 'Failed to parse PKGBUILD srcinfo'})}
+
+    def plan(self):
+        if self.name in self.errors:
+            raise self.errors[self.name]
+        return super().plan()
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.watch = Watch(FakeLocalDir(), FakeBuilder, debounce=0)
+
+    def tearDown(self):
+        self.watch.close()
+
+    def test_debounce(self):
+        self.watch.watcher = FakeWatcher([{'pkg1'}, {'pkg2'}, set(),
+                                          {'pkg3'}])
+        self.assertEqual(self.watch.wait(), {'pkg1', 'pkg2'})
+        self.assertEqual(self.watch.wait(), {'pkg3'})
+
+    def test_overflow(self):
+        self.watch.watcher = FakeWatcher([{'pkg1'}, None, {'pkg2'}])
+        self.assertIsNone(self.watch.wait())
+        self.assertEqual(self.watch.affected(None), FakeLocalDir.names)
+
+    def test_affected(self):
+        dirs = {os.path.join(FakeLocalDir.path, 'pkg1')}
+        self.assertEqual(self.watch.affected(dirs), ['pkg1', 'pkg2'])
+
+    def test_affected_srcinfo_error(self):
+        self.watch.builder = BrokenBuilder
+        dirs = {os.path.join(FakeLocalDir.path, 'pkg1'),
+                os.path.join(FakeLocalDir.path, 'pkg3')}
+        with self.assertLogs('pkgbuilder.watch', 'ERROR') as cm:
+            self.assertEqual(self.watch.affected(dirs), ['pkg1'])
+        self.assertEqual(len(cm.output), 2)
+
+    def test_affected_names(self):
+        self.watch.names = ['pkg3']
+        dirs = {os.path.join(FakeLocalDir.path, 'pkg1')}
+        self.assertEqual(self.watch.affected(dirs), [])
+
+
+if __name__ == '__main__':
+    unittest.main()